@@ -1,9 +1,11 @@
-import random
 from contextlib import contextmanager
 
-import pymysql
-
 from glacia.debug import color
+from glacia.backends import create_backend
+from glacia.migrations import migrate
+
+
+__version__ = '0.2.0'
 
 
 # Read config file
@@ -16,10 +18,29 @@ class CompilerState(object):
     """
     Keeps track of generated temp variables in a glacia compilation.
 
+    Temp variables are numbered per function (see function()), so a change
+    which adds or removes temps in one function doesn't rename the temps of
+    the others, which would make them look changed on reload.
+
     """
 
     def __init__(self):
         self.__temp_var_index = -1
+        self.__functions = {}
+
+    def function(self, name):
+        """
+        Get the state of one function of the program, kept across all the
+        compiler stages.
+
+        """
+
+        ret = self.__functions.get(name)
+
+        if ret is None:
+            ret = self.__functions[name] = CompilerState()
+
+        return ret
 
     def next_id(self):
         self.__temp_var_index += 1
@@ -37,65 +58,211 @@ def close_after(ret):
         ret.close()
 
 
+# The lengths of the "in (...)" lists built by in_lists(). Queries over any
+# number of values then take one of a few forms, which the statement caches
+# can reuse.
+in_list_sizes = (1, 4, 16, 64, 256)
+
+
+def in_lists(values):
+    """
+    Split values into chunks to be matched with "in (...)", one query per
+    chunk. Each chunk is padded to one of in_list_sizes by repeating its last
+    value, which doesn't change what the query matches.
+
+    Returns:
+        A list of (placeholders, chunk) tuples, where placeholders is the
+        text to put between the parentheses.
+
+    """
+
+    values = list(values)
+    largest = in_list_sizes[-1]
+    ret = []
+
+    for i in range(0, len(values), largest):
+        chunk = values[i:i + largest]
+        size = next(size for size in in_list_sizes if size >= len(chunk))
+        chunk += chunk[-1:] * (size - len(chunk))
+
+        ret.append((', '.join(['%s'] * size), chunk))
+
+    return ret
+
+
+def config_get(key, default=None, section='db'):
+    """
+    Read a value from a section of the config file ([db] unless another is
+    named), stripping any surrounding double-quotes.
+
+    """
+
+    ret = config.get(section, key, fallback=default)
+
+    if isinstance(ret, str) and ret.startswith('"') and ret.endswith('"'):
+        ret = ret[1:-1]
+
+    return ret
+
+
 class Database(object):
-    def __init__(self):
-        self.__conn = None
+    """
+    A connection to the database storing a glacia program and its state.
+
+    Arguments:
+        backend (str): The storage backend to use ('mysql' or 'sqlite'). If
+                       None, the backend named in the config file is used,
+                       falling back to mysql.
+        path (str): The database file for file-based backends (sqlite).
+        pooled (bool): Whether to reuse connections from the process-wide
+                       connection pool. close() returns the connection to the
+                       pool, rolling back anything uncommitted.
+        section (str): The config file section to read connection settings
+                       from, for a database other than the main one (such as
+                       a shard, see glacia.shards).
+
+    Row IDs are 64-bit integers handed out by next_id(). IDs are reserved from
+    the sequences table in blocks of id_block_size, so most IDs are allocated
+    without a query. A block is reserved in the current transaction: if the
+    transaction is rolled back, the rest of the block is discarded.
+
+    Opening a database upgrades its schema if it is out of date (see
+    glacia.migrations).
 
-    def conn(self):
-        if self.__conn is None:
-            def rq(s):
-                if s.startswith('"') and s.endswith('"'):
-                    s = s[1:-1]
-                return s
+    """
 
-            self.__conn = pymysql.connect(host=rq(config.get('db', 'host')),
-                                          port=int(config.get('db', 'port')),
-                                          user=rq(config.get('db', 'user')),
-                                          passwd=rq(config.get('db', 'passwd')),
-                                          db=rq(config.get('db', 'db')))
+    id_block_size = 1000
+
+    def __init__(self, backend=None, path=None, pooled=True, section='db'):
+        if backend is None:
+            backend = config_get('backend', 'mysql', section)
+
+        if backend == 'sqlite':
+            options = {
+                'path': path if path is not None else
+                        config_get('path', 'glacia.db', section),
+            }
+        else:
+            options = {
+                'host': config_get('host', section=section),
+                'port': int(config_get('port', 3306, section)),
+                'user': config_get('user', section=section),
+                'passwd': config_get('passwd', section=section),
+                'db': config_get('db', section=section),
+            }
+
+        self.backend = create_backend(backend, pooled=pooled, **options)
+
+        self.__next_id = None
+        self.__id_limit = None
+
+        try:
+            migrate(self)
+        except:
+            self.close()
+            raise
 
-        return self.__conn
+    def conn(self):
+        return self.backend.conn()
 
     def close(self):
-        if self.__conn is not None:
-            self.__conn.close()
+        self.backend.close()
 
     def commit(self):
-        self.__conn.commit()
+        self.backend.commit()
+
+    def rollback(self):
+        self.backend.rollback()
+
+        # Any ID block reserved in the transaction is no longer reserved.
+        self.__next_id = None
+
+    def foreign_key_checks(self, enabled):
+        self.backend.foreign_key_checks(enabled)
 
     def cur(self):
-        return close_after(self.conn().cursor(pymysql.cursors.DictCursor))
+        return close_after(self.backend.cursor())
 
     def cmd(self, *args):
         with self.cur() as cur:
-            cur.execute(*args)
+            self.backend.execute(cur, *args)
             return cur.rowcount
 
-    def autoid(self, *args):
-        for i in range(10):
-            # Randomly generate an ID
-            new = ""
-            for j in range(3):
-                c = 48 + random.randrange(0, 36)
-                if c > 57: c += 39
-                new += chr(c)
-
-            temp_args = []
-            for arg in args:
-                temp_args.append(arg)
-
-            try:
-                temp_args[0] = args[0].replace('{$id}', "'" + new + "'")
-                self.cmd(*temp_args)
-                return new
-            except pymysql.err.IntegrityError as e:
-                print("id collision")
-                if i == 9:
-                    raise e
+    def many(self, query, rows):
+        """
+        Execute a command once for each parameter tuple in rows.
+
+        """
+
+        with self.cur() as cur:
+            self.backend.execute_many(cur, query, rows)
+            return cur.rowcount
+
+    def next_id(self):
+        """
+        Allocate a new row ID.
+
+        """
+
+        if self.__next_id is None or self.__next_id >= self.__id_limit:
+            self.__next_id = self.reserve_ids(self.id_block_size)
+            self.__id_limit = self.__next_id + self.id_block_size
+
+        ret = self.__next_id
+        self.__next_id += 1
+
+        return ret
+
+    def reserve_ids(self, count):
+        """
+        Reserve a range of consecutive row IDs with a single query, in the
+        current transaction.
+
+        Returns:
+            The first ID of the range.
+
+        """
+
+        self.cmd("update sequences set next_id = next_id + %s " +
+                 "where name = 'ids';",
+                 (count,))
+
+        return self.scalar("select next_id from sequences " +
+                           "where name = 'ids';") - count
+
+    def skip_ids(self, last_id):
+        """
+        Make sure no ID up to and including last_id is allocated again, for
+        when IDs were used without their block having been committed.
+
+        """
+
+        self.cmd("update sequences set next_id = %s " +
+                 "where name = 'ids' and next_id <= %s;",
+                 (last_id + 1, last_id))
+
+        self.__next_id = None
+
+    def autoid(self, query, args=()):
+        """
+        Run an insert with a newly-allocated ID as its first parameter, ahead
+        of args. The ID is passed as a parameter rather than written into the
+        query, so every insert has the same query text.
+
+        Returns:
+            The new ID.
+
+        """
+
+        new = self.next_id()
+
+        self.cmd(query, (new,) + tuple(args))
+
+        return new
 
     def res(self, *args):
         with self.cur() as cursor:
-            cursor.execute(*args)
+            self.backend.execute(cursor, *args)
             for row in cursor:
                 yield row
 
@@ -106,12 +273,32 @@ class Database(object):
         for row in self.res(*args):
             return row
 
+    def row(self, *args):
+        """
+        Get the first row of a query as a tuple. Cheaper than first() for
+        frequently-run queries.
+
+        """
+
+        cur = self.backend.tuple_cursor()
+        self.backend.execute(cur, *args)
+        return cur.fetchone()
+
+    def rows(self, *args):
+        """
+        Get all rows of a query as tuples.
+
+        """
+
+        cur = self.backend.tuple_cursor()
+        self.backend.execute(cur, *args)
+        return cur.fetchall()
+
     def scalar(self, *args):
-        ret = self.first(*args)
+        ret = self.row(*args)
 
         if ret is not None:
-            for k,v in ret.items():
-                return v
+            return ret[0]
 
 
 class Token(object):
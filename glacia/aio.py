@@ -0,0 +1,224 @@
+"""
+Runs many programs at once from a single process, on an asyncio event loop.
+
+An Interpreter blocks on every query, so on its own a process spends most of
+its time waiting for the database. AsyncRunner keeps one Interpreter per
+program and runs them a slice of lines at a time on a bounded pool of
+threads (there is no async driver for either backend), so the database is
+kept busy with the queries of several programs while each one waits.
+
+Programs take turns: a program which has run a slice goes to the back of the
+queue, so a long program doesn't hold up short ones. Submitting waits while
+max_programs programs are unfinished, so a producer can't queue more work
+than the runner can keep up with.
+
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from glacia import Database
+from glacia.interpreter import Interpreter
+from glacia.scheduler import run_slice
+
+
+class AsyncRunner(object):
+    """
+    Runs programs concurrently on the running event loop until they finish.
+    Each slice is run and committed by a thread of the pool, and the
+    program's connection is returned to the connection pool in between, so
+    only the programs running a slice hold a connection.
+
+    Arguments:
+        backend (str): The storage backend to use. If None, the backend from
+                       the config file is used.
+        db_path (str): The database file for file-based backends.
+        concurrency (int): The most slices run at once (the size of the
+                           thread pool).
+        max_programs (int): The most unfinished programs. submit() waits for
+                            one to finish beyond this.
+        slice_lines (int): The most lines a program runs before giving
+                           another program a turn.
+        slice_ms (int): How long a program runs before giving another
+                        program a turn.
+        options (dict): Options for each program's Interpreter
+                        (commit_every, commit_interval_ms, sweep_every).
+
+    """
+
+    def __init__(self, backend=None, db_path=None, concurrency=8,
+                 max_programs=100, slice_lines=100, slice_ms=50,
+                 options=None):
+        self.backend = backend
+        self.db_path = db_path
+        self.concurrency = concurrency
+        self.max_programs = max_programs
+        self.slice_lines = slice_lines
+        self.slice_ms = slice_ms
+        self.options = options if options is not None else {}
+
+        self.__executor = None
+        self.__ready = None
+        self.__room = None
+        self.__slots = []
+        self.__pending = set()
+
+
+    def start(self):
+        """
+        Start running submitted programs. Must be called from a coroutine.
+
+        """
+
+        self.__executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        self.__ready = asyncio.Queue()
+        self.__room = asyncio.Semaphore(self.max_programs)
+
+        self.__slots = [asyncio.ensure_future(self.slot())
+                        for i in range(self.concurrency)]
+
+
+    async def submit(self, program_id, stdout_func=None):
+        """
+        Queue a loaded and started program to be run, waiting while there are
+        already max_programs unfinished programs.
+
+        Arguments:
+            program_id (int): The program to run.
+            stdout_func (callable): Receives the program's output instead of
+                                    stdout. Called from a pool thread.
+
+        Returns:
+            A future for the number of lines run, set once the program has
+            finished. If a line fails, the future holds the exception.
+
+        """
+
+        await self.__room.acquire()
+
+        program = {
+            'program_id': program_id,
+            'stdout_func': stdout_func,
+            'db': None,
+            'interpreter': None,
+            'lines': 0,
+            'done': asyncio.get_running_loop().create_future(),
+        }
+
+        self.__pending.add(program['done'])
+        self.__ready.put_nowait(program)
+
+        return program['done']
+
+
+    async def join(self):
+        """
+        Wait for every submitted program to finish.
+
+        """
+
+        while len(self.__pending) > 0:
+            await asyncio.wait(list(self.__pending))
+
+
+    async def close(self):
+        """
+        Wait for every submitted program to finish and stop the threads.
+
+        """
+
+        await self.join()
+
+        for slot in self.__slots:
+            slot.cancel()
+
+        await asyncio.gather(*self.__slots, return_exceptions=True)
+
+        self.__executor.shutdown()
+
+
+    async def slot(self):
+        """
+        Run slices of the programs in the queue, one at a time, until
+        cancelled.
+
+        """
+
+        loop = asyncio.get_running_loop()
+
+        while True:
+            program = await self.__ready.get()
+
+            try:
+                lines, more = await loop.run_in_executor(
+                    self.__executor, self.run_slice, program)
+            except Exception as e:
+                self.finish(program, e)
+                continue
+
+            program['lines'] += lines
+
+            if more:
+                self.__ready.put_nowait(program)
+            else:
+                self.finish(program)
+
+
+    def run_slice(self, program):
+        """
+        Run a slice of a program. Called from a pool thread.
+
+        """
+
+        if program['interpreter'] is None:
+            program['db'] = Database(self.backend, self.db_path)
+            program['interpreter'] = Interpreter(
+                program['db'], stdout_func=program['stdout_func'],
+                program_id=program['program_id'], **self.options)
+
+        try:
+            return run_slice(program['interpreter'], None, self.slice_lines,
+                             self.slice_ms)
+        finally:
+            # The connection is taken from the pool again by the next query.
+            program['db'].close()
+
+
+    def finish(self, program, error=None):
+        if error is not None:
+            program['done'].set_exception(error)
+        else:
+            program['done'].set_result(program['lines'])
+
+        self.__pending.discard(program['done'])
+        self.__room.release()
+
+
+def run_programs(program_ids, backend=None, db_path=None, **kwargs):
+    """
+    Run loaded and started programs to completion concurrently.
+
+    Arguments:
+        program_ids (list): The programs to run.
+        backend (str): The storage backend to use.
+        db_path (str): The database file for file-based backends.
+        kwargs: Other AsyncRunner arguments.
+
+    Returns:
+        The number of lines run by each program, in order. If a program
+        fails, its exception is raised once every program has finished.
+
+    """
+
+    async def main():
+        runner = AsyncRunner(backend, db_path, **kwargs)
+        runner.start()
+
+        try:
+            done = [await runner.submit(p) for p in program_ids]
+        finally:
+            await runner.close()
+
+        return [d.result() for d in done]
+
+    return asyncio.run(main())
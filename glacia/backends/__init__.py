@@ -0,0 +1,282 @@
+"""
+Storage backends for glacia.Database.
+
+A backend owns the connection to one database engine and knows the quirks of
+its SQL dialect. Database delegates to a backend so the interpreter and loader
+can issue the same queries regardless of where program state is stored.
+
+"""
+
+import atexit
+import importlib
+import threading
+
+
+# Maps backend names to the module and class implementing them. Modules are
+# imported on demand so optional drivers (pymysql) are only needed when used.
+backends = {
+    'mysql': ('glacia.backends.mysql', 'MySQLBackend'),
+    'sqlite': ('glacia.backends.sqlite', 'SQLiteBackend'),
+}
+
+
+class ConnectionPool(object):
+    """
+    Keeps idle driver connections open so they can be reused by later
+    Database instances in the same process instead of reconnecting.
+
+    Connections are grouped by Backend.key(), so only connections to the same
+    database are shared. Each connection is checked with Backend.ping()
+    before being handed out again.
+
+    Arguments:
+        max_idle (int): The maximum number of idle connections to keep per
+                        key. Connections released beyond this are closed.
+
+    """
+
+    def __init__(self, max_idle=8):
+        self.max_idle = max_idle
+
+        self.__idle = {}
+        self.__lock = threading.Lock()
+
+    def acquire(self, backend):
+        """
+        Get a healthy connection for a backend, opening one if none are idle.
+
+        """
+
+        key = backend.key()
+
+        while True:
+            with self.__lock:
+                idle = self.__idle.get(key)
+                conn = idle.pop() if idle else None
+
+            if conn is None:
+                return backend.connect()
+
+            if backend.ping(conn):
+                return conn
+
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def release(self, backend, conn):
+        """
+        Return a connection to the pool. Any uncommitted changes are rolled
+        back.
+
+        """
+
+        try:
+            conn.rollback()
+        except Exception:
+            conn = None
+
+        with self.__lock:
+            idle = self.__idle.setdefault(backend.key(), [])
+
+            if conn is not None and len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+
+        if conn is not None:
+            conn.close()
+
+    def clear(self):
+        """
+        Close all idle connections.
+
+        """
+
+        with self.__lock:
+            idle, self.__idle = self.__idle, {}
+
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+# The process-wide connection pool.
+pool = ConnectionPool()
+atexit.register(pool.clear)
+
+
+class Backend(object):
+    """
+    Base class for storage backends.
+
+    Queries are written in the DB-API "format" paramstyle (%s placeholders)
+    and are translated by backends which use something else.
+
+    Arguments:
+        pooled (bool): Whether to take connections from the process-wide
+                       pool and return them on close() instead of
+                       connecting and disconnecting every time.
+
+    """
+
+    name = None
+
+    # The exception raised by the driver when a unique key is violated.
+    IntegrityError = Exception
+
+    # Whether select ... for update skip locked is supported.
+    skip_locked = False
+
+    def __init__(self, pooled=True):
+        self.pooled = pooled
+
+        self._conn = None
+        self._tuple_cursor = None
+
+        # The number of queries run through this backend.
+        self.queries = 0
+
+    def key(self):
+        """
+        Identify the database this backend connects to. Pooled connections
+        are only shared between backends with the same key.
+
+        """
+        raise NotImplementedError
+
+    def connect(self):
+        """
+        Open a new driver connection.
+
+        """
+        raise NotImplementedError
+
+    def ping(self, conn):
+        """
+        Check whether a previously-opened connection is still usable.
+
+        """
+        raise NotImplementedError
+
+    def conn(self):
+        if self._conn is None:
+            if self.pooled:
+                self._conn = pool.acquire(self)
+            else:
+                self._conn = self.connect()
+
+        return self._conn
+
+    def close(self):
+        if self._tuple_cursor is not None:
+            self._tuple_cursor.close()
+            self._tuple_cursor = None
+
+        if self._conn is not None:
+            if self.pooled:
+                pool.release(self, self._conn)
+            else:
+                self._conn.close()
+
+            self._conn = None
+
+    def commit(self):
+        if self._conn is not None:
+            self._conn.commit()
+
+    def rollback(self):
+        if self._conn is not None:
+            self._conn.rollback()
+
+    def cursor(self):
+        """
+        Get a cursor which returns rows as dicts.
+
+        """
+        raise NotImplementedError
+
+    def new_tuple_cursor(self):
+        """
+        Create a cursor which returns rows as tuples.
+
+        """
+        raise NotImplementedError
+
+    def tuple_cursor(self):
+        """
+        Get a long-lived cursor which returns rows as tuples. It is shared by
+        all tuple queries on the connection, so results must be fetched
+        before the next query is run.
+
+        """
+
+        if self._tuple_cursor is None:
+            self._tuple_cursor = self.new_tuple_cursor()
+
+        return self._tuple_cursor
+
+    def translate(self, query):
+        """
+        Convert a query to the backend's SQL dialect.
+
+        """
+        return query
+
+    def execute(self, cur, query, args=None):
+        self.queries += 1
+
+        if args is None:
+            cur.execute(self.translate(query))
+        else:
+            cur.execute(self.translate(query), args)
+
+    def execute_many(self, cur, query, rows):
+        self.queries += 1
+        cur.executemany(self.translate(query), rows)
+
+    def foreign_key_checks(self, enabled):
+        """
+        Enable or disable foreign key checks for the current connection.
+
+        """
+        raise NotImplementedError
+
+    def has_table(self, name):
+        """
+        Check whether a table exists in the database.
+
+        """
+        raise NotImplementedError
+
+    def lock_schema(self):
+        """
+        Take a lock which keeps other connections from changing the schema
+        until unlock_schema() (see glacia.migrations).
+
+        """
+        raise NotImplementedError
+
+    def unlock_schema(self):
+        raise NotImplementedError
+
+
+def create_backend(name, **options):
+    """
+    Instantiate a backend by name.
+
+    Arguments:
+        name (str): The backend name ('mysql' or 'sqlite').
+        options: Keyword arguments passed to the backend's constructor.
+
+    Returns:
+        A Backend instance.
+
+    """
+
+    if name not in backends:
+        raise Exception('Unknown database backend: ' + str(name))
+
+    module_name, class_name = backends[name]
+
+    return getattr(importlib.import_module(module_name), class_name)(**options)
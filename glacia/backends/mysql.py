@@ -0,0 +1,111 @@
+import re
+
+import pymysql
+
+from glacia.backends import Backend
+
+
+# The version string of each server connected to, by Backend.key(). It is
+# read when connecting (see MySQLBackend.connect()).
+server_versions = {}
+
+
+def supports_skip_locked(version):
+    """
+    Check whether a server version string is new enough for select ... for
+    update skip locked: MySQL 8.0.1 or MariaDB 10.6.
+
+    """
+
+    numbers = tuple(int(n) for n in
+                    re.match(r'(\d+)\.(\d+)\.(\d+)', version).groups())
+
+    if 'mariadb' in version.lower():
+        return numbers >= (10, 6, 0)
+
+    return numbers >= (8, 0, 1)
+
+
+class MySQLBackend(Backend):
+    """
+    Stores glacia programs in a MySQL database. The schema is expected to
+    exist already (see vagrant/glacia.sql).
+
+    pymysql has no support for server-side prepared statements: parameters
+    are always interpolated client-side. Using tuple cursors avoids the cost
+    of building a dict for every row.
+
+    """
+
+    name = 'mysql'
+
+    IntegrityError = pymysql.err.IntegrityError
+
+    def __init__(self, host, port, user, passwd, db, pooled=True):
+        super().__init__(pooled=pooled)
+
+        self.host = host
+        self.port = port
+        self.user = user
+        self.passwd = passwd
+        self.db = db
+
+    def key(self):
+        return ('mysql', self.host, self.port, self.user, self.db)
+
+    def ping(self, conn):
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except pymysql.err.Error:
+            return False
+
+    @property
+    def skip_locked(self):
+        # Older servers (like the 5.5 of the Vagrant box) lease threads with
+        # the single update used for SQLite (see glacia.scheduler).
+        if self.key() not in server_versions:
+            self.conn()
+
+        return supports_skip_locked(server_versions[self.key()])
+
+    def connect(self):
+        conn = pymysql.connect(host=self.host, port=self.port, user=self.user,
+                               passwd=self.passwd, db=self.db)
+
+        with conn.cursor() as cur:
+            cur.execute("select version();")
+            server_versions[self.key()] = cur.fetchone()[0]
+
+        return conn
+
+    def cursor(self):
+        return self.conn().cursor(pymysql.cursors.DictCursor)
+
+    def new_tuple_cursor(self):
+        return self.conn().cursor()
+
+    def foreign_key_checks(self, enabled):
+        with self.conn().cursor() as cur:
+            cur.execute('set foreign_key_checks = ' + ('1' if enabled else '0'))
+
+    def has_table(self, name):
+        with self.conn().cursor() as cur:
+            cur.execute("select count(1) from information_schema.tables " +
+                        "where table_schema = database() and " +
+                        "table_name = %s;", (name,))
+
+            return cur.fetchone()[0] > 0
+
+    def lock_schema(self):
+        # DDL commits implicitly in MySQL, so use a named lock rather than a
+        # transaction.
+        with self.conn().cursor() as cur:
+            cur.execute("select get_lock('glacia_schema', 60);")
+
+            if cur.fetchone()[0] != 1:
+                raise Exception('Timed out waiting for the schema lock.')
+
+    def unlock_schema(self):
+        with self.conn().cursor() as cur:
+            cur.execute("select release_lock('glacia_schema');")
@@ -0,0 +1,141 @@
+import os
+import sqlite3
+import functools
+
+from glacia.backends import Backend
+
+
+schema_path = os.path.join(os.path.dirname(__file__), 'sqlite.sql')
+
+
+# Connection settings applied every time a database is opened. WAL lets
+# readers proceed while a line is being committed. synchronous=FULL syncs the
+# log on every commit: a commit which was lost in a power failure would have
+# its lines run again after resuming, repeating the output they printed.
+# Fewer syncs are had by committing less often (see commit_every).
+pragmas = [
+    ('journal_mode', 'wal'),
+    ('synchronous', 'full'),
+    ('foreign_keys', 'on'),
+    ('temp_store', 'memory'),
+    ('cache_size', '-16000'),
+    ('mmap_size', '268435456'),
+]
+
+
+# Queries translated to qmark placeholders, shared by all connections. Only
+# the most recently used are kept, so long-running processes (the daemon and
+# the job pool) don't grow it without bound.
+@functools.lru_cache(maxsize=1024)
+def qmark(query):
+    return query.replace('%s', '?')
+
+
+def dict_factory(cursor, row):
+    return {col[0]: row[i] for i, col in enumerate(cursor.description)}
+
+
+class SQLiteBackend(Backend):
+    """
+    Stores glacia programs in an embedded SQLite database file. The schema is
+    created automatically the first time a database file is opened.
+
+    """
+
+    name = 'sqlite'
+
+    IntegrityError = sqlite3.IntegrityError
+
+    def __init__(self, path, pooled=True):
+        super().__init__(pooled=pooled)
+
+        self.path = path
+
+    def key(self):
+        return ('sqlite', os.path.abspath(self.path))
+
+    def ping(self, conn):
+        try:
+            conn.execute('select 1;')
+            return True
+        except sqlite3.Error:
+            return False
+
+    def connect(self):
+        # Pooled connections may be handed to a different thread than the one
+        # which opened them (one thread at a time).
+        conn = sqlite3.connect(self.path, timeout=30, cached_statements=512,
+                               check_same_thread=False)
+        conn.row_factory = dict_factory
+
+        for pragma, value in pragmas:
+            conn.execute('pragma ' + pragma + ' = ' + value + ';')
+
+        self.create_schema(conn)
+
+        return conn
+
+    def create_schema(self, conn):
+        """
+        Create the glacia tables if they don't exist yet.
+
+        """
+
+        if conn.execute("select count(1) as c from sqlite_master " +
+                        "where type = 'table' and name = 'functions';"
+                        ).fetchone()['c'] > 0:
+            return
+
+        with open(schema_path, 'rb') as f:
+            conn.executescript(f.read().decode('utf-8'))
+
+    def cursor(self):
+        return self.conn().cursor()
+
+    def new_tuple_cursor(self):
+        cur = self.conn().cursor()
+        cur.row_factory = None
+        return cur
+
+    def translate(self, query):
+        # sqlite3 only understands qmark placeholders. Translations are cached
+        # by query so the same string is always passed to sqlite3, whose
+        # statement cache then reuses the prepared statement.
+        return qmark(query)
+
+    def foreign_key_checks(self, enabled):
+        conn = self.conn()
+
+        # defer_foreign_keys only lasts until the end of the transaction, so
+        # make sure there is one to attach it to.
+        if not enabled and not conn.in_transaction:
+            conn.execute('begin;')
+
+        conn.execute('pragma defer_foreign_keys = ' +
+                     ('off' if enabled else 'on') + ';')
+
+    def has_table(self, name):
+        return self.conn().execute(
+            "select count(1) as c from sqlite_master " +
+            "where type = 'table' and name = ?;", (name,)).fetchone()['c'] > 0
+
+    def lock_schema(self):
+        # An immediate transaction holds the write lock until it commits, so
+        # the lock is released by the commit which ends the migration.
+        # Foreign keys are off meanwhile so migrations can rebuild tables
+        # (dropping a table would otherwise delete the rows referring to it).
+        conn = self.conn()
+
+        if not conn.in_transaction:
+            conn.execute('pragma foreign_keys = off;')
+            conn.execute('begin immediate;')
+
+    def unlock_schema(self):
+        # A failed migration is still in its transaction, which has to end
+        # before foreign keys can be turned back on.
+        conn = self.conn()
+
+        if conn.in_transaction:
+            conn.rollback()
+
+        conn.execute('pragma foreign_keys = on;')
@@ -0,0 +1,201 @@
+/* SQLite port of vagrant/glacia.sql. */
+
+/* The schema version these tables are at (see glacia.migrations). */
+create table schema_version
+(
+    version int not null
+);
+
+insert into schema_version (version) values (10);
+
+/* Block allocator for row IDs (see Database.next_id()). */
+create table sequences
+(
+    name varchar(64)
+,   next_id integer
+
+,   primary key (name)
+);
+
+insert into sequences (name, next_id) values ('ids', 1);
+
+/* Namespaces holding a program and its state (see glacia.program). version
+   counts the loads of the program's code and free_head is the first address
+   of its free list. The rest tracks the program as a job (see glacia.jobs). */
+create table programs
+(
+    id integer
+,   name varchar(255)
+,   version integer not null default 0
+,   free_head integer not null default 0
+,   status varchar(16) not null default 'loaded'
+,   lines_run integer not null default 0
+,   submitted_at integer null
+,   started_at integer null
+,   finished_at integer null
+,   error text null
+
+,   primary key (id)
+,   unique (name)
+);
+
+insert into programs (id, name, version, free_head) values (0, 'default', 1, 0);
+
+/* The shard each program is placed on (see glacia.shards). */
+create table placements
+(
+    name varchar(255)
+,   shard varchar(255)
+
+,   primary key (name)
+);
+
+create index placements_shard on placements (shard);
+
+/* The new ID of each row copied by a fork in progress, by the new program
+   (see glacia.fork). */
+create table fork_ids
+(
+    program_id integer
+,   old_id integer
+,   new_id integer
+
+,   primary key (program_id, old_id)
+);
+
+create table functions
+(
+    id integer
+,   program_id integer not null default 0
+,   label varchar(255)
+,   return_type varchar(255)
+,   arguments text
+
+    /* sha256 of the function's DBIL, to skip unchanged functions on reload */
+,   code_hash char(64) null
+
+,   primary key (id)
+,   unique (program_id, label)
+);
+
+create table instructions
+(
+    id integer
+,   function_id integer null
+,   parent_id integer null
+,   previous_id integer null
+,   code text
+,   label varchar(64) null
+
+    /* Control flow worked out by the loader. The instruction to go to once
+       this one is done (null at the end of the function), the number of
+       conditionals popped on the way there and, for break and continue, the
+       enclosing loops as a JSON list of [loop id, conditionals popped]. */
+,   successor_id integer null
+,   exits integer not null default 0
+,   loops text null
+
+,   primary key (id)
+,   unique (function_id, parent_id, previous_id)
+,   unique (function_id, label)
+,   foreign key (function_id) references functions (id)
+,   foreign key (parent_id) references instructions (id)
+,   foreign key (previous_id) references instructions (id)
+);
+
+create index instructions_previous_id on instructions (previous_id);
+create index instructions_parent_id on instructions (parent_id);
+
+/* The scheduler worker running each thread and when its lease runs out (see
+   glacia.scheduler). version is bumped on every change (see
+   glacia.interpreter). */
+create table threads
+(
+    id integer
+,   program_id integer not null default 0
+,   lease_owner varchar(64) null
+,   lease_expires bigint null
+,   version integer not null default 0
+
+,   primary key (id)
+);
+
+create index threads_program_id on threads (program_id);
+
+/* The call stack. Each row is a frame in a thread. */
+create table calls
+(
+    id integer
+,   thread_id integer
+,   depth integer null
+,   instruction_id integer
+,   calling_instruction_id integer null
+,   version integer not null default 0
+
+,   primary key (id)
+,   unique (thread_id, depth)
+,   foreign key (thread_id) references threads (id)
+,   foreign key (instruction_id) references instructions (id)
+,   foreign key (calling_instruction_id) references instructions (id)
+);
+
+/* The conditional stack. Each row is a conditional (if[/else if][/else]). */
+create table conditionals
+(
+    call_id integer
+,   depth int
+,   satisfied bool
+
+,   primary key (call_id, depth)
+,   foreign key (call_id) references calls (id) on delete cascade
+);
+
+/* Addresses in virtual database "memory". refs counts the locals and items
+   referring to an address, owner_call_id is the frame it is freed with and
+   next_free_id chains freed addresses into the program's free list. */
+create table addresses
+(
+    id integer
+,   program_id integer not null default 0
+,   type varchar(16)
+,   val varchar(255)
+,   refs int not null default 0
+,   owner_call_id integer null
+,   next_free_id integer null
+,   version integer not null default 0
+
+,   primary key (id)
+);
+
+create index addresses_owner_call_id on addresses (owner_call_id);
+create index addresses_program_id on addresses (program_id);
+
+/* Local variables visible to a given call stack frame */
+create table locals
+(
+    id integer
+,   call_id integer
+,   label varchar(255)
+,   address_id integer
+
+,   primary key (id)
+,   unique (call_id, label)
+,   foreign key (call_id) references calls (id) on delete cascade
+,   foreign key (address_id) references addresses (id) on delete cascade
+);
+
+create index locals_address_id on locals (address_id);
+
+/* List items */
+create table items
+(
+    list_id integer
+,   ordinal int
+,   address_id integer
+
+,   primary key (list_id, ordinal)
+,   foreign key (list_id) references addresses (id) on delete cascade
+,   foreign key (address_id) references addresses (id) on delete cascade
+);
+
+create index items_address_id on items (address_id);
@@ -2,20 +2,333 @@
 #
 # Command-line interface for the glacia interpreter.
 #
+#   glacia -f prog.glacia               Compile, load and run a program.
+#   glacia                              Resume the loaded program.
+#   glacia compile -f prog.glacia -o prog.dbil
+#                                       Compile a program to an image.
+#   glacia load prog.dbil               Load an image (and run it with -r).
+#   glacia submit -n job1 -f prog.glacia
+#                                       Queue a program as a job.
+#   glacia pool --workers 4             Run the queued jobs.
+#   glacia jobs                         Show the progress of each job.
+#   glacia fork -p prog -n copy1 -n copy2
+#                                       Copy a program and its state.
+#   glacia batch a.glacia b.glacia      Run many programs in parallel.
+#   glacia daemon                       Serve requests on a Unix socket.
+#   glacia client run -p prog           Send a request to the daemon.
+#
 
 import sys
 import argparse
 
-from glacia.run import run
+from glacia.image import write_image, default_cache_dir
+
+
+def add_db_arguments(p):
+    p.add_argument("-b", "--backend", choices=['mysql', 'sqlite'])
+    p.add_argument("-d", "--db-path")
+
+
+def add_run_arguments(p):
+    p.add_argument("-v", "--verbose", action='store_true')
+    add_db_arguments(p)
+    p.add_argument("-e", "--engine", choices=['db', 'memory', 'log'],
+                   default='db')
+    p.add_argument("--commit-every", type=int)
+    p.add_argument("--commit-interval-ms", type=int)
+    p.add_argument("--log-path", default='glacia.log')
+    p.add_argument("--compact-lines", type=int)
+    p.add_argument("--sweep-every", type=int)
+    p.add_argument("--workers", type=int)
+    p.add_argument("-p", "--program")
+    p.add_argument("--shard", action='append', dest='shards')
+
+
+def run_options(args):
+    return {
+        'verbose': args.verbose,
+        'exec_lines': args.runlines,
+        'backend': args.backend,
+        'db_path': args.db_path,
+        'engine': args.engine,
+        'commit_every': args.commit_every,
+        'commit_interval_ms': args.commit_interval_ms,
+        'log_path': args.log_path,
+        'compact_lines': args.compact_lines,
+        'sweep_every': args.sweep_every,
+        'workers': args.workers,
+        'program': args.program,
+        'shards': args.shards,
+    }
+
+
+def jobs_main(command, argv):
+    from glacia import Database, close_after
+    from glacia import jobs
+    from glacia.shards import ShardMap, open_shard
+
+    p = argparse.ArgumentParser(prog='glacia ' + command)
+    add_db_arguments(p)
+
+    if command in ['submit', 'jobs']:
+        p.add_argument("--shard", action='append', dest='shards')
+
+    if command == 'submit':
+        p.add_argument("-n", "--name", required=True)
+        p.add_argument("-f", "--file")
+        p.add_argument("-i", "--image")
+        p.add_argument("--cache-dir", default=default_cache_dir())
+    elif command == 'pool':
+        p.add_argument("--workers", type=int)
+        p.add_argument("--max-running", type=int, default=100)
+        p.add_argument("--commit-every", type=int)
+
+    args = p.parse_args(argv)
+
+    if command == 'pool':
+        options = {}
+        if args.commit_every is not None:
+            options['commit_every'] = args.commit_every
+
+        jobs.JobPool(args.backend, args.db_path, workers=args.workers,
+                     max_running=args.max_running, options=options).run()
+        return
+
+    if command == 'submit':
+        if (args.file is None) == (args.image is None):
+            p.error("one of -f and -i is required")
+
+        if args.image is not None:
+            from glacia.image import read_image
+
+            generated = read_image(args.image)
+        else:
+            from glacia.compiler import compile_source
+
+            with open(args.file, 'rb') as f:
+                src = f.read().decode('utf-8')
+
+            generated = compile_source(src, cache_dir=args.cache_dir)
+
+    # With shards, a job is submitted to the shard it is placed on, and the
+    # database given by -b and -d is the directory (see glacia.shards).
+    with close_after(Database(args.backend, args.db_path)) as db:
+        if args.shards is None:
+            databases = [db]
+        elif command == 'submit':
+            databases = [ShardMap(db, args.shards, args.backend).open(
+                args.name, create=True)]
+        else:
+            databases = [open_shard(s, args.backend) for s in args.shards]
+
+        for shard_db in databases:
+            with close_after(shard_db):
+                if command == 'submit':
+                    print(jobs.submit(shard_db, args.name, generated))
+                    continue
+
+                for job in jobs.progress(shard_db):
+                    print('%-20s %-8s %10d lines %4d threads%s' %
+                          (job['name'], job['status'], job['lines_run'],
+                           job['threads'],
+                           '' if job['error'] is None
+                           else '  ' + job['error']))
+
+
+def fork_main(argv):
+    from glacia import Database, close_after
+    from glacia.fork import fork
+    from glacia.program import default_program_id, find_program
+
+    p = argparse.ArgumentParser(prog='glacia fork')
+    add_db_arguments(p)
+    p.add_argument("-p", "--program")
+    p.add_argument("-n", "--name", action='append', required=True)
+    p.add_argument("--queue", action='store_true',
+                   help="queue the copies as jobs for glacia pool")
+    args = p.parse_args(argv)
+
+    with close_after(Database(args.backend, args.db_path)) as db:
+        program_id = default_program_id
+
+        if args.program is not None:
+            program_id = find_program(db, args.program)
+
+            if program_id is None:
+                p.error("program not found: " + args.program)
+
+        for name in args.name:
+            print(fork(db, program_id, name,
+                       status='queued' if args.queue else 'loaded'))
+
+
+def batch_main(argv):
+    from glacia.run import run_batch
+
+    p = argparse.ArgumentParser(prog='glacia batch')
+    p.add_argument("files", nargs='+')
+    add_db_arguments(p)
+    p.add_argument("-j", "--concurrency", type=int, default=8)
+    p.add_argument("--prefix", default='batch')
+    p.add_argument("--commit-every", type=int)
+    p.add_argument("--cache-dir", default=default_cache_dir())
+    args = p.parse_args(argv)
+
+    failed = 0
+
+    for result in run_batch(args.files, backend=args.backend,
+                            db_path=args.db_path,
+                            concurrency=args.concurrency, prefix=args.prefix,
+                            commit_every=args.commit_every,
+                            cache_dir=args.cache_dir):
+        print('==> %s: %d lines, %d queries, %.3fs%s' %
+              (result['fn'], result['lines'], result['queries'],
+               result['seconds'],
+               '' if result['error'] is None else '  ' + result['error']))
+
+        for line in result['output']:
+            print(line)
+
+        if result['error'] is not None:
+            failed += 1
+
+    if failed > 0:
+        sys.exit(1)
+
+
+def daemon_main(argv):
+    from glacia.daemon import Daemon
+    from glacia.client import default_socket_path, DaemonError
+
+    p = argparse.ArgumentParser(prog='glacia daemon')
+    add_db_arguments(p)
+    p.add_argument("-s", "--socket", default=default_socket_path)
+    p.add_argument("--cache-dir", default=default_cache_dir())
+    p.add_argument("--commit-every", type=int)
+    args = p.parse_args(argv)
+
+    options = {}
+    if args.commit_every is not None:
+        options['commit_every'] = args.commit_every
+
+    try:
+        Daemon(args.socket, args.backend, args.db_path,
+               cache_dir=args.cache_dir, options=options).serve()
+    except DaemonError as e:
+        sys.exit('glacia daemon: ' + str(e))
+
+
+def client_main(argv):
+    from glacia.client import request, default_socket_path, DaemonError
+
+    p = argparse.ArgumentParser(prog='glacia client')
+    p.add_argument("op", choices=['load', 'submit', 'run', 'step', 'status',
+                                  'shutdown'])
+    p.add_argument("-s", "--socket", default=default_socket_path)
+    p.add_argument("-p", "--program")
+    p.add_argument("-f", "--file")
+    p.add_argument("-n", "--lines", type=int)
+    args = p.parse_args(argv)
+
+    message = {}
+    if args.program is not None:
+        message['program'] = args.program
+    if args.lines is not None:
+        message['lines'] = args.lines
+
+    if args.op in ['load', 'submit']:
+        if args.program is None or args.file is None:
+            p.error("-p and -f are required to " + args.op)
+
+        # The daemon may not see the same files, so send the source.
+        with open(args.file, 'rb') as f:
+            message['src'] = f.read().decode('utf-8')
+    elif args.op in ['run', 'step'] and args.program is None:
+        p.error("-p is required to " + args.op)
+
+    try:
+        ret = request(args.op, socket_path=args.socket, **message)
+    except OSError as e:
+        sys.exit('glacia client: no daemon on ' + args.socket + ' (' +
+                 e.strerror + ').')
+    except DaemonError as e:
+        sys.exit('glacia client: ' + str(e))
+
+    for line in ret.get('output', []):
+        print(line)
+
+    for program in ret.get('programs', []):
+        for line in program.get('output', []):
+            print(line)
+
+        print('%-20s %-8s %10d lines%s' %
+              (program['program'],
+               'running' if program['running'] else 'idle',
+               program['lines'],
+               '' if program['error'] is None else '  ' + program['error']))
+
+
+def main(argv):
+    # Importing the run module pulls in the whole interpreter, which isn't
+    # needed to compile.
+    if len(argv) > 0 and argv[0] == 'compile':
+        from glacia.compiler import compile_source
+
+        p = argparse.ArgumentParser(prog='glacia compile')
+        p.add_argument("-v", "--verbose", action='store_true')
+        p.add_argument("-f", "--file", required=True)
+        p.add_argument("-o", "--output", required=True)
+        args = p.parse_args(argv[1:])
+
+        with open(args.file, 'rb') as f:
+            src = f.read().decode('utf-8')
+
+        write_image(args.output, compile_source(src, verbose=args.verbose))
+        return
+
+    if len(argv) > 0 and argv[0] in ['submit', 'jobs', 'pool']:
+        jobs_main(argv[0], argv[1:])
+        return
+
+    if len(argv) > 0 and argv[0] == 'fork':
+        fork_main(argv[1:])
+        return
+
+    if len(argv) > 0 and argv[0] == 'batch':
+        batch_main(argv[1:])
+        return
+
+    if len(argv) > 0 and argv[0] == 'client':
+        client_main(argv[1:])
+        return
+
+    if len(argv) > 0 and argv[0] == 'daemon':
+        daemon_main(argv[1:])
+        return
+
+    from glacia.run import run
+
+    if len(argv) > 0 and argv[0] == 'load':
+        p = argparse.ArgumentParser(prog='glacia load')
+        p.add_argument("image")
+        p.add_argument("-r", "--runlines", type=int, default=0)
+        add_run_arguments(p)
+        args = p.parse_args(argv[1:])
+
+        run(image=args.image, **run_options(args))
+        return
+
+    p = argparse.ArgumentParser()
+    p.add_argument("-r", "--runlines", type=int, default=-1)
+    p.add_argument("-f", "--file")
+    p.add_argument("--cache-dir", default=default_cache_dir())
+    p.add_argument("--no-cache", action='store_true')
+    add_run_arguments(p)
+    args = p.parse_args(argv)
+
+    run(fn=args.file, cache_dir=None if args.no_cache else args.cache_dir,
+        **run_options(args))
 
-p = argparse.ArgumentParser()
-p.add_argument("-v", "--verbose", action='store_true')
-p.add_argument("-r", "--runlines", type=int, default=-1)
-p.add_argument("-f", "--file")
-args = p.parse_args(sys.argv[1:])
 
-run(**{
-    'verbose': args.verbose,
-    'exec_lines': args.runlines,
-    'fn': args.file,
-})
+if __name__ == '__main__':
+    main(sys.argv[1:])
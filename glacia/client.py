@@ -0,0 +1,81 @@
+"""
+Client for the glacia daemon (see glacia.daemon).
+
+Requests and responses are JSON objects, one per line. Only the standard
+library is needed to talk to the daemon, so the client starts without
+loading the compiler or interpreter.
+
+"""
+
+import os
+import json
+import socket
+import tempfile
+
+
+# The daemon's socket, in the user's runtime directory where there is one.
+# The socket itself is only accessible to its owner (see Daemon.serve()).
+default_socket_path = os.path.join(
+    os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(),
+    'glacia-' + str(os.getuid()) + '.sock')
+
+
+class DaemonError(Exception):
+    """
+    Raised when the daemon couldn't carry out a request.
+
+    """
+    pass
+
+
+def request(op, socket_path=default_socket_path, **args):
+    """
+    Send a request to the daemon and wait for the response.
+
+    Arguments:
+        op (str): The operation (see glacia.daemon.Daemon).
+        socket_path (str): The daemon's Unix socket.
+        args: The operation's arguments.
+
+    Returns:
+        The response as a dict.
+
+    Raises:
+        OSError: The daemon couldn't be reached.
+        DaemonError: The daemon couldn't carry out the request.
+
+    """
+
+    message = dict(args, op=op)
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+        with sock.makefile('rb') as f:
+            line = f.readline()
+
+    if len(line) == 0:
+        raise DaemonError('The daemon closed the connection.')
+
+    ret = json.loads(line.decode('utf-8'))
+
+    if not ret.get('ok'):
+        raise DaemonError(ret.get('error', 'Unknown daemon error.'))
+
+    return ret
+
+
+def daemon_running(socket_path=default_socket_path):
+    """
+    Check whether a daemon is listening on a socket.
+
+    """
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            return False
+
+    return True
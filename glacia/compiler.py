@@ -0,0 +1,100 @@
+from glacia.debug import divider, print_tokens, print_nodes, print_program
+from glacia import CompilerState
+from glacia.preprocessor import preprocess
+from glacia.lexer import lex
+from glacia.parser import parse
+from glacia.semantics import analyze
+from glacia.restructurer import restructure
+from glacia.reducer import reduce
+from glacia.parameterizer import parameterize
+from glacia.generator import generate
+from glacia.liveness import liveness
+from glacia.loader import encode_function
+from glacia.image import cache_path, read_image, write_image
+
+
+def compile_source(src, verbose=False, cache_dir=None):
+    """
+    Compile glacia source code to DBIL.
+
+    If cache_dir is given, the output is cached there keyed by the source and
+    the compiler version, and compiling the same source again reads it back
+    instead of running the compiler. The cache isn't read in verbose mode so
+    every stage is still printed.
+
+    Arguments:
+        src (str): The source code to compile.
+        verbose (bool): Whether to print the output of each stage.
+        cache_dir (str): The compile cache directory, or None to disable the
+                         cache.
+
+    Returns:
+        DBIL code in dict format (see glacia.generator.generate()).
+
+    """
+
+    path = None if cache_dir is None else cache_path(cache_dir, src)
+
+    if path is not None and not verbose:
+        try:
+            return read_image(path)
+        except (IOError, ValueError):
+            pass
+
+    state = CompilerState()
+
+    if verbose:
+        divider('Source code')
+        print(src)
+
+    preprocessed = preprocess(src)
+    if verbose:
+        divider('Preprocessed.')
+        print(preprocessed)
+
+        divider('Partially lexed (still with whitespace)')
+    tokens = lex(preprocessed, preserve_whitespace=True)
+    if verbose:
+        print(print_tokens(tokens))
+
+        divider('Lexed')
+    tokens = lex(preprocessed)
+    if verbose:
+        print(print_tokens(tokens,identifier_color='switch',line_width=60))
+
+    nodes = parse(tokens)
+    if verbose:
+        divider('Parsed')
+        print(print_nodes(nodes).strip())
+
+    program = analyze(nodes)
+    if verbose:
+        divider('Analyzed')
+        print(print_program(program))
+
+    def run_stage(label, func):
+        func(program, state)
+        if verbose:
+            divider(label)
+            print(print_program(program))
+
+    run_stage('Restructured', restructure)
+    run_stage('Reduced', reduce)
+    run_stage('Parameterized', parameterize)
+
+    generated = liveness(generate(program))
+
+    # Hash each function now rather than every time it is loaded, so a reload
+    # only has to encode the functions which changed (see glacia.loader).
+    for function in generated:
+        function['hash'] = encode_function(function)[0]
+
+    # Like reading, writing the cache is best effort: a cache directory which
+    # can't be written to doesn't stop the program from running.
+    if path is not None:
+        try:
+            write_image(path, generated)
+        except IOError:
+            pass
+
+    return generated
@@ -0,0 +1,407 @@
+"""
+A long-running process which loads and runs programs on request, so that
+each request doesn't pay for starting Python, importing the compiler,
+connecting and reading the program back from the database.
+
+The daemon keeps its database connections, the compiled output of every
+source it has seen, the program caches and an Interpreter for each program
+between requests. Requests come in over a Unix socket as JSON objects, one
+per line, each answered with a JSON object with ok set to true, or false and
+an error (see glacia.client for the client side).
+
+Operations (program is a program name, see glacia.program):
+
+    load {program, src}         Compile, load and start a program.
+    submit {program, src}       Load a program and run it in the background.
+    run {program, lines}        Run lines of a program (all of them if -1)
+                                and return its output.
+    step {program, lines}       The same, one line unless lines is given.
+    status {program}            Report on a program, or on every program
+                                the daemon knows if none is given.
+    shutdown {}                 Stop the daemon once requests in progress
+                                have been answered.
+
+"""
+
+import os
+import json
+import threading
+import socketserver
+
+from glacia import Database, close_after
+from glacia.image import source_hash, default_cache_dir
+from glacia.loader import load
+from glacia.interpreter import Interpreter
+from glacia.program import find_program, create_program
+from glacia.scheduler import run_slice
+from glacia.compiler import compile_source
+from glacia.client import default_socket_path, daemon_running, \
+                          DaemonError
+
+
+class Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                ret = self.server.daemon.handle(
+                    json.loads(line.decode('utf-8')))
+                ret['ok'] = True
+            except Exception as e:
+                ret = {'ok': False, 'error': str(e)}
+
+            self.wfile.write(json.dumps(ret).encode('utf-8') + b'\n')
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon(object):
+    """
+    Serves requests to load and run programs (see the module docstring).
+
+    Arguments:
+        socket_path (str): The Unix socket to listen on. A stale socket file
+                           left by a daemon which didn't shut down cleanly is
+                           replaced, but not the socket of a daemon still
+                           running.
+        backend (str): The storage backend to use. If None, the backend from
+                       the config file is used.
+        db_path (str): The database file for file-based backends.
+        cache_dir (str): The compile cache directory, or None to only cache
+                         compiled programs in memory.
+        slice_lines (int): The most lines a background program runs before
+                           letting requests for it through.
+        slice_ms (int): How long a background program runs before letting
+                        requests for it through.
+        options (dict): Options for each program's Interpreter
+                        (commit_every, commit_interval_ms, sweep_every).
+
+    """
+
+    def __init__(self, socket_path=default_socket_path, backend=None,
+                 db_path=None, cache_dir=default_cache_dir(),
+                 slice_lines=100, slice_ms=50, options=None):
+        self.socket_path = socket_path
+        self.backend = backend
+        self.db_path = db_path
+        self.cache_dir = cache_dir
+        self.slice_lines = slice_lines
+        self.slice_ms = slice_ms
+        self.options = options if options is not None else {}
+
+        # Compiled programs by source_hash().
+        self.compiled = {}
+
+        # The daemon's state for each program by name: its Interpreter, the
+        # output of its background run and so on. The lock of a program is
+        # held while it runs.
+        self.programs = {}
+        self.lock = threading.Lock()
+
+        self.server = None
+
+
+    def serve(self):
+        """
+        Listen for requests until a shutdown request.
+
+        """
+
+        if os.path.exists(self.socket_path):
+            if daemon_running(self.socket_path):
+                raise DaemonError('A daemon is already listening on ' +
+                                self.socket_path + '.')
+
+            os.unlink(self.socket_path)
+
+        # Only the user running the daemon may connect to it, as requests run
+        # programs against the user's databases.
+        umask = os.umask(0o177)
+
+        try:
+            self.server = Server(self.socket_path, Handler)
+        finally:
+            os.umask(umask)
+
+        self.server.daemon = self
+
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+
+            for program in list(self.programs.values()):
+                self.stop(program)
+
+                with program['lock']:
+                    self.close(program)
+
+            os.unlink(self.socket_path)
+
+
+    def handle(self, request):
+        """
+        Carry out a request.
+
+        Returns:
+            The response as a dict.
+
+        """
+
+        op = request.get('op')
+
+        if op in ['load', 'submit']:
+            program = self.load(request['program'], request['src'])
+
+            if op == 'submit':
+                self.start(program)
+
+            return {'program_id': program['program_id']}
+
+        if op in ['run', 'step']:
+            return self.execute(self.program(request['program']),
+                                request.get('lines', -1 if op == 'run' else 1))
+
+        if op == 'status':
+            if request.get('program') is not None:
+                return {'programs': [
+                    self.status(self.program(request['program']),
+                                output=True)]}
+
+            with self.lock:
+                programs = list(self.programs.values())
+
+            return {'programs': [self.status(p) for p in programs]}
+
+        if op == 'shutdown':
+            # shutdown() waits for serve_forever() to return, which it can't
+            # while this request is being handled.
+            threading.Thread(target=self.server.shutdown).start()
+            return {}
+
+        raise Exception('Unknown operation: ' + str(op))
+
+
+    def compile(self, src):
+        """
+        Compile source code, reusing the output if it has been compiled
+        before.
+
+        """
+
+        key = source_hash(src)
+
+        with self.lock:
+            ret = self.compiled.get(key)
+
+        if ret is None:
+            ret = compile_source(src, cache_dir=self.cache_dir)
+
+            with self.lock:
+                self.compiled[key] = ret
+
+        return ret
+
+
+    def program(self, name, create=False):
+        """
+        Get the daemon's state for a program, starting from the program's
+        state in the database if the daemon hasn't used it yet.
+
+        """
+
+        with self.lock:
+            ret = self.programs.get(name)
+
+            if ret is not None:
+                return ret
+
+            with close_after(Database(self.backend, self.db_path)) as db:
+                program_id = find_program(db, name)
+
+                if program_id is None:
+                    if not create:
+                        raise Exception('Program not found: ' + name)
+
+                    program_id = create_program(db, name)
+                    db.commit()
+
+            ret = {
+                'name': name,
+                'program_id': program_id,
+                'lock': threading.Lock(),
+                'db': None,
+                'interpreter': None,
+                'output': [],
+                'lines': 0,
+                'thread': None,
+                'stop': False,
+                'error': None,
+            }
+
+            self.programs[name] = ret
+
+        return ret
+
+
+    def interpreter(self, program):
+        """
+        Get a program's Interpreter, creating it if needed. The program's lock
+        must be held.
+
+        """
+
+        if program['interpreter'] is None:
+            program['db'] = Database(self.backend, self.db_path)
+            program['interpreter'] = Interpreter(
+                program['db'], stdout_func=program['output'].append,
+                program_id=program['program_id'], **self.options)
+
+        return program['interpreter']
+
+
+    def close(self, program):
+        """
+        Drop a program's Interpreter and return its connection to the pool.
+        The program's lock must be held.
+
+        """
+
+        if program['db'] is not None:
+            program['db'].close()
+
+        program['db'] = None
+        program['interpreter'] = None
+
+
+    def load(self, name, src):
+        """
+        Compile and load a program, and start it.
+
+        Returns:
+            The daemon's state for the program.
+
+        """
+
+        generated = self.compile(src)
+        program = self.program(name, create=True)
+
+        self.stop(program)
+
+        with program['lock']:
+            # An Interpreter keeps the code loaded when it first ran, so the
+            # program gets a new one.
+            self.close(program)
+
+            interpreter = self.interpreter(program)
+
+            load(interpreter.db, generated, program['program_id'])
+            interpreter.start()
+
+            del program['output'][:]
+            program['lines'] = 0
+            program['error'] = None
+
+        return program
+
+
+    def execute(self, program, lines):
+        """
+        Run lines of a program and return its output, including any output
+        of a background run not yet returned.
+
+        """
+
+        if program['thread'] is not None:
+            raise Exception('Program is running in the background: ' +
+                            program['name'])
+
+        with program['lock']:
+            interpreter = self.interpreter(program)
+            ran = 0
+            more = True
+
+            try:
+                while more and (lines < 0 or ran < lines):
+                    more = interpreter.run_one_line()
+                    ran += 1
+            except:
+                interpreter.rollback()
+                raise
+            finally:
+                interpreter.flush()
+
+                program['lines'] += ran
+                output = list(program['output'])
+                del program['output'][:]
+
+        return {'output': output, 'lines': ran, 'more': more}
+
+
+    def start(self, program):
+        """
+        Run a program to the end in the background.
+
+        """
+
+        program['stop'] = False
+        program['thread'] = threading.Thread(target=self.background,
+                                             args=(program,), daemon=True)
+        program['thread'].start()
+
+
+    def stop(self, program):
+        """
+        Stop a program's background run, if any, after its current slice.
+
+        """
+
+        thread = program['thread']
+
+        if thread is not None:
+            program['stop'] = True
+            thread.join()
+
+
+    def background(self, program):
+        try:
+            more = True
+
+            while more and not program['stop']:
+                with program['lock']:
+                    lines, more = run_slice(self.interpreter(program), None,
+                                            self.slice_lines, self.slice_ms)
+                    program['lines'] += lines
+        except Exception as e:
+            program['error'] = str(e)
+        finally:
+            program['thread'] = None
+
+
+    def status(self, program, output=False):
+        """
+        Report on a program.
+
+        Arguments:
+            program (dict): The daemon's state for the program.
+            output (bool): Whether to include (and clear) the output
+                           collected from its background run.
+
+        """
+
+        ret = {
+            'program': program['name'],
+            'program_id': program['program_id'],
+            'running': program['thread'] is not None,
+            'lines': program['lines'],
+            'error': program['error'],
+        }
+
+        if output:
+            with program['lock']:
+                ret['output'] = list(program['output'])
+                del program['output'][:]
+
+        return ret
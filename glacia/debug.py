@@ -91,13 +91,13 @@ def print_db(db):
     ret = ''
 
     for r in db.all('select * from functions;'):
-        ret += '\t'.join([r['id'],r['return_type'],r['label'],
+        ret += '\t'.join([str(r['id']),r['return_type'],r['label'],
                           r['arguments']])+'\n'
 
     ret += '\n'
 
     for r in db.all('select * from instructions;'):
-        ret += '\t'.join([r[c] if r[c] else 'NUL'
+        ret += '\t'.join([str(r[c]) if r[c] else 'NUL'
                           for c in ['id','function_id','parent_id',
                                     'previous_id','code']]) + '\n\n'
 
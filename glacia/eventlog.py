@@ -0,0 +1,279 @@
+import os
+import json
+import time
+
+from glacia.memory import MemoryInterpreter, MemoryState
+from glacia.program import program_version, default_program_id
+
+
+class LogInterpreter(MemoryInterpreter):
+    """
+    An in-memory interpreter which makes its state durable by appending every
+    change to a log file instead of writing it to the database.
+
+    Each line that changes state makes one record (the list of changes made
+    by the line). Records are held in memory until a commit, which appends
+    them to the log in one write and fsyncs it, so commit_every and
+    commit_interval_ms control how records are batched per fsync. The log
+    only ever holds committed lines, whose output has been written out.
+
+    Periodically, at a commit, the whole state is written to a snapshot file
+    and the log is truncated (compaction). On startup the latest snapshot is
+    read and the log is replayed on top of it, stopping at the last complete
+    record, so a resumed program always lands on the last commit.
+
+    The program itself is still read from the database. State belonging to a
+    different program than the one currently loaded is discarded.
+
+    Arguments:
+        db (Database): The database holding the program.
+        path (str): The log file. The snapshot is stored next to it with a
+                    .snapshot suffix.
+        stdout_func (callable): Receives program output instead of stdout.
+        commit_every (int): fsync the log after this many lines.
+        commit_interval_ms (int): fsync the log after this many milliseconds.
+        compact_lines (int): Compact at the first commit after this many
+                             lines. None to disable.
+        compact_ms (int): Compact at the first commit after this many
+                          milliseconds. None to disable.
+        sweep_every (int): Sweep memory after this many lines.
+        program_id (int): The program to run.
+
+    """
+
+    def __init__(self, db, path, stdout_func=None, commit_every=100,
+                 commit_interval_ms=None, compact_lines=100000,
+                 compact_ms=None, sweep_every=10000,
+                 program_id=default_program_id):
+        self.path = path
+        self.snapshot_path = path + '.snapshot'
+
+        self.compact_lines = compact_lines
+        self.compact_ms = compact_ms
+
+        self.__file = None
+        self.__pending = []
+
+        # Encoded records waiting for the next commit.
+        self.__records = []
+
+        self.__lines = 0
+        self.__last_compact = time.monotonic()
+
+        # The sequence number of the last record applied.
+        self.__seq = 0
+
+        # Identifies the loaded program so state from a previous program
+        # isn't replayed against it.
+        self.__program = [program_id, program_version(db, program_id)]
+
+        super().__init__(db, stdout_func=stdout_func,
+                         commit_every=commit_every,
+                         commit_interval_ms=commit_interval_ms,
+                         sweep_every=sweep_every, program_id=program_id)
+
+
+    def mutate(self, op, *args):
+        super().mutate(op, *args)
+
+        self.__pending.append([op] + list(args))
+
+
+    def restore(self):
+        """
+        Rebuild the state from the snapshot and the log.
+
+        """
+
+        snapshot = None
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as f:
+                snapshot = json.loads(f.read().decode('utf-8'))
+
+            if snapshot['program'] != self.__program:
+                snapshot = None
+
+        if snapshot is not None:
+            self.state.load(snapshot['tables'])
+            self.__seq = snapshot['seq']
+
+        if not self.replay():
+            self.rewrite_log()
+
+        self.__file = open(self.path, 'ab')
+
+        # The log may contain IDs from blocks which were reserved but never
+        # committed to the database.
+        self.db.skip_ids(self.state.max_id())
+        self.db.commit()
+
+
+    def replay(self):
+        """
+        Apply the records in the log which are newer than the snapshot.
+
+        Returns:
+            False if there is no usable log for the loaded program.
+
+        """
+
+        if not os.path.exists(self.path):
+            return False
+
+        with open(self.path, 'rb') as f:
+            header = f.readline()
+
+            try:
+                if json.loads(header.decode('utf-8'))['program'] != \
+                   self.__program:
+                    return False
+            except ValueError:
+                return False
+
+            good = f.tell()
+
+            for line in f:
+                try:
+                    seq, changes = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    # A torn write at the end of the log. Everything before
+                    # it is intact.
+                    break
+
+                good += len(line)
+
+                # Records already included in the snapshot.
+                if seq <= self.__seq:
+                    continue
+
+                for change in changes:
+                    self.state.apply(*change)
+
+                self.__seq = seq
+
+        # Drop any partial record so new records aren't appended after it.
+        with open(self.path, 'r+b') as f:
+            f.truncate(good)
+
+        return True
+
+
+    def rewrite_log(self):
+        """
+        Replace the log with an empty one starting after the current record.
+
+        """
+
+        if self.__file is not None:
+            self.__file.close()
+
+        with open(self.path, 'wb') as f:
+            f.write(json.dumps({
+                'program': self.__program,
+                'seq': self.__seq,
+            }).encode('utf-8') + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.__file = open(self.path, 'ab')
+
+
+    def end_record(self):
+        """
+        Make a record of the changes made since the last one, to be written
+        to the log at the next commit.
+
+        """
+
+        if len(self.__pending) == 0:
+            return
+
+        self.__seq += 1
+        self.__records.append(json.dumps([self.__seq, self.__pending])
+                              .encode('utf-8') + b'\n')
+
+        self.__pending = []
+
+
+    def commit(self):
+        """
+        Write the records of the lines run since the last commit to the log
+        and make them durable.
+
+        """
+
+        self.end_record()
+
+        # Commit any ID blocks reserved in the database before the records
+        # using them become durable.
+        self.db.commit()
+
+        if len(self.__records) > 0:
+            self.__file.write(b''.join(self.__records))
+            self.__records = []
+
+            self.__file.flush()
+            os.fsync(self.__file.fileno())
+
+        if (self.compact_lines is not None and
+            self.__lines >= self.compact_lines) or \
+           (self.compact_ms is not None and
+            (time.monotonic() - self.__last_compact) * 1000 >=
+            self.compact_ms):
+            self.compact()
+
+
+    def rollback(self):
+        # Discard the records of the lines run since the last commit, which
+        # never reached the log, and go back to the state as of the commit.
+        self.__pending = []
+        self.__records = []
+        self.__file.close()
+        self.__file = None
+
+        self.__seq = 0
+        self.output = []
+        self.state = MemoryState()
+        self.restore()
+
+
+    def compact(self):
+        """
+        Compact the log by writing the whole state to the snapshot file. Only
+        called at a commit, so the snapshot holds committed lines only.
+
+        """
+
+        temp_path = self.snapshot_path + '.tmp'
+
+        with open(temp_path, 'wb') as f:
+            f.write(json.dumps({
+                'program': self.__program,
+                'seq': self.__seq,
+                'tables': self.state.dump(),
+            }).encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(temp_path, self.snapshot_path)
+
+        # Make sure the rename is durable before throwing away the log.
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.path)),
+                         os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+        self.rewrite_log()
+
+        self.__lines = 0
+        self.__last_compact = time.monotonic()
+
+
+    def end_line(self):
+        self.end_record()
+
+        self.__lines += 1
+
+        super().end_line()
@@ -0,0 +1,232 @@
+"""
+Forks a program: copies its code and its state into a new program (see
+glacia.program), which carries on from the same point independently of the
+original. A program can be run until its setup is done and then forked any
+number of times, for example as jobs (see glacia.jobs), without running the
+setup again.
+
+The copy is made by the database with one insert ... select per table, so
+forking costs a fixed number of queries however large the program is. The
+program's rows are given new IDs from a block reserved for the fork, in the
+same order and with no gaps, so a fork uses one ID per row copied however
+the original's IDs are spread out. The old and new IDs are listed in the
+fork_ids table while the copy is made (in one batch of inserts), so the
+references between rows (frames, locals, list items, references and
+generators in memory) still hold in the copy.
+
+A fork is a full copy, so it costs time and space in proportion to the
+program's state: nothing is shared with the original, not even memory the
+fork never writes to. Addresses belong to a program (reference counts, the
+free list and sweeps are all per program), so sharing them copy-on-write
+would mean checking on every write, in every engine, whether another
+program can see the address. Forks are of whole programs, as the threads of
+a program share memory.
+"""
+
+import json
+
+from glacia import in_lists
+from glacia.program import create_program
+
+
+# Lists the IDs of a program's rows, taking the program's ID six times as its
+# parameters.
+program_ids = ("select id from functions where program_id = %s " +
+               "union all " +
+               "select instructions.id from instructions " +
+                "join functions on functions.id = instructions.function_id " +
+                "where functions.program_id = %s " +
+               "union all " +
+               "select id from threads where program_id = %s " +
+               "union all " +
+               "select calls.id from calls " +
+                "join threads on threads.id = calls.thread_id " +
+                "where threads.program_id = %s " +
+               "union all " +
+               "select id from addresses where program_id = %s " +
+               "union all " +
+               "select locals.id from locals " +
+                "join calls on calls.id = locals.call_id " +
+                "join threads on threads.id = calls.thread_id " +
+                "where threads.program_id = %s")
+
+
+def forked(*columns):
+    """
+    Build the joins looking up the new IDs given to a fork's rows.
+
+    Arguments:
+        columns: (alias, column) tuples. The new ID of each column is
+                 selected as alias.new_id. Each join takes the new program's
+                 ID as a parameter.
+
+    """
+
+    return ''.join("left join fork_ids as " + alias + " on " +
+                   alias + ".program_id = %s and " +
+                   alias + ".old_id = " + column + " "
+                   for alias, column in columns)
+
+
+def fork(db, program_id, name, status='loaded'):
+    """
+    Copy a program and its state into a new program, and commit.
+
+    The state copied is the state last committed, which is always at the end
+    of a line, so a program can be forked while it runs.
+
+    Arguments:
+        db (Database): The database holding the program.
+        program_id (int): The program to fork.
+        name (str): A name for the new program, unique in the database.
+        status (str): 'loaded' to run the fork directly, or 'queued' to run it
+                      as a job (see glacia.program.create_program()).
+
+    Returns:
+        The new program's ID.
+
+    """
+
+    version, free_head = db.row("select version, free_head from programs " +
+                                "where id = %s;",
+                                (program_id,))
+
+    new_id = create_program(db, name, status=status)
+
+    # The new IDs are numbered here rather than with row_number(), which
+    # MySQL only has from 8.0.
+    old_ids = [row_id for row_id, in db.rows(
+        "select id from (" + program_ids + ") as ids order by id;",
+        (program_id,) * 6)]
+
+    if len(old_ids) > 0:
+        first_id = db.reserve_ids(len(old_ids))
+
+        db.many("insert into fork_ids (program_id, old_id, new_id) " +
+                "values (%s, %s, %s);",
+                [(new_id, old_id, first_id + i)
+                 for i, old_id in enumerate(old_ids)])
+
+    db.foreign_key_checks(False)
+
+    db.cmd("insert into functions " +
+           "(id, program_id, label, return_type, arguments, code_hash) " +
+           "select f.new_id, %s, label, return_type, arguments, code_hash " +
+           "from functions " +
+           forked(('f', 'functions.id')) +
+           "where functions.program_id = %s;",
+           (new_id, new_id, program_id))
+
+    db.cmd("insert into instructions " +
+           "(id, function_id, parent_id, previous_id, code, label, " +
+           "successor_id, exits, loops) " +
+           "select i.new_id, f.new_id, parent.new_id, previous.new_id, " +
+           "instructions.code, instructions.label, successor.new_id, " +
+           "instructions.exits, instructions.loops from instructions " +
+           "join functions on functions.id = instructions.function_id " +
+           forked(('i', 'instructions.id'),
+                  ('f', 'instructions.function_id'),
+                  ('parent', 'instructions.parent_id'),
+                  ('previous', 'instructions.previous_id'),
+                  ('successor', 'instructions.successor_id')) +
+           "where functions.program_id = %s;",
+           (new_id,) * 5 + (program_id,))
+
+    db.cmd("insert into threads (id, program_id) " +
+           "select t.new_id, %s from threads " +
+           forked(('t', 'threads.id')) +
+           "where threads.program_id = %s;",
+           (new_id, new_id, program_id))
+
+    db.cmd("insert into calls " +
+           "(id, thread_id, depth, instruction_id, calling_instruction_id) " +
+           "select c.new_id, t.new_id, calls.depth, i.new_id, caller.new_id " +
+           "from calls join threads on threads.id = calls.thread_id " +
+           forked(('c', 'calls.id'),
+                  ('t', 'calls.thread_id'),
+                  ('i', 'calls.instruction_id'),
+                  ('caller', 'calls.calling_instruction_id')) +
+           "where threads.program_id = %s;",
+           (new_id,) * 4 + (program_id,))
+
+    db.cmd("insert into conditionals (call_id, depth, satisfied) " +
+           "select c.new_id, conditionals.depth, conditionals.satisfied " +
+           "from conditionals " +
+           "join calls on calls.id = conditionals.call_id " +
+           "join threads on threads.id = calls.thread_id " +
+           forked(('c', 'conditionals.call_id')) +
+           "where threads.program_id = %s;",
+           (new_id, program_id))
+
+    # References and generators hold the ID of an address or call stack
+    # frame as their value, stored as text like every other value.
+    db.cmd("insert into addresses " +
+           "(id, type, val, refs, owner_call_id, next_free_id, program_id) " +
+           "select a.new_id, type, " +
+           "case when type in ('ref', 'generator') " +
+           "then cast(v.new_id as char) else val end, " +
+           "refs, owner.new_id, next_free.new_id, %s from addresses " +
+           forked(('a', 'addresses.id'),
+                  ('v', "case when type in ('ref', 'generator') " +
+                        "then cast(val as signed) end"),
+                  ('owner', 'addresses.owner_call_id'),
+                  ('next_free', 'addresses.next_free_id')) +
+           "where addresses.program_id = %s;",
+           (new_id,) * 5 + (program_id,))
+
+    db.cmd("insert into locals (id, call_id, label, address_id) " +
+           "select l.new_id, c.new_id, locals.label, a.new_id from locals " +
+           "join calls on calls.id = locals.call_id " +
+           "join threads on threads.id = calls.thread_id " +
+           forked(('l', 'locals.id'),
+                  ('c', 'locals.call_id'),
+                  ('a', 'locals.address_id')) +
+           "where threads.program_id = %s;",
+           (new_id,) * 3 + (program_id,))
+
+    db.cmd("insert into items (list_id, ordinal, address_id) " +
+           "select l.new_id, items.ordinal, a.new_id " +
+           "from items join addresses on addresses.id = items.list_id " +
+           forked(('l', 'items.list_id'),
+                  ('a', 'items.address_id')) +
+           "where addresses.program_id = %s;",
+           (new_id,) * 2 + (program_id,))
+
+    # The loops column is JSON naming the loops a break or continue leaves.
+    # Only break and continue instructions have it, so there are few.
+    loops = db.rows("select instructions.id, instructions.loops " +
+                    "from instructions join functions " +
+                    "on functions.id = instructions.function_id " +
+                    "where functions.program_id = %s and " +
+                    "instructions.loops is not null;",
+                    (new_id,))
+
+    loop_ids = {loop_id for inst_id, inst_loops in loops
+                for loop_id, exits in json.loads(inst_loops)}
+
+    if len(loop_ids) > 0:
+        new_ids = dict(row for placeholders, chunk in in_lists(loop_ids)
+                       for row in db.rows(
+                           "select old_id, new_id from fork_ids " +
+                           "where program_id = %s and old_id in (" +
+                           placeholders + ");",
+                           [new_id] + chunk))
+
+        db.many("update instructions set loops = %s where id = %s;",
+                [(json.dumps([[new_ids[loop_id], exits] for loop_id, exits
+                              in json.loads(inst_loops)]), inst_id)
+                 for inst_id, inst_loops in loops])
+
+    db.foreign_key_checks(True)
+
+    db.cmd("update programs set version = %s, free_head = coalesce(" +
+           "(select new_id from fork_ids " +
+           "where program_id = %s and old_id = %s), 0) " +
+           "where id = %s;",
+           (version, new_id, free_head, new_id))
+
+    db.cmd("delete from fork_ids where program_id = %s;", (new_id,))
+
+    db.commit()
+
+    return new_id
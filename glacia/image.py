@@ -0,0 +1,98 @@
+import os
+import json
+import hashlib
+
+from glacia import __version__
+
+
+# Bumped whenever the image format changes independently of the compiler.
+image_format = 1
+
+
+def source_hash(src):
+    """
+    Hash source code together with the compiler version, so compiled output
+    is never reused by a different compiler.
+
+    """
+
+    return hashlib.sha256((__version__ + '\0' + src).encode('utf-8')) \
+                  .hexdigest()
+
+
+def cache_path(cache_dir, src):
+    """
+    Get the compile cache file for some source code.
+
+    """
+
+    return os.path.join(cache_dir, source_hash(src) + '.dbil')
+
+
+def default_cache_dir():
+    """
+    The compile cache directory used unless another one is given:
+    $GLACIA_CACHE_DIR, falling back to ~/.cache/glacia.
+
+    """
+
+    return os.environ.get('GLACIA_CACHE_DIR',
+                          os.path.join(os.path.expanduser('~'), '.cache',
+                                       'glacia'))
+
+
+def write_image(path, generated):
+    """
+    Write compiled DBIL to an image file. The file is written to a temporary
+    name first and renamed, so a reader never sees a partial image.
+
+    Arguments:
+        path (str): The image file to write.
+        generated (list): DBIL code in dict format.
+
+    """
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+
+    temp_path = path + '.' + str(os.getpid()) + '.tmp'
+
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(json.dumps({
+                'format': image_format,
+                'version': __version__,
+                'functions': generated,
+            }).encode('utf-8'))
+
+        os.replace(temp_path, path)
+    except:
+        # Don't leave a partial image behind, e.g. when the disk is full.
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+
+def read_image(path):
+    """
+    Read compiled DBIL from an image file written by write_image().
+
+    Returns:
+        DBIL code in dict format.
+
+    Raises:
+        ValueError if the image is unreadable or from another compiler
+        version.
+
+    """
+
+    with open(path, 'rb') as f:
+        image = json.loads(f.read().decode('utf-8'))
+
+    if not isinstance(image, dict) or \
+       image.get('format') != image_format or \
+       image.get('version') != __version__:
+        raise ValueError('Image ' + path + ' was not compiled by glacia ' +
+                         __version__ + '.')
+
+    return image['functions']
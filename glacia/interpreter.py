@@ -1,20 +1,147 @@
-import json
+import sys
+import time
 from random import randint
 from math import ceil, floor
 
+from glacia import in_lists
+from glacia.program import program_cache, default_program_id
+
 
 loop_keywords = ['while', 'foreach', 'for']
 
 
+# The type of addresses which have been freed and can be reused (see
+# Interpreter.mem_alloc()).
+free_type = 'free'
+
+
+# Columns read by the frequently-run queries below. These queries fetch rows
+# as tuples and convert them to dicts with row_dict(), which is cheaper than
+# having the driver build a dict for every row.
+call_columns = ('id', 'thread_id', 'depth', 'instruction_id',
+                'calling_instruction_id', 'version')
+address_columns = ('id', 'type', 'val', 'refs', 'owner_call_id', 'version')
+local_columns = ('id', 'call_id', 'label', 'address_id')
+item_columns = ('list_id', 'ordinal', 'address_id')
+
+
+def row_dict(columns, row):
+    return None if row is None else dict(zip(columns, row))
+
+
+class ConflictError(Exception):
+    """
+    Raised when a row read by the current line was changed by another
+    interpreter before the line could write to it (see
+    Interpreter.versioned()). The line is rolled back and run again.
+
+    """
+    pass
+
+
 def interpret(db, stdout_func=None):
     Interpreter(db, stdout_func=stdout_func).run()
 
 
 class Interpreter(object):
-
-    def __init__(self, db, stdout_func=None):
+    """
+    Runs a program stored in the database.
+
+    Arguments:
+        db (Database): The database holding the program and its state.
+        stdout_func (callable): Receives program output instead of stdout.
+        commit_every (int): Commit after this many lines. None to only commit
+                            on a time basis (see commit_interval_ms).
+        commit_interval_ms (int): Commit once this many milliseconds have
+                                  passed since the last commit. None to only
+                                  commit on a line count basis.
+        sweep_every (int): Run a full mark-and-sweep of memory after this many
+                           lines (see sweep()). None to never sweep.
+        program_id (int): The program to run, when the database holds more
+                          than one (see glacia.program.create_program()).
+
+    Commits only ever happen between lines, so a resumed program always
+    continues from the line after the last commit. Batching many lines into
+    one commit trades the number of lines which may need to be rerun after a
+    crash for fewer (expensive) syncs to disk.
+
+    Freed addresses are reused rather than deleted (see mem_alloc()). Free
+    addresses are reserved from the database's free list free_block_size at
+    a time.
+
+    Several interpreters can run the same program at once. Threads, calls
+    and addresses have a version which every write bumps. A line first
+    claims its thread (see claim_thread()), and writes to calls and
+    addresses the line has read only apply if their version is unchanged.
+    If another interpreter got there first, the line is rolled back and run
+    again from the state it left (conflicts counts how often).
+
+    """
+
+    free_block_size = 100
+
+    def __init__(self, db, stdout_func=None, commit_every=1,
+                 commit_interval_ms=None, sweep_every=10000,
+                 program_id=default_program_id):
         self.db = db
         self.stdout_func = stdout_func
+        self.program_id = program_id
+
+        self.commit_every = commit_every
+        self.commit_interval_ms = commit_interval_ms
+        self.sweep_every = sweep_every
+
+        self.__lines = 0
+        self.__last_commit = time.monotonic()
+        self.__sweep_lines = 0
+
+        # The thread which ran the last line (see next_thread()).
+        self.__thread_id = None
+
+        # Addresses whose reference count may have dropped to zero during the
+        # current line (see gc()).
+        self.garbage = set()
+
+        # Free addresses this interpreter can reuse, and whether the free list
+        # in the database may have more. Addresses freed by the current line
+        # wait in released until the line has ended, as the line may still
+        # read them.
+        self.free_addresses = []
+        self.free_list_empty = False
+        self.released = []
+
+        # The versions of the rows read by the current line, by (table, id),
+        # and of the threads this interpreter has claimed (see versioned()
+        # and claim_thread()).
+        self.versions = {}
+        self.thread_versions = {}
+        self.conflicts = 0
+
+        # Output printed since the last commit. It is only written out once
+        # committed, as the lines printing it may be rolled back and run
+        # again.
+        self.output = []
+
+        # The temporary locals holding the lists built by the current
+        # instruction (see call()), deleted once it has been evaluated.
+        self.temp_locals = []
+
+        self.__program = None
+
+
+    def program(self):
+        """
+        Get the cached functions and instructions of the loaded program.
+
+        Returns:
+            A ProgramCache.
+
+        """
+
+        if self.__program is None:
+            self.__program = program_cache(self.db, self.program_id)
+
+        return self.__program
 
 
     def start(self):
@@ -27,29 +154,90 @@ class Interpreter(object):
 
         """
 
-        thread_id = self.db.autoid("insert into threads (id) values ({$id});")
+        thread_id = self.create_thread()
 
         self.call(thread_id, {'tokens': [{'val': 'main'}]}, [])
 
-        self.db.commit()
+        self.flush()
 
         return thread_id
 
 
+    def commit(self):
+        """
+        Make all state changes made so far durable.
+
+        """
+
+        self.db.commit()
+
+
+    def rollback(self):
+        """
+        Discard all state changes made since the last commit.
+
+        """
+
+        self.db.rollback()
+
+        self.garbage = set()
+
+        # Frees and reservations made since the last commit are undone.
+        self.free_addresses = []
+        self.free_list_empty = False
+        self.released = []
+
+        # So are version bumps.
+        self.versions = {}
+        self.thread_versions = {}
+
+        self.output = []
+
+
+    def flush(self):
+        """
+        Commit now, regardless of the commit settings, and write out the
+        output of the lines committed.
+
+        """
+
+        self.commit()
+
+        output = self.output
+        self.output = []
+
+        if callable(self.stdout_func):
+            for out in output:
+                self.stdout_func(out)
+
+        # In one write, so lines printed by worker processes sharing stdout
+        # stay whole even when it is unbuffered.
+        elif len(output) > 0:
+            sys.stdout.write(''.join(out + '\n' for out in output))
+
+        self.__lines = 0
+        self.__last_commit = time.monotonic()
+
+
     def run(self, thread_id=None):
         """
         Run the loaded program to completion.
 
-        """
+        Arguments:
+            thread_id (str): The thread to run. If None, all threads are run
+                             until none are left running.
 
-        if thread_id is None:
-            thread_id = self.get_main_thread_id()
+        """
 
         try:
             while self.run_one_line(thread_id=thread_id):
                 pass
-        finally:
-            self.db.commit()
+        except:
+            # Don't commit a partially-run line.
+            self.rollback()
+            raise
+
+        self.flush()
 
 
     def run_one_line(self, thread_id=None):
@@ -57,8 +245,8 @@ class Interpreter(object):
         Run one line of the loaded program.
 
         Arguments:
-            thread_id (str): The thread to run. If None, the main thread will
-                             be used.
+            thread_id (str): The thread to run. If None, the running threads
+                             take turns a line at a time (see next_thread()).
 
         Returns:
             True if there are more lines to be run, False if the program has
@@ -67,22 +255,192 @@ class Interpreter(object):
         """
 
         if thread_id is None:
-            thread_id = self.get_main_thread_id()
+            thread_id = self.next_thread()
+
+        self.versions = {}
+
+        try:
+            if thread_id is not None:
+                self.claim_thread(thread_id)
+
+            ret = self.exec(thread_id)
+        except ConflictError:
+            # Start again from the last commit, which will now read what the
+            # other interpreter wrote.
+            self.rollback()
+            self.conflicts += 1
+            return True
 
-        ret = self.exec(thread_id)
         self.gc()
-        self.db.commit()
+
+        # Nothing can read the addresses freed by the line any more.
+        self.free_addresses.extend(self.released)
+        self.released = []
+
+        self.__sweep_lines += 1
+
+        if self.sweep_every is not None and \
+           self.__sweep_lines >= self.sweep_every:
+            self.sweep()
+            self.__sweep_lines = 0
+
+        self.end_line()
 
         return ret
 
 
+    def end_line(self):
+        """
+        Called after each line has been run. Commits if enough lines or time
+        have passed since the last commit.
+
+        """
+
+        self.__lines += 1
+
+        if (self.commit_every is not None and
+            self.__lines >= self.commit_every) or \
+           (self.commit_interval_ms is not None and
+            (time.monotonic() - self.__last_commit) * 1000 >=
+            self.commit_interval_ms):
+            self.flush()
+
+
+    def claim_thread(self, thread_id):
+        """
+        Bump a thread's version before running a line of it. Until the line
+        is committed, this also keeps other interpreters from running the
+        thread (by row lock, or the write lock in SQLite).
+
+        Raises:
+            ConflictError: Another interpreter has run a line of the thread
+                           since this one last did.
+
+        """
+
+        expected = self.thread_versions.pop(thread_id, None)
+
+        if expected is None:
+            expected = self.db.scalar("select version from threads " +
+                                      "where id = %s;",
+                                      (thread_id,))
+
+        if self.db.cmd("update threads set version = version + 1 " +
+                       "where id = %s and version = %s;",
+                       (thread_id, expected)) == 0:
+            raise ConflictError('Thread ' + str(thread_id) +
+                                ' was run by another interpreter.')
+
+        self.thread_versions[thread_id] = expected + 1
+
+
+    def seen(self, table, row):
+        """
+        Record the version of a row read by the current line, so writes to it
+        can be checked (see versioned()).
+
+        Returns:
+            The row.
+
+        """
+
+        if row is not None:
+            self.versions[(table, row['id'])] = row['version']
+
+        return row
+
+
+    def versioned(self, query, table, row_id, args=()):
+        """
+        Run an update or delete of one row of a versioned table (calls or
+        addresses). If the current line read the row, the query only applies
+        if nobody else has changed the row since.
+
+        Arguments:
+            query (str): The query, ending with "where id = %s" and without a
+                         semicolon. Updates should bump the version.
+            table (str): The table.
+            row_id (int): The row.
+            args (tuple): Arguments for the query before the row ID.
+
+        Raises:
+            ConflictError: The row was changed by another interpreter.
+
+        """
+
+        key = (table, row_id)
+        expected = self.versions.get(key)
+        args = tuple(args) + (row_id,)
+
+        if expected is None:
+            self.db.cmd(query + ";", args)
+            return
+
+        if self.db.cmd(query + " and version = %s;", args + (expected,)) == 0:
+            raise ConflictError(table + ' row ' + str(row_id) +
+                                ' was changed by another interpreter.')
+
+        self.versions[key] = expected + 1
+
+
     def get_main_thread_id(self):
         """
         Get the main thread ID.
 
         """
 
-        return self.db.scalar("select id from threads limit 1;")
+        return self.db.scalar("select min(id) from threads " +
+                              "where program_id = %s;",
+                              (self.program_id,))
+
+
+    def next_thread(self):
+        """
+        Pick the thread to run the next line in, going round robin through
+        the running threads.
+
+        Returns:
+            The thread ID, or None if no thread is running.
+
+        """
+
+        self.__thread_id = self.running_thread(self.__thread_id)
+
+        return self.__thread_id
+
+
+    def running_thread(self, after=None):
+        """
+        Get the first running thread (one with a frame on its call stack)
+        after the given thread, wrapping around to the first running thread.
+
+        Returns:
+            The thread ID, or None if no thread is running.
+
+        """
+
+        running = ("select min(calls.thread_id) from calls " +
+                   "join threads on threads.id = calls.thread_id " +
+                   "where threads.program_id = %s and calls.depth is not null")
+
+        return self.db.scalar(
+            "select coalesce((" + running + " and calls.thread_id > %s), (" +
+            running + "));",
+            (self.program_id, after or 0, self.program_id))
+
+
+    def create_thread(self):
+        """
+        Create a new thread with an empty call stack.
+
+        Returns:
+            The new thread ID.
+
+        """
+
+        return self.db.autoid("insert into threads (id, program_id) " +
+                              "values (%s, %s);",
+                              (self.program_id,))
 
 
     def call(self, thread_id, binding, arguments, caller_id=None):
@@ -124,13 +482,16 @@ class Interpreter(object):
                     },
                 }))
 
-        # Helper function for generating inline lists.
+        # Helper function for generating inline lists. The list is held by a
+        # temporary local until the instruction has assigned it somewhere
+        # (see eval_assignment()).
         def ret_list(items):
             list_ident = {
                 'label': self.generate_local_label(current_call, '__temp{$r}')
             }
 
             self.create_local(current_call['id'],list_ident['label'],'list',0)
+            self.temp_locals.append((current_call['id'], list_ident['label']))
 
             for item in items:
                 self.list_push(current_call, list_ident, item)
@@ -153,10 +514,7 @@ class Interpreter(object):
             else:
                 out = str(arg['val'])
 
-            if callable(self.stdout_func):
-                self.stdout_func(out)
-            else:
-                print(out)
+            self.output.append(out)
 
             return None
 
@@ -205,6 +563,14 @@ class Interpreter(object):
             return ret_list([{'type': 'int', 'val': r}
                              for r in range(rng_start, rng_stop, rng_step)])
 
+        elif func_name == 'spawn':
+            return {
+                'type': 'int',
+                'val': self.spawn(
+                    self.eval_expression_token(current_call, evaled[0]),
+                    evaled[1:]),
+            }
+
         elif func_name == 'ceiling':
             return {
                 'type': 'int',
@@ -217,33 +583,21 @@ class Interpreter(object):
                 'val': floor(self.eval_expression_token(current_call,evaled[0]))
             }
 
-        # Look up the function in the database
-        function = self.db.first("select * from functions where label = %s;",
-                                 (func_name,))
-        function['arguments'] = json.loads(function['arguments'])
+        # Look up the function
+        function = self.program().function(func_name)
 
         # Find the first instruction in the function
-        inst_id = self.db.scalar("select id from instructions " +
-                                 "where function_id = %s and " +
-                                 "parent_id is null and previous_id is null;",
-                                 (function['id'],))
+        inst_id = self.program().entry(function['id'])['id']
 
         if function['return_type'] == 'generator':
             depth = None
         else:
             # Get the size of the call stack
-            depth = self.db.scalar("select max(depth) + 1 from calls " +
-                                   "where thread_id = %s",
-                                   (thread_id,))
-
-            if depth is None:
-                depth = 0
+            depth = self.stack_depth(thread_id)
+            depth = 0 if depth is None else depth + 1
 
         # Push this call onto the call stack
-        call_id = self.db.autoid("insert into calls (id, thread_id, depth, " +
-                                 "instruction_id, calling_instruction_id) " +
-                                 "values ({$id}, %s, %s, %s, %s);",
-                                 (thread_id, depth, inst_id, caller_id))
+        call_id = self.push_call(thread_id, depth, inst_id, caller_id)
 
         # Validate argument count
         if len(arguments) != len(function['arguments']):
@@ -286,6 +640,40 @@ class Interpreter(object):
             }
 
 
+    def spawn(self, func_name, arguments):
+        """
+        Start a new thread calling a function. The thread runs alongside the
+        others and stops when the function returns; its return value is
+        discarded.
+
+        Arguments:
+            func_name (str): The function to call.
+            arguments (list): The evaluated arguments to pass. Lists are
+                              passed by reference as usual, and are then
+                              shared between the threads.
+
+        Returns:
+            The new thread ID.
+
+        """
+
+        # The new thread has no frame to look locals up in, so pass their
+        # values, keeping the address for lists to be passed by reference.
+        values = []
+
+        for arg in arguments:
+            if 'address_id' in arg:
+                arg = dict(self.resolve(arg), address_id=arg['address_id'])
+
+            values.append(arg)
+
+        thread_id = self.create_thread()
+
+        self.call(thread_id, {'tokens': [{'val': func_name}]}, values)
+
+        return thread_id
+
+
     def resolve(self, local):
         """
         Looks up the value of a local, resolving references automatically.
@@ -312,13 +700,9 @@ class Interpreter(object):
         mem = self.mem_read(generator['address_id'])
         generator_call = self.get_call(mem['val'])
 
-        depth = self.db.scalar("select max(depth) from calls " +
-                               "where thread_id = %s;",
-                               (generator_call['thread_id'],))
+        depth = self.stack_depth(generator_call['thread_id'])
 
-        self.db.cmd("update calls set depth = %s, calling_instruction_id = %s "+
-                    "where id = %s;",
-                    (depth + 1, caller_id, generator_call['id']))
+        self.restore_call(generator_call['id'], depth + 1, caller_id)
 
 
     def generator_finished(self, call, generator):
@@ -337,86 +721,144 @@ class Interpreter(object):
         }
 
 
-    def set_call_instruction(self, call_id, instruction_id):
-        self.db.cmd("update calls set instruction_id = %s where id = %s;",
-                    (instruction_id, call_id,))
+    def stack_depth(self, thread_id):
+        """
+        Get the depth of the frame on top of a thread's call stack.
 
+        Returns:
+            The depth, or None if the call stack is empty.
 
-    def step_over(self, instruction_id):
         """
-        Look up the next instruction without changing hierarchical depth.
 
+        return self.db.scalar("select max(depth) from calls " +
+                              "where thread_id = %s;",
+                              (thread_id,))
+
+
+    def push_call(self, thread_id, depth, instruction_id, caller_id):
         """
-        ret = self.db.first("select * from instructions where previous_id=%s;",
-                            (instruction_id,))
+        Create a call stack frame.
 
-        if ret is not None:
-            ret['code'] = json.loads(ret['code'])
+        Arguments:
+            thread_id (str): The thread to create the frame in.
+            depth (int): The depth of the frame, or None for a frame which is
+                         not on the stack (a generator).
+            instruction_id (str): The first instruction to execute.
+            caller_id (str): The instruction which made the call.
 
-        return ret
+        Returns:
+            The new call ID.
 
+        """
 
-    def step_into(self, instruction_id):
+        return self.db.autoid("insert into calls (id, thread_id, depth, " +
+                              "instruction_id, calling_instruction_id) " +
+                              "values (%s, %s, %s, %s, %s);",
+                              (thread_id, depth, instruction_id, caller_id))
+
+
+    def restore_call(self, call_id, depth, caller_id):
         """
-        Look up the first instruction inside an instruction block.
+        Put a stashed (generator) frame back on top of the call stack.
 
         """
-        return self.db.first("select * from instructions where parent_id = %s "+
-                             "and previous_id is null;",
-                             (instruction_id,))
 
+        self.versioned("update calls set depth = %s, " +
+                       "calling_instruction_id = %s, version = version + 1 " +
+                       "where id = %s",
+                       'calls', call_id, (depth, caller_id))
 
-    def step_out(self, instruction_id):
+
+    def stash_call(self, call_id):
         """
-        Look up the next instruction outside the current block.
+        Take a frame off the call stack without deleting it (yield).
 
         """
-        ret = self.db.first("select * from instructions where previous_id = ("+
-                            "select parent_id from instructions " +
-                            "where id = %s);",
-                            (instruction_id,))
 
-        if ret is not None:
-            ret['code'] = json.loads(ret['code'])
+        self.versioned("update calls set depth = null, " +
+                       "version = version + 1 where id = %s",
+                       'calls', call_id)
 
-        return ret
 
-
-    def step_out_greedy(self, call, inst):
+    def delete_call(self, call_id):
         """
-        Step out of the given instruction to the next executable line, taking
-        conditionals and loops into account.
+        Delete a call stack frame along with its locals and conditionals, and
+        free the memory owned by the frame (see mem_alloc()).
 
         """
 
-        self.exit_conditional(call, inst)
+        # The locals and list items going away which point to addresses the
+        # frame doesn't own. Those addresses lose a reference. Everything the
+        # frame owns is only reachable from the frame and is freed with it.
+        addrs = self.db.rows(
+            "select locals.address_id from locals " +
+            "join addresses on addresses.id = locals.address_id " +
+            "where locals.call_id = %s and " +
+            "(addresses.owner_call_id is null or " +
+             "addresses.owner_call_id <> %s) " +
+            "union all " +
+            "select items.address_id from items " +
+            "join addresses l on l.id = items.list_id " +
+            "join addresses a on a.id = items.address_id " +
+            "where l.owner_call_id = %s and " +
+            "(a.owner_call_id is null or a.owner_call_id <> %s);",
+            (call_id, call_id, call_id, call_id))
+
+        owned = [addr for addr, in self.db.rows(
+            "select id from addresses where owner_call_id = %s and " +
+            "(type is null or type <> %s);",
+            (call_id, free_type))]
+
+        self.versioned("delete from calls where id = %s", 'calls', call_id)
 
-        for parent in self.step_up(call, inst):
-            # If the next level above this one is a loop, then loop.
-            if parent['code']['kind'] in loop_keywords:
-                return parent
+        # A return deletes its frame before the instruction pointer moves on,
+        # which tries to delete it again.
+        self.versions.pop(('calls', call_id), None)
 
-            self.exit_conditional(parent, inst)
+        if len(owned) > 0:
+            self.release_addresses(owned)
 
-            # If the parent is not a loop, find the next line after it.
-            next_inst = self.step_over(parent['id'])
+        for addr, in addrs:
+            self.add_refs(addr, -1)
 
-            if next_inst is not None:
-                return next_inst
+
+    def set_call_instruction(self, call_id, instruction_id):
+        self.versioned("update calls set instruction_id = %s, " +
+                       "version = version + 1 where id = %s",
+                       'calls', call_id, (instruction_id,))
+
+
+    def step_over(self, instruction_id):
+        """
+        Look up the next instruction without changing hierarchical depth.
+
+        """
+        return self.program().step_over(instruction_id)
+
+
+    def step_into(self, instruction_id):
+        """
+        Look up the first instruction inside an instruction block.
+
+        """
+        return self.program().step_into(instruction_id)
 
 
     def step_over_or_out_greedy(self, call, inst):
         """
-        Advance the instruction pointer to the next executable instruction.
+        Advance the instruction pointer to the next executable instruction,
+        taking conditionals and loops into account.
+
+        The next instruction and the conditionals exited on the way there are
+        worked out when the program is loaded (see loader.control_flow()).
 
         """
 
-        next_inst = self.step_over(inst['id'])
+        self.exit_conditionals(call, inst['exits'])
 
-        if next_inst is None:
-            next_inst = self.step_out_greedy(call, inst)
-        else:
-            self.exit_conditional(call, inst)
+        next_inst = None
+        if inst['successor_id'] is not None:
+            next_inst = self.get_instruction(inst['successor_id'])
 
         self.call_advance(call, next_inst)
 
@@ -433,11 +875,7 @@ class Interpreter(object):
             The instruction in dict-format.
 
         """
-        id = self.db.scalar("select id from instructions " +
-                            "where function_id = %s and label = %s limit 1;",
-                            (function_id, label,))
-
-        return self.get_instruction(id)
+        return self.program().by_label(function_id, label)
 
 
     def conditional_depth(self, call):
@@ -503,10 +941,12 @@ class Interpreter(object):
         :param thread_id: The thread to look up
         :return: The call stack frame in dict form
         """
-        return self.db.first("select * from calls where thread_id = %s " +
-                             "and depth is not null " +
-                             "order by depth desc limit 1;",
-                             (thread_id,))
+        return self.seen('calls', row_dict(call_columns, self.db.row(
+            "select id, thread_id, depth, instruction_id, " +
+            "calling_instruction_id, version from calls " +
+            "where thread_id = %s and depth is not null " +
+            "order by depth desc limit 1;",
+            (thread_id,))))
 
 
     def parent_call(self, call):
@@ -516,9 +956,11 @@ class Interpreter(object):
         :param call: The base frame in dict form to get the parent of
         :return: The call stack frame in dict format
         """
-        return self.db.first("select * from calls where thread_id = %s " +
-                             "and depth = %s;",
-                             (call['thread_id'], call['depth'] - 1))
+        return self.seen('calls', row_dict(call_columns, self.db.row(
+            "select id, thread_id, depth, instruction_id, " +
+            "calling_instruction_id, version from calls " +
+            "where thread_id = %s and depth = %s;",
+            (call['thread_id'], call['depth'] - 1))))
 
 
     def call_instruction(self, call_id):
@@ -536,7 +978,10 @@ class Interpreter(object):
         Get a call from the database by ID.
 
         """
-        return self.db.first("select * from calls where id = %s;", (call_id,))
+        return self.seen('calls', row_dict(call_columns, self.db.row(
+            "select id, thread_id, depth, instruction_id, " +
+            "calling_instruction_id, version from calls where id = %s;",
+            (call_id,))))
 
 
     def call_delete(self, call):
@@ -545,11 +990,10 @@ class Interpreter(object):
 
         """
         # Make sure the conditional stack is clear before leaving the call.
-        if self.db.scalar("select count(1) from conditionals where call_id=%s;",
-                          (call['id'],)) > 0:
+        if self.conditional_depth(call) >= 0:
             raise Exception("Conditional stack not cleared.")
 
-        self.db.cmd("delete from calls where id = %s;", (call['id'],))
+        self.delete_call(call['id'])
 
 
     def call_advance(self, call, next_inst):
@@ -575,15 +1019,10 @@ class Interpreter(object):
 
     def get_instruction(self, instruction_id):
         """
-        Get an instruction from the database by ID.
+        Get an instruction by ID.
 
         """
-        ret = self.db.first("select * from instructions where id = %s;",
-                            (instruction_id,))
-
-        ret['code'] = json.loads(ret['code'])
-
-        return ret
+        return self.program().instruction(instruction_id)
 
 
     def mem_read(self, addr, ref_resolve=False):
@@ -599,15 +1038,27 @@ class Interpreter(object):
 
         """
 
-        ret = self.db.first("select * from addresses where id = %s;", (addr,))
+        ret = self.fetch_address(addr)
 
         # If it's a reference, resolve it.
         while ret['type'] == 'ref':
-            ret = self.mem_read(ret['val'])
+            ret = self.mem_read(self.type_check(ret)['val'])
 
         return self.type_check(ret)
 
 
+    def fetch_address(self, addr):
+        """
+        Look up a row of virtual database memory without resolving references
+        or converting types.
+
+        """
+
+        return self.seen('addresses', row_dict(address_columns, self.db.row(
+            "select id, type, val, refs, owner_call_id, version " +
+            "from addresses where id = %s;", (addr,))))
+
+
     def mem_write(self, addr, val):
         """
         Write to virtual database memory directly.
@@ -625,32 +1076,227 @@ class Interpreter(object):
         except KeyError:
             pass
 
-        self.db.cmd("update addresses set val = %s, type = %s where id = %s;",
-                    (val['val'], val['type'], addr,))
+        self.store_address(addr, val['type'], val['val'])
 
         return addr
 
 
-    def mem_alloc(self):
+    def store_address(self, addr, type_, val):
+        """
+        Overwrite the type and value of an address of virtual database memory.
+
+        """
+
+        self.versioned("update addresses set val = %s, type = %s, " +
+                       "version = version + 1 where id = %s",
+                       'addresses', addr, (val, type_))
+
+
+    def mem_alloc(self, owner_call_id=None):
         """
         Allocate a new address in virtual database memory.
 
+        Arguments:
+            owner_call_id (int): The call stack frame the address belongs to.
+                                 While it belongs to a frame, an address is
+                                 only reachable from that frame and is freed
+                                 all at once with the frame's other memory
+                                 when the frame is deleted. See escape().
+
         Returns:
             The new memory address in dict format.
 
+        Freed addresses are reused before new ones are inserted, so memory
+        which is repeatedly freed and allocated updates the same rows rather
+        than inserting into and deleting from the addresses table (and its
+        indexes).
+
         """
-        return self.db.autoid("insert into addresses (id) values ({$id});")
 
+        if len(self.free_addresses) == 0 and not self.free_list_empty:
+            self.reserve_free_addresses()
+
+        addr = None
+
+        if len(self.free_addresses) > 0:
+            addr = self.free_addresses.pop()
+
+            # The address may have been taken since it was freed, by another
+            # interpreter which reserved it after a sweep.
+            if self.db.cmd("update addresses set type = null, val = null, " +
+                           "owner_call_id = %s, version = version + 1 " +
+                           "where id = %s and type = %s;",
+                           (owner_call_id, addr, free_type)) > 0:
+                # The address is this line's alone until it is referred to.
+                self.versions.pop(('addresses', addr), None)
+            else:
+                addr = None
+
+        if addr is None:
+            addr = self.db.autoid("insert into addresses " +
+                                  "(id, program_id, owner_call_id) " +
+                                  "values (%s, %s, %s);",
+                                  (self.program_id, owner_call_id))
+
+        # Nothing refers to the address until it is assigned to a local or a
+        # list item, which has to happen before the end of the line.
+        self.garbage.add(addr)
+
+        return addr
+
+
+    def mem_free(self, addrs):
+        """
+        Free addresses of virtual database memory which nothing refers to,
+        along with the items of any lists among them.
+
+        Arguments:
+            addrs (list): The addresses to free.
+
+        """
+
+        items = [row for placeholders, chunk in in_lists(addrs)
+                 for row in self.db.rows("select list_id, address_id " +
+                                         "from items where list_id in (" +
+                                         placeholders + ");",
+                                         chunk)]
+
+        freed = set(self.release_addresses(addrs, unreferenced=True))
 
-    def mem_free(self, addr):
+        for list_id, addr in items:
+            if list_id in freed:
+                self.add_refs(addr, -1)
+
+
+    def release_addresses(self, addrs, unreferenced=False):
         """
-        Free an address of virtual database memory.
+        Mark addresses as free for this interpreter to reuse, deleting the
+        items of any lists among them.
 
         Arguments:
-            addr (str): The address to free.
+            addrs (list): The addresses to release.
+            unreferenced (bool): Whether to leave alone any addresses which
+                                 are referred to again, e.g. by another
+                                 interpreter since gc() found them. Otherwise
+                                 nothing may refer to the addresses.
+
+        Returns:
+            The addresses released.
+
+        """
+
+        # Each address is checked with its own update, which tells whether it
+        # was released.
+        if unreferenced:
+            addrs = [addr for addr in addrs
+                     if self.db.cmd("update addresses set type = %s, " +
+                                    "val = null, version = version + 1 " +
+                                    "where id = %s and refs = 0;",
+                                    (free_type, addr)) > 0]
+        else:
+            for placeholders, chunk in in_lists(addrs):
+                self.db.cmd("update addresses set type = %s, val = null, " +
+                            "refs = 0, version = version + 1 where id in (" +
+                            placeholders + ");",
+                            [free_type] + chunk)
+
+        for placeholders, chunk in in_lists(addrs):
+            self.db.cmd("delete from items where list_id in (" +
+                        placeholders + ");", chunk)
+
+        for addr in addrs:
+            self.versions.pop(('addresses', addr), None)
+
+        self.released.extend(addrs)
 
+        return addrs
+
+
+    def reserve_free_addresses(self):
         """
-        self.db.cmd("delete from addresses where id = %s;", (addr,))
+        Take up to free_block_size addresses off the free list in the
+        database for this interpreter to reuse, in the current transaction.
+
+        The free list is only rebuilt by sweep(). Addresses freed since then
+        are reused by the interpreter which freed them, and any it still holds
+        when it stops go back on the free list with the next sweep.
+
+        The head of the list is moved with a compare-and-swap, so interpreters
+        running the same program at once never reserve the same addresses.
+        Whichever loses the race inserts new addresses instead this time.
+
+        """
+
+        head = self.db.scalar("select free_head from programs where id = %s;",
+                              (self.program_id,))
+
+        # Walk the chain here rather than with a recursive query, which MySQL
+        # only has from 8.0. rebuild_free_list() chains the addresses in order
+        # of ID, so reading them in that order from the next link usually
+        # finds the whole block at once.
+        addrs = []
+        next_id = head
+
+        while next_id and len(addrs) < self.free_block_size:
+            batch = dict(self.db.rows(
+                "select id, next_free_id from addresses " +
+                "where program_id = %s and id >= %s order by id limit %s;",
+                (self.program_id, next_id,
+                 self.free_block_size - len(addrs))))
+
+            if next_id not in batch:
+                break
+
+            while next_id in batch and len(addrs) < self.free_block_size:
+                addrs.append(next_id)
+                next_id = batch[next_id]
+
+        if len(addrs) == 0:
+            self.free_list_empty = True
+            return
+
+        if self.db.cmd("update programs set free_head = %s " +
+                       "where id = %s and free_head = %s;",
+                       (next_id or 0, self.program_id, head)) == 0:
+            return
+
+        self.free_addresses.extend(reversed(addrs))
+
+
+    def rebuild_free_list(self):
+        """
+        Chain every free address in the database into the free list, including
+        any reserved or freed by interpreters which have since stopped.
+
+        """
+
+        addrs = [addr for addr, in self.db.rows(
+            "select id from addresses where program_id = %s and type = %s " +
+            "order by id;",
+            (self.program_id, free_type))]
+
+        self.db.many("update addresses set next_free_id = %s where id = %s;",
+                     list(zip(addrs[1:] + [None], addrs)))
+
+        self.db.cmd("update programs set free_head = %s where id = %s;",
+                    (addrs[0] if len(addrs) > 0 else 0, self.program_id))
+
+        self.free_addresses = []
+        self.free_list_empty = False
+
+
+    def add_refs(self, addr, count):
+        """
+        Adjust the reference count of an address: the number of locals and
+        list items pointing to it.
+
+        """
+
+        self.db.cmd("update addresses set refs = refs + %s where id = %s;",
+                    (count, addr))
+
+        if count < 0:
+            self.garbage.add(addr)
 
 
     def generate_local_label(self, call, label_format):
@@ -671,9 +1317,7 @@ class Interpreter(object):
         for tries in range(10):
             check = label_format.replace('{$r}', str(randint(0, 10000)))
 
-            if 0 == self.db.scalar("select count(1) from locals " +
-                                   "where call_id = %s and label = %s;",
-                                   (call['id'], check)):
+            if self.get_local(call['id'], check) is None:
                 return check
 
             print('local collision')
@@ -699,24 +1343,115 @@ class Interpreter(object):
 
         # No existing reference to point to.
         if ref is None:
-            addr = self.mem_write(self.mem_alloc(), {'type': type_,'val': val})
+            addr = self.mem_write(self.mem_alloc(call_id),
+                                  {'type': type_,'val': val})
 
         # Existing reference. Make a pointer.
         else:
             addr = ref
+            self.escape(addr, call_id)
 
         # Check for an existing local to update.
         existing = self.get_local(call_id, label)
         if existing is not None:
-            self.db.cmd("update locals set address_id = %s where id = %s;",
-                        (addr, existing['id'],))
+            self.set_local_address(existing['id'], addr)
             return
 
-        r=self.db.autoid("insert into locals (id, call_id, label, address_id) "+
-                         "values ({$id}, %s, %s, %s);",
-                         (call_id, label, addr))
+        return self.insert_local(call_id, label, addr)
+
+
+    def escape(self, addr, call_id):
+        """
+        Make sure an address which is about to be referenced by a local in a
+        call stack frame isn't freed with a different frame.
+
+        """
 
-        return r
+        mem = self.fetch_address(addr)
+
+        if mem is not None and mem['owner_call_id'] is not None and \
+           mem['owner_call_id'] != call_id:
+            self.disown_address(addr)
+
+
+    def disown_address(self, addr):
+        """
+        Detach an address and the items of the list it holds (if any) from
+        the call stack frame owning them, leaving them to be freed by
+        reference counting.
+
+        """
+
+        self.db.cmd("update addresses set owner_call_id = null " +
+                    "where id = %s or id in " +
+                    "(select address_id from items where list_id = %s);",
+                    (addr, addr))
+
+
+    def insert_local(self, call_id, label, addr):
+        """
+        Insert a local pointing to an existing address.
+
+        Returns:
+            The new local ID.
+
+        """
+
+        local_id = self.db.autoid("insert into locals " +
+                                  "(id, call_id, label, address_id) " +
+                                  "values (%s, %s, %s, %s);",
+                                  (call_id, label, addr))
+
+        self.add_refs(addr, 1)
+
+        return local_id
+
+
+    def delete_locals(self, call_id, labels):
+        """
+        Delete locals from a call stack frame if they exist, releasing their
+        addresses.
+
+        Arguments:
+            call_id (int): The call stack frame.
+            labels (list): The names of the locals.
+
+        """
+
+        rows = [row for placeholders, chunk in in_lists(labels)
+                for row in self.db.rows("select id, address_id from locals " +
+                                        "where call_id = %s and label in (" +
+                                        placeholders + ");",
+                                        [call_id] + chunk)]
+
+        if len(rows) == 0:
+            return
+
+        for placeholders, chunk in in_lists(row[0] for row in rows):
+            self.db.cmd("delete from locals where id in (" + placeholders +
+                        ");", chunk)
+
+        for local_id, addr in rows:
+            self.add_refs(addr, -1)
+
+
+    def set_local_address(self, local_id, addr):
+        """
+        Point an existing local at a different address.
+
+        """
+
+        old = self.db.scalar("select address_id from locals where id = %s;",
+                             (local_id,))
+
+        if old == addr:
+            return
+
+        self.db.cmd("update locals set address_id = %s where id = %s;",
+                    (addr, local_id,))
+
+        self.add_refs(addr, 1)
+        self.add_refs(old, -1)
 
 
     def get_local(self, call_id, label):
@@ -741,9 +1476,7 @@ class Interpreter(object):
         except TypeError:
             pass
 
-        ret = self.db.first("select * from locals where call_id = %s and " +
-                            "label = %s;",
-                            (call_id, label,))
+        ret = self.fetch_local(call_id, label)
 
         if ret is not None:
             ret['cls'] = 'local'
@@ -751,6 +1484,18 @@ class Interpreter(object):
         return ret
 
 
+    def fetch_local(self, call_id, label):
+        """
+        Look up the row for a local by call stack frame and label.
+
+        """
+
+        return row_dict(local_columns, self.db.row(
+            "select id, call_id, label, address_id from locals " +
+            "where call_id = %s and label = %s;",
+            (call_id, label,)))
+
+
     def set_local(self, call_id, label, val):
         """
         Change the value of an existing local.
@@ -767,38 +1512,6 @@ class Interpreter(object):
         self.mem_write(local['address_id'], val)
 
 
-    def step_up(self, call, inst):
-        current = inst
-
-        # Perform any needed cleanup on the conditional stack.
-        self.exit_conditional(call, current)
-
-        while current['parent_id'] is not None:
-            # Look up the parent instruction if there is one.
-            parent_inst = self.get_instruction(current['parent_id'])
-
-            if parent_inst is None:
-                raise StopIteration
-
-            # Perform any needed cleanup on the conditional stack.
-            self.exit_conditional(call, parent_inst)
-
-            yield parent_inst
-
-            current = parent_inst
-
-
-    def step_up_loops(self, call, inst):
-        """
-        Step up from the given instruction, yielding any loops encountered.
-
-        """
-
-        for parent in self.step_up(call, inst):
-            if parent['code']['kind'] in loop_keywords:
-                yield parent
-
-
     def exec(self, thread_id):
         """
         Execute an instruction in the given thread.
@@ -817,9 +1530,25 @@ class Interpreter(object):
 
         inst = self.call_instruction(call['id'])
 
+        # Delete temp variables which are no longer needed (see
+        # glacia.liveness).
+        if 'dead_locals' in inst['code']:
+            self.delete_locals(call['id'], inst['code']['dead_locals'])
+
+        self.temp_locals = []
+
+        stepped = self.eval(call, inst)
+
+        # The lists built by the instruction have been assigned by now (if
+        # at all), so their temporary locals can go.
+        for call_id, label in self.temp_locals:
+            self.delete_locals(call_id, [label])
+
+        self.temp_locals = []
+
         # If the instruction stepped into a block, don't advance the
         # instruction pointer.
-        if not self.eval(call, inst):
+        if not stepped:
             return True
 
         # Advance instruction pointer to the next line.
@@ -829,26 +1558,18 @@ class Interpreter(object):
         return True
 
 
-    def exit_conditional(self, call, parent_inst):
+    def exit_conditionals(self, call, count):
         """
-        Check if execution is leaving a conditional and pop off the conditional
-        stack if so.
+        Pop conditionals off the conditional stack when execution leaves if/else
+        blocks.
 
         Arguments:
             call (dict): The call stack frame to execute within.
-            parent_inst (dict): The instruction whose block we are exiting from.
+            count (int): The number of conditionals to pop.
 
         """
 
-        # Look up the next instruction
-        next_inst = None
-        if parent_inst is not None:
-            next_inst = self.step_over(parent_inst['id'])
-
-        if (parent_inst is not None and
-            parent_inst['code']['kind'] in ['if', 'else']) and \
-           (next_inst is None or
-            next_inst['code']['kind'] != 'else'):
+        for i in range(count):
             self.pop_conditional(call)
 
 
@@ -888,7 +1609,11 @@ class Interpreter(object):
 
         found = None
 
-        for loop in self.step_up_loops(call, break_inst):
+        # The enclosing loops and the conditionals exited to reach each one
+        # were worked out when the program was loaded.
+        for loop_id, exits in break_inst['loops']:
+            loop = self.get_instruction(loop_id)
+
             # If no target_label, break out of the specified number of loops.
             if target_label is None:
                 break_count -= 1
@@ -901,13 +1626,17 @@ class Interpreter(object):
                     found = loop
                     break
 
-        if found is not None:
-            # Break the target loop and continue execution after.
-            if is_break:
-                self.step_over_or_out_greedy(call, found)
-            # Continue execution at the start of the target loop.
-            else:
-                self.call_advance(call, found)
+        if found is None:
+            raise Exception('No loop to ' + break_inst['code']['kind'] + '.')
+
+        self.exit_conditionals(call, exits)
+
+        # Break the target loop and continue execution after.
+        if is_break:
+            self.step_over_or_out_greedy(call, found)
+        # Continue execution at the start of the target loop.
+        else:
+            self.call_advance(call, found)
 
 
     def type_check(self, token):
@@ -922,6 +1651,10 @@ class Interpreter(object):
         elif token['type'] == 'bool':
             token['val'] = bool(int(token['val']))
 
+        # References to addresses and generator call stack frames hold IDs.
+        elif token['type'] in ['ref', 'generator']:
+            token['val'] = int(token['val'])
+
         return token
 
 
@@ -1033,9 +1766,7 @@ class Interpreter(object):
         except TypeError:
             pass
 
-        ret = self.db.first("select * from items where list_id = %s and " +
-                            "ordinal = %s limit 1;",
-                            (mem['id'], index,))
+        ret = self.fetch_item(mem['id'], index)
 
         if ret is None:
             raise Exception('Failed to get index '+str(index)+' '+
@@ -1068,17 +1799,93 @@ class Interpreter(object):
         except TypeError:
             pass
 
-        # An "upsert" would still take 2 queries: a select to see if it exists
-        # already and then an insert or update depending on the select. Might as
-        # well just delete and insert.
-        self.db.cmd("delete from items where list_id = %s and ordinal = %s;",
-                    (mem['id'], index))
+        # Overwrite the existing item in place if nothing else refers to it.
+        # A list is left alone as its own items would be lost.
+        item = self.fetch_item(mem['id'], index)
 
-        addr = self.mem_write(self.mem_alloc(), val)
+        if item is not None:
+            old = self.fetch_address(item['address_id'])
 
-        self.db.cmd("insert into items (list_id, ordinal, address_id) " +
-                    "values (%s, %s, %s);",
-                    (mem['id'], index, addr,))
+            if old['refs'] == 1 and old['type'] != 'list' and \
+               old['owner_call_id'] == mem['owner_call_id']:
+                self.mem_write(old['id'], val)
+                return
+
+        # Items belong to the same frame as their list.
+        addr = self.mem_write(self.mem_alloc(mem['owner_call_id']), val)
+
+        self.store_item(mem['id'], index, addr)
+
+
+    def fetch_item(self, list_id, ordinal):
+        """
+        Look up the row for a list item.
+
+        """
+
+        return row_dict(item_columns, self.db.row(
+            "select list_id, ordinal, address_id from items " +
+            "where list_id = %s and ordinal = %s limit 1;",
+            (list_id, ordinal,)))
+
+
+    def store_item(self, list_id, ordinal, addr):
+        """
+        Point a list item at an address, replacing any existing item.
+
+        """
+
+        self.touch_list(list_id)
+
+        # The replaced item's address loses a reference.
+        old = self.db.scalar("select address_id from items " +
+                             "where list_id = %s and ordinal = %s;",
+                             (list_id, ordinal))
+
+        if old is not None:
+            self.db.cmd("update items set address_id = %s " +
+                        "where list_id = %s and ordinal = %s;",
+                        (addr, list_id, ordinal))
+        else:
+            self.db.cmd("insert into items (list_id, ordinal, address_id) " +
+                        "values (%s, %s, %s);",
+                        (list_id, ordinal, addr,))
+
+        self.add_refs(addr, 1)
+
+        if old is not None:
+            self.add_refs(old, -1)
+
+
+    def truncate_items(self, list_id, size):
+        """
+        Delete all list items at or beyond the given size.
+
+        """
+
+        self.touch_list(list_id)
+
+        addrs = self.db.rows("select address_id from items " +
+                             "where list_id = %s and ordinal >= %s;",
+                             (list_id, size))
+
+        self.db.cmd("delete from items where list_id=%s and ordinal>=%s;",
+                    (list_id, size))
+
+        for addr, in addrs:
+            self.add_refs(addr, -1)
+
+
+    def touch_list(self, list_id):
+        """
+        Bump the version of a list before changing its items, which are
+        versioned along with the list.
+
+        """
+
+        self.versioned("update addresses set version = version + 1 " +
+                       "where id = %s",
+                       'addresses', list_id)
 
 
     def get_list(self, call, target):
@@ -1142,8 +1949,7 @@ class Interpreter(object):
 
         # If the list is being shrunk, delete any newly out-of-bounds items.
         if size_diff < 0:
-            self.db.cmd("delete from items where list_id=%s and ordinal>=%s;",
-                        (lst['id'], new_size))
+            self.truncate_items(mem['id'], new_size)
 
 
     def list_push(self, call, target, val):
@@ -1382,11 +2188,35 @@ class Interpreter(object):
 
         """
 
-        val_stripped = self.eval_expression_token(call, val)
         bind = self.binding(inst['code']['binding'])
         binding = self.eval_expression(call, inst['code']['binding'],
                                        assignment_target=True)
 
+        # A list built by list() or range() is referred to rather than
+        # copied, so the reference is counted once its temporary local is
+        # gone (see call()).
+        if val.get('type') == 'ref' and 'address_id' not in val:
+            if binding is not None and 'cls' in binding and \
+               binding['cls'] == 'unevaluated_indexer':
+                local = self.get_local(call['id'], binding['identifier'])
+                lst = self.mem_read(local['address_id'])
+                index = binding['index']
+
+                try:
+                    index = index['val']
+                except TypeError:
+                    pass
+
+                self.escape(val['val'], lst['owner_call_id'])
+                self.store_item(lst['id'], index, val['val'])
+            else:
+                self.create_local(call['id'], bind, None, None,
+                                  ref=val['val'])
+
+            return
+
+        val_stripped = self.eval_expression_token(call, val)
+
         # If the binding could not be resolved (it doesn't exist yet), create
         # a new local.
         if binding is None:
@@ -1499,35 +2329,36 @@ class Interpreter(object):
 
         # Evaluate return instruction
         elif inst['code']['kind'] in ['return', 'yield', 'yield break']:
-            # Look up the call stack frame we're returning to.
+            # Look up the call stack frame we're returning to. There is none
+            # when the function a thread started with returns.
             parent = self.parent_call(call)
 
-            # Get the instruction we'll be returning to.
-            parent_inst = self.call_instruction(parent['id'])
-
-            # Map the return value to the variable in the call instruction.
-            try:
-                v = self.eval_expression(call,
-                                         inst['code']['expression']['tokens'])
-            except KeyError:
-                # In the case of yield break, return null.
-                v = {
-                    'type': 'special',
-                    'val': 'null'
-                }
-
-            # Get the call instruction that invoked the now-returning function.
-            caller_inst = self.get_instruction(call['calling_instruction_id'])
-
-            self.eval_assignment(parent, caller_inst, v)
+            if parent is not None:
+                # Map the return value to the variable in the call
+                # instruction.
+                try:
+                    v = self.eval_expression(
+                        call, inst['code']['expression']['tokens'])
+                except KeyError:
+                    # In the case of yield break, return null.
+                    v = {
+                        'type': 'special',
+                        'val': 'null'
+                    }
+
+                # Get the call instruction that invoked the now-returning
+                # function.
+                caller_inst = self.get_instruction(
+                    call['calling_instruction_id'])
+
+                self.eval_assignment(parent, caller_inst, v)
 
             # For returns, delete the call stack frame.
             if inst['code']['kind'] == 'return':
-                self.db.cmd("delete from calls where id = %s", (call['id'],))
+                self.delete_call(call['id'])
             # For yields, stash the call stack frame.
             elif inst['code']['kind'] == 'yield':
-                self.db.cmd("update calls set depth = null where id = %s",
-                            (call['id'],))
+                self.stash_call(call['id'])
 
         # Execute if statement
         elif inst['code']['kind'] == 'if':
@@ -1559,13 +2390,102 @@ class Interpreter(object):
 
     def gc(self):
         """
-        Run the garbage collector against all virtual database memory.
+        Free the memory addresses which stopped being referenced during the
+        line just run.
+
+        Addresses are reference counted, so only the addresses allocated or
+        released during the line need to be checked, no matter how much
+        memory is in use. Freeing a list releases its items, which are then
+        checked in turn.
+
+        """
+
+        while len(self.garbage) > 0:
+            candidates = sorted(self.garbage)
+            self.garbage = set()
+
+            addrs = [addr for placeholders, chunk in in_lists(candidates)
+                     for addr, in self.db.rows(
+                         "select id from addresses where refs = 0 and " +
+                         "id in (" + placeholders + ");",
+                         chunk)]
+
+            if len(addrs) > 0:
+                self.mem_free(addrs)
 
+
+    def sweep(self):
         """
+        Free all memory addresses which can't be reached from a local, either
+        directly or through list items, recount the references of the rest
+        and rebuild the free list.
+
+        Reference counting frees everything on its own as the locals and items
+        pointing to an address are the only references to it. This scans all
+        of memory and is only run occasionally (see sweep_every) to recover
+        from counts which drifted, e.g. in state written by older versions.
+        Being a mark and sweep, it also frees unreachable cycles.
+
+        Nothing is done while scheduler workers hold leases on threads of the
+        program, as memory they have allocated but not yet committed would
+        look unreachable.
 
-        # Delete any memory addresses which are no longer referenced.
-        self.db.cmd("delete from addresses where 0 = " +
+        """
+
+        if self.db.scalar("select count(1) from threads " +
+                          "where program_id = %s and " +
+                          "lease_owner is not null and lease_expires >= %s;",
+                          (self.program_id, int(time.time() * 1000))) > 0:
+            return
+
+        # Mark the reachable addresses here rather than with a recursive
+        # query, which MySQL only has from 8.0 and which it won't run in a
+        # delete from the table the query reads.
+        live = set()
+        found = {addr for addr, in self.db.rows(
+            "select locals.address_id from locals " +
+            "join calls on calls.id = locals.call_id " +
+            "join threads on threads.id = calls.thread_id " +
+            "where threads.program_id = %s;",
+            (self.program_id,))}
+
+        while len(found) > 0:
+            live.update(found)
+            lists = sorted(found)
+            found = set()
+
+            for placeholders, chunk in in_lists(lists):
+                found.update(addr for addr, in self.db.rows(
+                    "select address_id from items where list_id in (" +
+                    placeholders + ");",
+                    chunk))
+
+            found -= live
+
+        self.db.many("delete from items where list_id = %s;",
+                     [(list_id,) for list_id, in self.db.rows(
+                         "select distinct items.list_id from items " +
+                         "join addresses on addresses.id = items.list_id " +
+                         "where addresses.program_id = %s;",
+                         (self.program_id,))
+                      if list_id not in live])
+
+        self.db.many("update addresses set type = %s, val = null " +
+                     "where id = %s;",
+                     [(free_type, addr) for addr, in self.db.rows(
+                         "select id from addresses where program_id = %s " +
+                         "and (type is null or type <> %s);",
+                         (self.program_id, free_type))
+                      if addr not in live])
+
+        self.db.cmd("update addresses set refs = " +
                     "(select count(1) from locals " +
                      "where address_id = addresses.id) + " +
                     "(select count(1) from items " +
-                     "where address_id = addresses.id);")
+                     "where address_id = addresses.id) " +
+                    "where program_id = %s;",
+                    (self.program_id,))
+
+        self.rebuild_free_list()
+
+        self.garbage = set()
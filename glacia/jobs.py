@@ -0,0 +1,289 @@
+"""
+Runs many independent programs (jobs) concurrently against one database.
+
+A job is a program in its own namespace (see glacia.program) whose status in
+the programs table moves from 'queued' to 'running' to 'finished' or
+'failed'. Jobs are admitted to run oldest first, with at most max_running
+running at a time, so a database can hold any number of queued jobs without
+every one of them competing for the workers. Workers lease the threads of
+running jobs a time slice at a time (see glacia.scheduler), so a job with
+many threads can use several workers and a long job doesn't hold up the
+rest.
+
+Progress is kept in the programs table as the workers go: the lines run by
+each job, and when it was submitted, started and finished.
+
+"""
+
+import os
+import time
+import socket
+import multiprocessing
+
+from glacia import Database, close_after
+from glacia.loader import load
+from glacia.interpreter import Interpreter
+from glacia.program import create_program
+from glacia.scheduler import now_ms, lease_thread, release_thread, \
+                             run_slice
+
+
+def submit(db, name, generated):
+    """
+    Load a compiled program as a new job and queue it to be run by a job
+    pool.
+
+    Arguments:
+        db (Database): The database to submit the job to.
+        name (str): A name for the job, unique in the database.
+        generated (list): The program's DBIL (see glacia.compiler).
+
+    Returns:
+        The job's program ID.
+
+    """
+
+    program_id = create_program(db, name, status='queued')
+
+    load(db, generated, program_id)
+
+    # The main thread is created now, but isn't leased until the job is
+    # admitted.
+    Interpreter(db, program_id=program_id).start()
+
+    return program_id
+
+
+def admit(db, max_running):
+    """
+    Start queued jobs, oldest first, while fewer than max_running jobs are
+    running, and commit.
+
+    Returns:
+        The number of jobs started.
+
+    """
+
+    admitted = 0
+
+    # The limit is checked in the same statement that starts the job. The
+    # subqueries are wrapped in derived tables so MySQL allows them to read
+    # the table being updated.
+    while db.cmd("update programs set status = 'running', started_at = %s " +
+                 "where id = (select id from (select id from programs " +
+                  "where status = 'queued' " +
+                  "order by submitted_at, id limit 1) as queued) " +
+                 "and (select count(1) from (select id from programs " +
+                  "where status = 'running') as running) < %s;",
+                 (now_ms(), max_running)) > 0:
+        admitted += 1
+
+    db.commit()
+
+    return admitted
+
+
+def finish(db, program_id=None):
+    """
+    Mark running jobs finished once none of their threads are left running,
+    and commit.
+
+    Arguments:
+        db (Database): The database holding the jobs.
+        program_id (int): The job to check, or None to check every running
+                          job.
+
+    Returns:
+        The number of jobs marked finished.
+
+    """
+
+    ret = db.cmd("update programs set status = 'finished', " +
+                 "finished_at = %s where status = 'running' and " +
+                 "(%s is null or id = %s) and not exists " +
+                 "(select 1 from calls " +
+                  "join threads on threads.id = calls.thread_id " +
+                  "where threads.program_id = programs.id and " +
+                  "calls.depth is not null);",
+                 (now_ms(), program_id, program_id))
+
+    db.commit()
+
+    return ret
+
+
+def fail(db, program_id, error):
+    """
+    Mark a job failed, so no more of it is run, and commit.
+
+    """
+
+    db.cmd("update programs set status = 'failed', finished_at = %s, " +
+           "error = %s where id = %s;",
+           (now_ms(), error, program_id))
+
+    db.commit()
+
+
+def pending_jobs(db):
+    """
+    Count the jobs which are queued or running.
+
+    """
+
+    return db.scalar("select count(1) from programs " +
+                     "where status in ('queued', 'running');")
+
+
+def progress(db):
+    """
+    Report the progress of every job in a database.
+
+    Returns:
+        A list of dicts, one per job in order of submission, with the keys
+        id, name, status, lines_run, threads (the threads still running),
+        submitted_at, started_at, finished_at (in milliseconds since the
+        epoch) and error (for failed jobs).
+
+    """
+
+    return db.all("select id, name, status, lines_run, " +
+                  "(select count(distinct calls.thread_id) from calls " +
+                   "join threads on threads.id = calls.thread_id " +
+                   "where threads.program_id = programs.id and " +
+                   "calls.depth is not null) as threads, " +
+                  "submitted_at, started_at, finished_at, error " +
+                  "from programs where status <> 'loaded' " +
+                  "order by submitted_at, id;")
+
+
+def work(backend, db_path, max_running, options, slice_lines, lease_ms,
+         poll_ms):
+    """
+    The main loop of a job worker process: admit jobs and run the threads of
+    running jobs until no job is left queued or running.
+
+    Arguments:
+        backend (str): The storage backend to use.
+        db_path (str): The database file for file-based backends.
+        max_running (int): The most jobs to run at once.
+        options (dict): Interpreter options (commit_every etc).
+        slice_lines (int): The most lines to run before handing a thread
+                           back.
+        lease_ms (int): How long a lease lasts.
+        poll_ms (int): How long to wait when every running thread is leased.
+
+    """
+
+    worker_id = socket.gethostname() + ':' + str(os.getpid())
+
+    with close_after(Database(backend, db_path, pooled=False)) as db:
+        # An interpreter for each job this worker has run a slice of.
+        interpreters = {}
+
+        while True:
+            admit(db, max_running)
+
+            leased = lease_thread(db, worker_id, lease_ms, None)
+
+            if leased is None:
+                # Also catches jobs whose last slice was run by a worker
+                # which died before marking them finished.
+                finish(db)
+
+                if pending_jobs(db) == 0:
+                    break
+
+                time.sleep(poll_ms / 1000)
+                continue
+
+            thread_id, program_id = leased
+
+            if program_id not in interpreters:
+                interpreters[program_id] = Interpreter(
+                    db, sweep_every=None, program_id=program_id, **options)
+
+            try:
+                lines, more = run_slice(interpreters[program_id], thread_id,
+                                        slice_lines, lease_ms / 2)
+            except Exception as e:
+                # A failed job doesn't stop the others.
+                release_thread(db, thread_id, worker_id)
+                fail(db, program_id, str(e))
+                del interpreters[program_id]
+                continue
+
+            db.cmd("update programs set lines_run = lines_run + %s " +
+                   "where id = %s;",
+                   (lines, program_id))
+
+            release_thread(db, thread_id, worker_id)
+
+            if finish(db, program_id) > 0:
+                del interpreters[program_id]
+
+
+class JobPool(object):
+    """
+    Runs the jobs in a database across worker processes until no job is left
+    queued or running. Jobs submitted while the pool runs are picked up too.
+
+    Workers run the db engine, as with glacia.scheduler.Scheduler.
+
+    Arguments:
+        backend (str): The storage backend to use. If None, the backend from
+                       the config file is used.
+        db_path (str): The database file for file-based backends.
+        workers (int): The number of worker processes. If None, one per CPU.
+        max_running (int): The most jobs to run at once. Queued jobs wait
+                           for a running job to finish.
+        slice_lines (int): The most lines a worker runs in a thread before
+                           handing it back.
+        lease_ms (int): How long a worker's lease on a thread lasts before
+                        another worker may take the thread over.
+        poll_ms (int): How long an idle worker waits before looking for a
+                       thread again.
+        options (dict): Options for each worker's Interpreters (commit_every,
+                        commit_interval_ms).
+
+    """
+
+    def __init__(self, backend=None, db_path=None, workers=None,
+                 max_running=100, slice_lines=100, lease_ms=60000,
+                 poll_ms=10, options=None):
+        self.backend = backend
+        self.db_path = db_path
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.max_running = max_running
+        self.slice_lines = slice_lines
+        self.lease_ms = lease_ms
+        self.poll_ms = poll_ms
+        self.options = options if options is not None else {}
+
+
+    def run(self):
+        """
+        Start the workers and wait for them to finish.
+
+        """
+
+        # Spawn rather than fork, so workers don't share the parent's pooled
+        # connections.
+        context = multiprocessing.get_context('spawn')
+
+        processes = [context.Process(target=work, args=(
+            self.backend, self.db_path, self.max_running, self.options,
+            self.slice_lines, self.lease_ms, self.poll_ms))
+            for i in range(self.workers)]
+
+        for process in processes:
+            process.start()
+
+        for process in processes:
+            process.join()
+
+        failed = [p for p in processes if p.exitcode != 0]
+
+        if len(failed) > 0:
+            raise Exception(str(len(failed)) + ' of ' + str(len(processes)) +
+                            ' workers failed.')
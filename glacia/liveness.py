@@ -0,0 +1,183 @@
+from glacia.interpreter import loop_keywords
+from glacia.loader import control_flow
+
+
+# Prefix of the temp variables generated by the compiler (see CompilerState).
+temp_prefix = 'temp_var_'
+
+
+def liveness(generated):
+    """
+    Annotate generated DBIL with the temp variables that are dead when each
+    instruction is reached, so the interpreter can delete them instead of
+    keeping every temp ever assigned until the call returns.
+
+    A temp is dead at an instruction if it is not read again before being
+    assigned again on any path from there. Each instruction lists the temps
+    that may have been live coming from any of its predecessors and are dead
+    at it, as 'dead_locals'. This covers both a temp's last use and a loop
+    indexer going out of scope when the loop exits.
+
+    Only compiler temps are released. A user variable can share its address
+    with a by-reference parameter, and assigning to it again must write to
+    that address rather than to a new local.
+
+    :param generated: DBIL code in dict format (see glacia.generator)
+    :return: The same DBIL, annotated in place
+    """
+
+    for function in generated:
+        annotate_block(function['body'])
+
+    return generated
+
+
+def flatten(rows, parent_id, instructions):
+    """
+    Recursively flatten a block into rows in the format control_flow()
+    expects, numbering the instructions in order.
+
+    :param rows: The list of rows to append to
+    :param parent_id: The number of the parent instruction, or None
+    :param instructions: A list of instructions in dict format
+    :return: None
+    """
+
+    previous_id = None
+
+    for instruction in instructions:
+        inst_id = len(rows)
+
+        rows.append({
+            'id': inst_id,
+            'parent_id': parent_id,
+            'previous_id': previous_id,
+            'code': instruction,
+        })
+
+        flatten(rows, inst_id, instruction.get('body', []))
+
+        previous_id = inst_id
+
+
+def temps(obj):
+    """
+    Find the temp variables referenced anywhere in an expression, binding or
+    token.
+
+    :param obj: DBIL code in dict format
+    :return: A set of temp variable names
+    """
+
+    if isinstance(obj, list):
+        return set().union(*[temps(o) for o in obj])
+
+    if not isinstance(obj, dict):
+        return set()
+
+    if obj.get('cls') == 'identifier' and \
+       str(obj.get('val')).startswith(temp_prefix):
+        return {obj['val']}
+
+    return set().union(*[temps(v) for k, v in obj.items() if k != 'body'])
+
+
+def uses_defs(code):
+    """
+    Work out which temps an instruction reads and which it assigns.
+
+    :param code: An instruction in dict format
+    :return: A tuple (uses, defs) of sets of temp variable names
+    """
+
+    defs = set()
+    fields = dict((k, v) for k, v in code.items() if k != 'body')
+
+    # Assigning to a plain identifier replaces its value. Anything else (such
+    # as a list item) reads the binding.
+    if code['kind'] == 'assignment':
+        tokens = code['binding']['tokens']
+
+        if len(tokens) == 1 and tokens[0]['cls'] == 'identifier':
+            defs = temps(tokens[0])
+            del fields['binding']
+
+    return temps(fields), defs
+
+
+def annotate_block(instructions):
+    """
+    Annotate the instructions of a function with their dead temps.
+
+    :param instructions: The body of a function in dict format
+    :return: None
+    """
+
+    rows = []
+    flatten(rows, None, instructions)
+
+    flow = control_flow(rows)
+
+    first_child = dict((row['parent_id'], row['id']) for row in rows
+                       if row['parent_id'] is not None and
+                       row['previous_id'] is None)
+
+    # Where execution can go after each instruction.
+    successors = {}
+
+    for row in rows:
+        kind = row['code']['kind']
+        successor_id, exits, loops = flow[row['id']]
+
+        if kind == 'break':
+            successors[row['id']] = [flow[loop_id][0]
+                                     for loop_id, loop_exits in loops or []]
+        elif kind == 'continue':
+            successors[row['id']] = [loop_id for loop_id, loop_exits
+                                     in loops or []]
+        elif kind == 'return':
+            successors[row['id']] = []
+        else:
+            successors[row['id']] = [successor_id]
+
+            if kind in ['if', 'else'] + loop_keywords and \
+               row['id'] in first_child:
+                successors[row['id']].append(first_child[row['id']])
+
+        successors[row['id']] = [s for s in successors[row['id']]
+                                 if s is not None]
+
+    uses = {}
+    defs = {}
+
+    for row in rows:
+        uses[row['id']], defs[row['id']] = uses_defs(row['code'])
+
+    # Standard backwards dataflow: iterate until nothing changes.
+    live_in = dict((row['id'], set()) for row in rows)
+    changed = True
+
+    while changed:
+        changed = False
+
+        for row in reversed(rows):
+            live_out = set().union(*[live_in[s]
+                                     for s in successors[row['id']]])
+            new = uses[row['id']] | (live_out - defs[row['id']])
+
+            if new != live_in[row['id']]:
+                live_in[row['id']] = new
+                changed = True
+
+    # Temps which may be live coming from a predecessor.
+    incoming = dict((row['id'], set()) for row in rows)
+
+    for row in rows:
+        for s in successors[row['id']]:
+            incoming[s] |= live_in[row['id']] | defs[row['id']]
+
+    for row in rows:
+        dead = incoming[row['id']] - live_in[row['id']]
+
+        if len(dead) > 0:
+            row['code']['dead_locals'] = sorted(dead)
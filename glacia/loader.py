@@ -1,42 +1,184 @@
 import json
+import time
+import hashlib
 
+from glacia.interpreter import loop_keywords
+from glacia.program import invalidate, default_program_id
 
-def load(db, generated):
+
+# Encodes instructions for the code column. Keys keep the order the compiler
+# gave them, so the same DBIL always encodes (and hashes) the same way.
+encoder = json.JSONEncoder(separators=(',', ':'))
+
+
+def load(db, generated, program_id=default_program_id):
     """
-    Load DBIL code in dict format into the database for interpretation.
+    Load DBIL code in dict format into a program in the database for
+    interpretation. Other programs in the database are left alone.
+
+    Loading is incremental: functions whose DBIL is unchanged since the last
+    load keep their rows, and only new or changed functions are written
+    (with new IDs). Functions no longer present are removed. Program state
+    (threads, calls, memory) is always cleared.
+
+    IDs are reserved up front with a single query and all rows are written
+    with batched inserts in one transaction, with foreign key checks deferred
+    until the load is complete.
 
     :param db: A Database instance
     :param generated: DBIL code (from glacia.generator.generate())
-    :return: None
+    :param program_id: The program to load the code into (see
+                       glacia.program.create_program())
+    :return: A dict with the number of functions and instructions written,
+             the number of unchanged functions and the time taken in seconds
     """
 
-    # Clear existing program
-    db.cmd('set foreign_key_checks = 0;')
-    for table in ['locals', 'calls', 'threads', 'instructions', 'functions',
-                  'conditionals', 'addresses', 'items']:
-        db.cmd('delete from ' + table + ';')
-    db.cmd('set foreign_key_checks = 1;')
+    start = time.monotonic()
+
+    # The functions already loaded, by name.
+    existing = dict((label, (func_id, code_hash)) for label, func_id, code_hash
+                    in db.rows("select label, id, code_hash from functions " +
+                               "where program_id = %s;", (program_id,)))
+
+    # Functions are hashed when compiled (see glacia.compiler), so only the
+    # changed ones need to be encoded here. Each instruction is encoded once,
+    # for both the hash and the insert.
+    encoded = dict((function['name'], encode_function(function))
+                   for function in generated if 'hash' not in function)
+
+    hashes = dict((function['name'], function['hash'] if 'hash' in function
+                   else encoded[function['name']][0])
+                  for function in generated)
+
+    changed = [function for function in generated
+               if existing.get(function['name'], (None, None))[1] !=
+                  hashes[function['name']]]
+
+    for function in changed:
+        if function['name'] not in encoded:
+            encoded[function['name']] = encode_function(function)
+
+    removed = [func_id for label, (func_id, code_hash) in existing.items()
+               if hashes.get(label) != code_hash]
+
+    functions = []
+    instructions = []
+
+    if len(changed) > 0:
+        next_id = db.reserve_ids(len(changed) +
+                                 sum(len(encoded[function['name']][1])
+                                     for function in changed))
+
+        for function in changed:
+            func_id = next_id
+            rows = encoded[function['name']][1]
+
+            functions.append((func_id, program_id, function['name'],
+                              function['return_type'],
+                              json.dumps(function['params']),
+                              hashes[function['name']]))
+
+            instructions.extend(instruction_rows(func_id, func_id + 1, rows))
+
+            next_id = func_id + 1 + len(rows)
+
 
-    # Load new program
-    for function in generated:
-        func_id = db.autoid("insert into functions "+
-                            "(id, label, return_type, arguments) " +
-                            "values ({$id}, %s, %s, %s);",
-                            (function['name'], function['return_type'],
-                             json.dumps(function['params']),))
+    db.foreign_key_checks(False)
 
-        load_block(db, func_id, None, function['body'])
+    # Clear the program's existing state
+    calls = ("(select calls.id from calls " +
+             "join threads on threads.id = calls.thread_id " +
+             "where threads.program_id = %s)")
+
+    db.cmd("delete from locals where call_id in " + calls + ";",
+           (program_id,))
+    db.cmd("delete from conditionals where call_id in " + calls + ";",
+           (program_id,))
+    db.cmd("delete from calls where thread_id in " +
+           "(select id from threads where program_id = %s);",
+           (program_id,))
+    db.cmd("delete from threads where program_id = %s;", (program_id,))
+    db.cmd("delete from items where list_id in " +
+           "(select id from addresses where program_id = %s);",
+           (program_id,))
+    db.cmd("delete from addresses where program_id = %s;", (program_id,))
+
+    # Remove changed and deleted functions
+    db.many("delete from instructions where function_id = %s;",
+            [(func_id,) for func_id in removed])
+    db.many("delete from functions where id = %s;",
+            [(func_id,) for func_id in removed])
+
+    # Load new and changed functions
+    db.many("insert into functions " +
+            "(id, program_id, label, return_type, arguments, code_hash) " +
+            "values (%s, %s, %s, %s, %s, %s);",
+            functions)
+
+    db.many("insert into instructions " +
+            "(id, function_id, parent_id, previous_id, code, label, " +
+            "successor_id, exits, loops) " +
+            "values (%s, %s, %s, %s, %s, %s, %s, %s, %s);",
+            instructions)
+
+    db.foreign_key_checks(True)
+
+    # Even if nothing changed this is a new program run as far as anything
+    # keyed by program_version() is concerned. The free list went with the
+    # old state.
+    db.cmd("update programs set version = version + 1, free_head = 0 " +
+           "where id = %s;",
+           (program_id,))
 
     db.commit()
 
+    invalidate(db, program_id)
+
+    return {
+        'functions': len(functions),
+        'unchanged': len(generated) - len(changed),
+        'instructions': len(instructions),
+        'seconds': time.monotonic() - start,
+    }
+
 
-def load_block(db, func_id, parent_id, instructions):
+def encode_function(function):
     """
-    Recursively load a block of instructions into the database.
+    Flatten a function into instruction rows and hash its DBIL to detect
+    changes between loads. Each instruction is encoded to JSON once, and the
+    encoding is used both for the hash and as the code column. A 'hash' key
+    stored in the function is not part of its DBIL.
 
-    :param db: A Database instance
-    :param func_id: The ID of the function to which the block belongs
-    :param parent_id: The parent block if nested
+    :param function: A function in dict format (see glacia.generator)
+    :return: A tuple (hash, rows), where rows is a list of instructions in
+             dict format, numbered from 0 with parents before their children
+             (id, parent_id, previous_id, the decoded code without its body,
+             the encoded code and the label)
+    """
+
+    rows = []
+    flatten(rows, None, function['body'])
+
+    ret = hashlib.sha256(encoder.encode([function['name'],
+                                         function['return_type'],
+                                         function['params']]).encode('utf-8'))
+
+    # Encoded instructions never contain a newline, so the rows can't run
+    # into each other.
+    ret.update(''.join('\n%s %s %s' % (row['parent_id'], row['previous_id'],
+                                        row['encoded'])
+                       for row in rows).encode('utf-8'))
+
+    return ret.hexdigest(), rows
+
+
+def flatten(rows, parent_id, instructions):
+    """
+    Recursively flatten a block of instructions into rows, parents before
+    their children.
+
+    :param rows: The list to append instructions in dict format to
+    :param parent_id: The number of the parent instruction if nested
     :param instructions: A list of instructions in dict format
     :return: None
     """
@@ -46,18 +188,132 @@ def load_block(db, func_id, parent_id, instructions):
     for instruction in instructions:
         # Remove the body from the copy saved to the database: the body will
         # be written to the database as separate instructions.
-        copy = instruction.copy()
-        if "body" in copy:
-            del copy["body"]
+        if 'body' in instruction:
+            copy = dict((k, v) for k, v in instruction.items() if k != 'body')
+        else:
+            copy = instruction
 
-        label = copy["label"] if "label" in copy else None
+        inst_id = len(rows)
 
-        previous_id = db.autoid(
-            "insert into instructions " +
-            "(id, function_id, parent_id, previous_id, code, label) " +
-            "values ({$id}, %s, %s, %s, %s, %s);",
-            (func_id, parent_id, previous_id, json.dumps(copy), label))
+        rows.append({
+            'id': inst_id,
+            'parent_id': parent_id,
+            'previous_id': previous_id,
+            'code': copy,
+            'encoded': encoder.encode(copy),
+            'label': copy.get('label'),
+        })
+
+        previous_id = inst_id
 
         # Recursion
         if 'body' in instruction:
-            load_block(db, func_id, previous_id, instruction['body'])
+            flatten(rows, inst_id, instruction['body'])
+
+
+def instruction_rows(func_id, first_id, rows):
+    """
+    Convert the rows of a function from encode_function() into values for
+    the instructions table, numbering them from first_id.
+
+    """
+
+    def shift(inst_id):
+        return None if inst_id is None else first_id + inst_id
+
+    flow = control_flow(rows)
+
+    ret = []
+
+    for row in rows:
+        successor_id, exits, loops = flow[row['id']]
+
+        if loops is not None:
+            loops = json.dumps([[shift(loop_id), loop_exits]
+                                for loop_id, loop_exits in loops])
+
+        ret.append((shift(row['id']), func_id, shift(row['parent_id']),
+                    shift(row['previous_id']), row['encoded'], row['label'],
+                    shift(successor_id), exits, loops))
+
+    return ret
+
+
+def control_flow(instructions):
+    """
+    Work out where execution continues after each instruction, so the
+    interpreter doesn't have to walk the instruction tree at runtime.
+
+    When an instruction is done, execution moves to the instruction after it.
+    At the end of a block it moves up to the parent: a loop is re-entered
+    and anything else continues with the instruction after the parent, and
+    so on up to the end of the function.
+
+    Leaving an if/else block pops its conditional unless an else follows it.
+    The number of pops on the way is counted in the same order as the
+    interpreter used to perform them while walking the tree, including the
+    extra pop when the instruction being left is itself an if/else.
+
+    :param instructions: A list of instructions in dict format (id,
+                         parent_id, previous_id and the decoded code)
+    :return: A dict mapping instruction IDs to (successor_id, exits, loops)
+             where loops is None unless the instruction is a break or continue
+    """
+
+    by_id = dict((inst['id'], inst) for inst in instructions)
+    following = dict((inst['previous_id'], inst) for inst in instructions
+                     if inst['previous_id'] is not None)
+
+    def pops(inst):
+        next_inst = following.get(inst['id'])
+
+        return int(inst['code']['kind'] in ['if', 'else'] and
+                   (next_inst is None or next_inst['code']['kind'] != 'else'))
+
+    def ancestors(inst):
+        while inst['parent_id'] is not None:
+            inst = by_id[inst['parent_id']]
+            yield inst
+
+    ret = {}
+
+    for inst in instructions:
+        next_inst = following.get(inst['id'])
+
+        # Falling through to the next instruction in the same block.
+        if next_inst is not None:
+            successor_id = next_inst['id']
+            exits = pops(inst)
+
+        # Stepping out of the block.
+        else:
+            successor_id = None
+            exits = pops(inst) * 2
+
+            for parent in ancestors(inst):
+                exits += pops(parent)
+
+                if parent['code']['kind'] in loop_keywords:
+                    successor_id = parent['id']
+                    break
+
+                if parent['id'] in following:
+                    successor_id = following[parent['id']]['id']
+                    break
+
+        # The loops a break or continue can target, innermost first.
+        loops = None
+
+        if inst['code']['kind'] in ['break', 'continue']:
+            loops = []
+            loop_exits = pops(inst)
+
+            for parent in ancestors(inst):
+                loop_exits += pops(parent)
+
+                if parent['code']['kind'] in loop_keywords:
+                    loops.append([parent['id'], loop_exits])
+
+        ret[inst['id']] = (successor_id, exits, loops)
+
+    return ret
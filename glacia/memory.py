@@ -0,0 +1,621 @@
+from glacia.interpreter import Interpreter, free_type
+from glacia.program import default_program_id
+
+
+def column_value(val):
+    """
+    Convert a value the same way storing it in a varchar column would, so
+    values read back from memory match values read back from the database.
+
+    """
+
+    if val is None:
+        return None
+
+    if isinstance(val, bool):
+        return '1' if val else '0'
+
+    return str(val)
+
+
+# The tables holding runtime state and their columns, in an order which
+# satisfies foreign keys when inserting.
+state_tables = [
+    ('threads', ['id']),
+    ('addresses', ['id', 'type', 'val', 'refs', 'owner_call_id']),
+    ('calls', ['id', 'thread_id', 'depth', 'instruction_id',
+               'calling_instruction_id']),
+    ('conditionals', ['call_id', 'depth', 'satisfied']),
+    ('locals', ['id', 'call_id', 'label', 'address_id']),
+    ('items', ['list_id', 'ordinal', 'address_id']),
+]
+
+
+# The rows of each state table which belong to a program.
+program_rows = {
+    'threads': "program_id = %s",
+    'addresses': "program_id = %s",
+    'calls': "thread_id in (select id from threads where program_id = %s)",
+    'conditionals': "call_id in (select calls.id from calls " +
+                    "join threads on threads.id = calls.thread_id " +
+                    "where threads.program_id = %s)",
+    'locals': "call_id in (select calls.id from calls " +
+              "join threads on threads.id = calls.thread_id " +
+              "where threads.program_id = %s)",
+    'items': "list_id in (select id from addresses where program_id = %s)",
+}
+
+# Tables with a program_id column, set from the interpreter when inserting.
+program_tables = ['threads', 'addresses']
+
+
+class MemoryState(object):
+    """
+    The runtime state of a glacia program (threads, calls, conditionals,
+    addresses, locals and items) held in Python data structures.
+
+    All changes go through apply() so they can be recorded and replayed.
+
+    """
+
+    def __init__(self):
+        self.threads = []
+
+        # Call stack frames by ID, and the frames on each thread's stack by
+        # depth. Stashed (generator) frames are not in stacks.
+        self.calls = {}
+        self.stacks = {}
+
+        # The conditional stack of each frame as a list of satisfied values.
+        self.conditionals = {}
+
+        self.addresses = {}
+
+        # The addresses owned by each call stack frame.
+        self.regions = {}
+
+        # Locals by ID and by frame and label.
+        self.locals = {}
+        self.frame_locals = {}
+
+        # List items by list address and ordinal.
+        self.items = {}
+
+        # Addresses whose reference count may have dropped to zero since
+        # MemoryInterpreter.gc() last ran.
+        self.garbage = set()
+
+    def apply(self, op, *args):
+        """
+        Apply a change to the state.
+
+        Arguments:
+            op (str): The name of the change (one of the methods below).
+            args: The arguments to the change.
+
+        """
+
+        getattr(self, op)(*args)
+
+    def dump(self):
+        """
+        Get the whole state as rows for each table in state_tables.
+
+        Returns:
+            A dict mapping table names to lists of tuples.
+
+        """
+
+        return {
+            'threads': [(t,) for t in self.threads],
+            'addresses': [(m['id'], m['type'], m['val'], m['refs'],
+                           m['owner_call_id'])
+                          for m in self.addresses.values()],
+            'calls': [(c['id'], c['thread_id'], c['depth'],
+                       c['instruction_id'], c['calling_instruction_id'])
+                      for c in self.calls.values()],
+            'conditionals': [(call_id, depth, satisfied)
+                             for call_id, stack in self.conditionals.items()
+                             for depth, satisfied in enumerate(stack)],
+            'locals': [(l['id'], l['call_id'], l['label'], l['address_id'])
+                       for l in self.locals.values()],
+            'items': [(list_id, ordinal, addr)
+                      for list_id, items in self.items.items()
+                      for ordinal, addr in items.items()],
+        }
+
+    def load(self, tables):
+        """
+        Add rows in the format returned by dump() to the state. Reference
+        counts are recounted from the locals and items loaded.
+
+        """
+
+        for row in tables['threads']:
+            self.create_thread(*row)
+
+        # Free addresses left by the database engine aren't memory in use.
+        for row in tables['addresses']:
+            if row[1] == free_type:
+                continue
+
+            self.alloc(row[0], row[4] if len(row) > 4 else None)
+            self.store_address(*row[:3])
+
+        for row in tables['calls']:
+            self.push_call(*row)
+
+        for call_id, depth, satisfied in sorted(tables['conditionals'],
+                                                key=lambda r: r[1]):
+            self.push_conditional(call_id, satisfied)
+
+        for row in tables['locals']:
+            self.insert_local(*row)
+
+        for row in tables['items']:
+            self.store_item(*row)
+
+    def max_id(self):
+        """
+        Get the highest row ID in use, or 0 if there are none.
+
+        """
+
+        return max([0] + self.threads + list(self.calls) +
+                   list(self.addresses) + list(self.locals))
+
+    def create_thread(self, thread_id):
+        self.threads.append(thread_id)
+        self.stacks[thread_id] = {}
+
+    def push_call(self, call_id, thread_id, depth, instruction_id, caller_id):
+        self.calls[call_id] = {
+            'id': call_id,
+            'thread_id': thread_id,
+            'depth': depth,
+            'instruction_id': instruction_id,
+            'calling_instruction_id': caller_id,
+        }
+
+        self.frame_locals[call_id] = {}
+        self.conditionals[call_id] = []
+
+        if depth is not None:
+            self.stacks[thread_id][depth] = call_id
+
+    def set_call_depth(self, call_id, depth, caller_id):
+        call = self.calls[call_id]
+        stack = self.stacks[call['thread_id']]
+
+        if call['depth'] is not None:
+            del stack[call['depth']]
+
+        call['depth'] = depth
+        call['calling_instruction_id'] = caller_id
+
+        if depth is not None:
+            stack[depth] = call_id
+
+    def set_call_instruction(self, call_id, instruction_id):
+        self.calls[call_id]['instruction_id'] = instruction_id
+
+    def delete_call(self, call_id):
+        call = self.calls.pop(call_id)
+
+        if call['depth'] is not None:
+            del self.stacks[call['thread_id']][call['depth']]
+
+        # Cascade to the frame's locals and conditionals.
+        for local in self.frame_locals.pop(call_id).values():
+            del self.locals[local['id']]
+            self.add_refs(local['address_id'], -1)
+
+        del self.conditionals[call_id]
+
+        # Free the memory owned by the frame.
+        self.free(sorted(self.regions.pop(call_id, [])))
+
+    def push_conditional(self, call_id, satisfied):
+        self.conditionals[call_id].append(satisfied)
+
+    def pop_conditional(self, call_id):
+        self.conditionals[call_id].pop()
+
+    def set_conditional(self, call_id, satisfied):
+        self.conditionals[call_id][-1] = satisfied
+
+    def alloc(self, addr, owner_call_id=None):
+        self.addresses[addr] = {'id': addr, 'type': None, 'val': None,
+                                'refs': 0, 'owner_call_id': owner_call_id}
+        self.garbage.add(addr)
+
+        if owner_call_id is not None:
+            self.regions.setdefault(owner_call_id, set()).add(addr)
+
+    def disown(self, addr):
+        for a in [addr] + list(self.items.get(addr, {}).values()):
+            mem = self.addresses.get(a)
+
+            if mem is not None and mem['owner_call_id'] is not None:
+                self.regions[mem['owner_call_id']].discard(a)
+                mem['owner_call_id'] = None
+
+    def store_address(self, addr, type_, val):
+        mem = self.addresses[addr]
+        mem['type'] = type_
+        mem['val'] = val
+
+    def free(self, addrs):
+        for addr in addrs:
+            mem = self.addresses.pop(addr)
+            self.garbage.discard(addr)
+
+            if mem['owner_call_id'] is not None:
+                self.regions.get(mem['owner_call_id'], set()).discard(addr)
+
+            # Cascade to the items of freed lists.
+            for item in self.items.pop(addr, {}).values():
+                self.add_refs(item, -1)
+
+    def add_refs(self, addr, count):
+        mem = self.addresses.get(addr)
+
+        if mem is None:
+            return
+
+        mem['refs'] += count
+
+        if mem['refs'] == 0:
+            self.garbage.add(addr)
+
+    def insert_local(self, local_id, call_id, label, addr):
+        local = {
+            'id': local_id,
+            'call_id': call_id,
+            'label': label,
+            'address_id': addr,
+        }
+
+        self.locals[local_id] = local
+        self.frame_locals[call_id][label] = local
+
+        self.add_refs(addr, 1)
+
+    def delete_local(self, call_id, label):
+        local = self.frame_locals[call_id].pop(label)
+
+        del self.locals[local['id']]
+
+        self.add_refs(local['address_id'], -1)
+
+    def set_local_address(self, local_id, addr):
+        local = self.locals[local_id]
+
+        self.add_refs(addr, 1)
+        self.add_refs(local['address_id'], -1)
+
+        local['address_id'] = addr
+
+    def store_item(self, list_id, ordinal, addr):
+        items = self.items.setdefault(list_id, {})
+
+        self.add_refs(addr, 1)
+
+        if ordinal in items:
+            self.add_refs(items[ordinal], -1)
+
+        items[ordinal] = addr
+
+    def truncate_items(self, list_id, size):
+        items = self.items.get(list_id, {})
+
+        for ordinal in [o for o in items if o >= size]:
+            self.add_refs(items.pop(ordinal), -1)
+
+    def live_addresses(self):
+        """
+        Get the set of addresses reachable from a local, either directly or
+        through list items.
+
+        """
+
+        ret = set(local['address_id'] for local in self.locals.values())
+        pending = list(ret)
+
+        while len(pending) > 0:
+            for addr in self.items.get(pending.pop(), {}).values():
+                if addr not in ret:
+                    ret.add(addr)
+                    pending.append(addr)
+
+        return ret
+
+
+class MemoryInterpreter(Interpreter):
+    """
+    An interpreter which keeps program state in memory instead of issuing
+    queries for every change. Each commit writes the whole state back to the
+    database (a checkpoint), so commits are usually spread out over many
+    lines with commit_every and/or commit_interval_ms.
+
+    The program itself is still read from the database. On startup any state
+    left by a previous checkpoint (or by the database interpreter) is read
+    back, so a resumed program loses at most the lines run since the last
+    checkpoint.
+
+    """
+
+    def __init__(self, db, stdout_func=None, commit_every=1000,
+                 commit_interval_ms=None, sweep_every=10000,
+                 program_id=default_program_id):
+        super().__init__(db, stdout_func=stdout_func,
+                         commit_every=commit_every,
+                         commit_interval_ms=commit_interval_ms,
+                         sweep_every=sweep_every, program_id=program_id)
+
+        self.state = MemoryState()
+        self.restore()
+
+
+    def mutate(self, op, *args):
+        """
+        Apply a change to the in-memory state.
+
+        """
+
+        self.state.apply(op, *args)
+
+
+    def restore(self):
+        """
+        Read the state written by the last checkpoint from the database.
+
+        """
+
+        self.state.load({
+            table: [tuple(row[c] for c in columns) for row in
+                    self.db.all('select ' + ', '.join(columns) +
+                                ' from ' + table + ' where ' +
+                                program_rows[table] + ';',
+                                (self.program_id,))]
+            for table, columns in state_tables
+        })
+
+
+    def checkpoint(self):
+        """
+        Replace the state stored in the database with the in-memory state and
+        commit.
+
+        """
+
+        dump = self.state.dump()
+
+        for table, columns in reversed(state_tables):
+            self.db.cmd('delete from ' + table + ' where ' +
+                        program_rows[table] + ';',
+                        (self.program_id,))
+
+        for table, columns in state_tables:
+            rows = dump[table]
+
+            if table in program_tables:
+                columns = columns + ['program_id']
+                rows = [row + (self.program_id,) for row in rows]
+
+            self.db.many('insert into ' + table + ' (' + ', '.join(columns) +
+                         ') values (' + ', '.join(['%s' for c in columns]) +
+                         ');',
+                         rows)
+
+        # The free addresses went with the rest of the old state.
+        self.db.cmd("update programs set free_head = 0 where id = %s;",
+                    (self.program_id,))
+
+        self.db.commit()
+
+
+    def commit(self):
+        self.checkpoint()
+
+
+    def rollback(self):
+        # Go back to the state as of the last checkpoint.
+        self.db.rollback()
+
+        self.output = []
+        self.state = MemoryState()
+        self.restore()
+
+
+    def claim_thread(self, thread_id):
+        # Checkpoints replace the whole state, so it can't be shared with
+        # other interpreters and there is nothing to check.
+        pass
+
+
+    def get_main_thread_id(self):
+        return self.state.threads[0] if len(self.state.threads) > 0 else None
+
+
+    def running_thread(self, after=None):
+        running = sorted(thread_id for thread_id, stack
+                         in self.state.stacks.items() if len(stack) > 0)
+
+        for thread_id in running:
+            if after is None or thread_id > after:
+                return thread_id
+
+        return running[0] if len(running) > 0 else None
+
+
+    def create_thread(self):
+        thread_id = self.db.next_id()
+        self.mutate('create_thread', thread_id)
+        return thread_id
+
+
+    def stack_depth(self, thread_id):
+        stack = self.state.stacks[thread_id]
+        return max(stack) if len(stack) > 0 else None
+
+
+    def push_call(self, thread_id, depth, instruction_id, caller_id):
+        call_id = self.db.next_id()
+        self.mutate('push_call', call_id, thread_id, depth, instruction_id,
+                    caller_id)
+        return call_id
+
+
+    def restore_call(self, call_id, depth, caller_id):
+        self.mutate('set_call_depth', call_id, depth, caller_id)
+
+
+    def stash_call(self, call_id):
+        call = self.state.calls[call_id]
+        self.mutate('set_call_depth', call_id, None,
+                    call['calling_instruction_id'])
+
+
+    # Like their SQL counterparts, the methods below do nothing when the frame
+    # they refer to has already been deleted (e.g. advancing the instruction
+    # pointer of a frame which just returned).
+
+    def delete_call(self, call_id):
+        if call_id in self.state.calls:
+            self.mutate('delete_call', call_id)
+
+
+    def set_call_instruction(self, call_id, instruction_id):
+        if call_id in self.state.calls:
+            self.mutate('set_call_instruction', call_id, instruction_id)
+
+
+    def conditional_depth(self, call):
+        return len(self.state.conditionals.get(call['id'], [])) - 1
+
+
+    def push_conditional(self, call, satisfied):
+        self.mutate('push_conditional', call['id'], satisfied)
+
+
+    def pop_conditional(self, call):
+        if self.conditional_depth(call) >= 0:
+            self.mutate('pop_conditional', call['id'])
+
+
+    def read_conditional(self, call):
+        stack = self.state.conditionals.get(call['id'], [])
+        return stack[-1] if len(stack) > 0 else None
+
+
+    def set_conditional(self, call, satisfied):
+        if self.conditional_depth(call) >= 0:
+            self.mutate('set_conditional', call['id'], satisfied)
+
+
+    def current_call(self, thread_id):
+        stack = self.state.stacks.get(thread_id, {})
+
+        if len(stack) == 0:
+            return None
+
+        return dict(self.state.calls[stack[max(stack)]])
+
+
+    def parent_call(self, call):
+        call_id = self.state.stacks[call['thread_id']].get(call['depth'] - 1)
+        return self.get_call(call_id)
+
+
+    def get_call(self, call_id):
+        call = self.state.calls.get(call_id)
+        return None if call is None else dict(call)
+
+
+    def fetch_address(self, addr):
+        mem = self.state.addresses.get(addr)
+        return None if mem is None else dict(mem)
+
+
+    def store_address(self, addr, type_, val):
+        if addr in self.state.addresses:
+            self.mutate('store_address', addr, type_, column_value(val))
+
+
+    def mem_alloc(self, owner_call_id=None):
+        addr = self.db.next_id()
+        self.mutate('alloc', addr, owner_call_id)
+        return addr
+
+
+    def disown_address(self, addr):
+        self.mutate('disown', addr)
+
+
+    def mem_free(self, addrs):
+        addrs = [a for a in addrs if a in self.state.addresses]
+
+        if len(addrs) > 0:
+            self.mutate('free', addrs)
+
+
+    def fetch_local(self, call_id, label):
+        local = self.state.frame_locals.get(call_id, {}).get(label)
+        return None if local is None else dict(local)
+
+
+    def insert_local(self, call_id, label, addr):
+        local_id = self.db.next_id()
+        self.mutate('insert_local', local_id, call_id, label, addr)
+        return local_id
+
+
+    def delete_locals(self, call_id, labels):
+        frame = self.state.frame_locals.get(call_id, {})
+
+        for label in labels:
+            if label in frame:
+                self.mutate('delete_local', call_id, label)
+
+
+    def set_local_address(self, local_id, addr):
+        self.mutate('set_local_address', local_id, addr)
+
+
+    def fetch_item(self, list_id, ordinal):
+        addr = self.state.items.get(list_id, {}).get(int(ordinal))
+
+        if addr is None:
+            return None
+
+        return {
+            'list_id': list_id,
+            'ordinal': int(ordinal),
+            'address_id': addr,
+        }
+
+
+    def store_item(self, list_id, ordinal, addr):
+        self.mutate('store_item', list_id, int(ordinal), addr)
+
+
+    def truncate_items(self, list_id, size):
+        if list_id in self.state.items:
+            self.mutate('truncate_items', list_id, size)
+
+
+    def gc(self):
+        while len(self.state.garbage) > 0:
+            candidates, self.state.garbage = self.state.garbage, set()
+
+            self.mem_free(sorted(a for a in candidates
+                                 if a in self.state.addresses and
+                                 self.state.addresses[a]['refs'] == 0))
+
+
+    def sweep(self):
+        live = self.state.live_addresses()
+
+        self.mem_free(sorted(a for a in self.state.addresses
+                             if a not in live))
@@ -0,0 +1,276 @@
+"""
+Versioned upgrades to the schema of existing program databases.
+
+The schema files (vagrant/glacia.sql and glacia/backends/sqlite.sql) create
+the latest version, so new databases need no migrations. Every change to the
+schema is a migration below, applied in order the first time an older
+database is opened by a process (see migrate()), and is also made to the
+schema files along with their schema_version row. The version a database is
+at is stored in the schema_version table; databases without one are at
+version 1, unless they are older still (see check_version_1()).
+
+Upgrading takes a lock and runs DDL, which on MySQL needs a user allowed to
+alter the schema. Databases which are already current are only read.
+
+A statement is either a query run on every backend or a dict mapping backend
+names to the query to run there (missing backends skip the statement).
+
+"""
+
+
+# (version, description, statements)
+migrations = [
+    (2, 'Index the columns gc() and the address cascades look up', [
+        "create index locals_address_id on locals (address_id);",
+        "create index items_address_id on items (address_id);",
+    ]),
+    (3, 'Reference count addresses', [
+        "alter table addresses add column refs int not null default 0;",
+        "update addresses set refs = " +
+        "(select count(1) from locals where address_id = addresses.id) + " +
+        "(select count(1) from items where address_id = addresses.id);",
+    ]),
+    (4, 'Track the call stack frame owning each address', [
+        {
+            'mysql': "alter table addresses " +
+                     "add column owner_call_id bigint unsigned null;",
+            'sqlite': "alter table addresses " +
+                      "add column owner_call_id integer null;",
+        },
+        "create index addresses_owner_call_id on addresses (owner_call_id);",
+    ]),
+    (5, 'Chain freed addresses into a free list', [
+        {
+            'mysql': "alter table addresses " +
+                     "add column next_free_id bigint unsigned null;",
+            'sqlite': "alter table addresses " +
+                      "add column next_free_id integer null;",
+        },
+        "insert into sequences (name, next_id) values ('free_addresses', 0);",
+    ]),
+    (6, 'Lease threads to scheduler workers', [
+        "alter table threads add column lease_owner varchar(64) null;",
+        "alter table threads add column lease_expires bigint null;",
+    ]),
+    (7, 'Scope programs and their state to namespaces', [
+        # The load counter and free list head move from sequences to each
+        # program. Existing state belongs to the default program, ID 0.
+        {
+            'mysql': "create table programs (" +
+                     "id bigint unsigned, name varchar(255), " +
+                     "version bigint unsigned not null default 0, " +
+                     "free_head bigint unsigned not null default 0, " +
+                     "status varchar(16) not null default 'loaded', " +
+                     "lines_run bigint unsigned not null default 0, " +
+                     "submitted_at bigint null, started_at bigint null, " +
+                     "finished_at bigint null, error text null, " +
+                     "primary key (id), unique (name));",
+            'sqlite': "create table programs (" +
+                      "id integer, name varchar(255), " +
+                      "version integer not null default 0, " +
+                      "free_head integer not null default 0, " +
+                      "status varchar(16) not null default 'loaded', " +
+                      "lines_run integer not null default 0, " +
+                      "submitted_at integer null, started_at integer null, " +
+                      "finished_at integer null, error text null, " +
+                      "primary key (id), unique (name));",
+        },
+        "insert into programs (id, name, version, free_head) " +
+        "select 0, 'default', " +
+        "(select next_id from sequences where name = 'loads'), " +
+        "(select next_id from sequences where name = 'free_addresses');",
+        "delete from sequences where name in ('loads', 'free_addresses');",
+
+        # Function labels are only unique within a program. SQLite can't
+        # drop a unique constraint, so the table is rebuilt there.
+        {
+            'mysql': "alter table functions " +
+                     "add column program_id bigint unsigned not null " +
+                     "default 0, drop index label, " +
+                     "add unique (program_id, label);",
+            'sqlite': "create table functions_new (" +
+                      "id integer, program_id integer not null default 0, " +
+                      "label varchar(255), return_type varchar(255), " +
+                      "arguments text, code_hash char(64) null, " +
+                      "primary key (id), unique (program_id, label));",
+        },
+        {
+            'sqlite': "insert into functions_new " +
+                      "(id, label, return_type, arguments, code_hash) " +
+                      "select id, label, return_type, arguments, code_hash " +
+                      "from functions;",
+        },
+        {'sqlite': "drop table functions;"},
+        {'sqlite': "alter table functions_new rename to functions;"},
+
+        {
+            'mysql': "alter table threads " +
+                     "add column program_id bigint unsigned not null " +
+                     "default 0;",
+            'sqlite': "alter table threads " +
+                      "add column program_id integer not null default 0;",
+        },
+        "create index threads_program_id on threads (program_id);",
+        {
+            'mysql': "alter table addresses " +
+                     "add column program_id bigint unsigned not null " +
+                     "default 0;",
+            'sqlite': "alter table addresses " +
+                      "add column program_id integer not null default 0;",
+        },
+        "create index addresses_program_id on addresses (program_id);",
+    ]),
+    (8, 'Add the shard directory', [
+        "create table placements (" +
+        "name varchar(255), shard varchar(255), " +
+        "primary key (name));",
+        "create index placements_shard on placements (shard);",
+    ]),
+    (9, 'Version threads, calls and addresses', [
+        {
+            'mysql': "alter table threads " +
+                     "add column version bigint unsigned not null default 0;",
+            'sqlite': "alter table threads " +
+                      "add column version integer not null default 0;",
+        },
+        {
+            'mysql': "alter table calls " +
+                     "add column version bigint unsigned not null default 0;",
+            'sqlite': "alter table calls " +
+                      "add column version integer not null default 0;",
+        },
+        {
+            'mysql': "alter table addresses " +
+                     "add column version bigint unsigned not null default 0;",
+            'sqlite': "alter table addresses " +
+                      "add column version integer not null default 0;",
+        },
+    ]),
+    (10, 'Map the IDs of rows being forked', [
+        {
+            'mysql': "create table fork_ids (" +
+                     "program_id bigint unsigned, old_id bigint unsigned, " +
+                     "new_id bigint unsigned, " +
+                     "primary key (program_id, old_id));",
+            'sqlite': "create table fork_ids (" +
+                      "program_id integer, old_id integer, " +
+                      "new_id integer, " +
+                      "primary key (program_id, old_id));",
+        },
+    ]),
+]
+
+
+latest_version = migrations[-1][0]
+
+
+# Backend keys whose schema is known to be up to date in this process.
+migrated = set()
+
+
+def schema_version(db):
+    """
+    Read the schema version of a database without changing it.
+
+    Returns:
+        The version, or None if the database has no schema_version table
+        (or row) yet.
+
+    """
+
+    if not db.backend.has_table('schema_version'):
+        return None
+
+    return db.scalar("select version from schema_version;")
+
+
+def check_version_1(db):
+    """
+    Make sure a database without a schema version is at version 1 before
+    migrating it.
+
+    Version 1 is the first schema with integer IDs, the sequences table and
+    the per-function hashes, which is where the 'loads' sequence comes from.
+    Earlier databases (with random 3-character IDs, or from partway through
+    the change to integer IDs) have no migrations: their state refers to
+    rows in ways which can't be converted, so their programs have to be
+    loaded from source into a new database.
+
+    Raises:
+        Exception: The database is older than version 1.
+
+    """
+
+    if not db.backend.has_table('sequences') or \
+       db.scalar("select next_id from sequences where name = 'loads';") \
+       is None:
+        raise Exception('The database predates schema versions and can\'t ' +
+                        'be upgraded. Create a new database and load the ' +
+                        'programs into it from source.')
+
+
+def migrate(db):
+    """
+    Bring a database's schema up to date, applying the migrations it is
+    missing in one transaction (MySQL commits each DDL statement on its own,
+    so there the version is updated after each migration instead).
+
+    Arguments:
+        db (Database): The database to upgrade.
+
+    Returns:
+        The schema version of the database.
+
+    """
+
+    key = db.backend.key()
+
+    if key in migrated:
+        return latest_version
+
+    if schema_version(db) == latest_version:
+        migrated.add(key)
+        return latest_version
+
+    # Another process may be upgrading the same database, so take a lock and
+    # read the version again once holding it.
+    db.backend.lock_schema()
+
+    try:
+        version = schema_version(db)
+
+        if version is None:
+            check_version_1(db)
+
+            version = 1
+            db.cmd("create table if not exists schema_version " +
+                   "(version int not null);")
+            db.cmd("insert into schema_version (version) values (%s);",
+                   (version,))
+
+        if version > latest_version:
+            raise Exception('Database schema version ' + str(version) +
+                            ' is newer than this version of glacia supports.')
+
+        for target, description, statements in migrations:
+            if target <= version:
+                continue
+
+            for statement in statements:
+                if isinstance(statement, dict):
+                    statement = statement.get(db.backend.name)
+
+                if statement is not None:
+                    db.cmd(statement)
+
+            db.cmd("update schema_version set version = %s;", (target,))
+
+            version = target
+
+        db.commit()
+    finally:
+        db.backend.unlock_schema()
+
+    migrated.add(key)
+
+    return version
@@ -127,7 +127,7 @@ def __parse(ts):
             elif token.val == '}':
                 if len(ret.nodes) > 0 or len(ret.tokens) > 0:
                     yield ret
-                raise StopIteration
+                return
 
         # Semicolons delimit instructions
         elif token.kind == 'semicolon':
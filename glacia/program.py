@@ -0,0 +1,181 @@
+import json
+import time
+import threading
+
+
+# The program used when none is named. Every program in a database has its
+# own functions and state, in a namespace identified by its row in the
+# programs table.
+default_program_id = 0
+
+
+class ProgramCache(object):
+    """
+    The functions and instructions of a loaded program, read from the
+    database once and indexed for the lookups the interpreter makes on every
+    line. The JSON in the code, loops and arguments columns is decoded up
+    front.
+
+    Programs never change after load(), so the cache is only rebuilt when a
+    new program is loaded. The dicts returned are shared and must be treated
+    as read-only.
+
+    Arguments:
+        db (Database): The database to read the program from.
+        version (int): The program_version() the cache was built from.
+        program_id (int): The program to read.
+
+    """
+
+    def __init__(self, db, version, program_id=default_program_id):
+        self.version = version
+
+        self.functions = {}
+        self.instructions = {}
+
+        # Index of instructions by the instruction they follow (previous_id)
+        # and of the first instruction in each block by its parent.
+        self.next = {}
+        self.first_child = {}
+
+        # The first instruction of each function, by function ID.
+        self.entries = {}
+
+        # Instructions by (function_id, label).
+        self.labels = {}
+
+        for function in db.all("select * from functions " +
+                               "where program_id = %s;", (program_id,)):
+            function['arguments'] = json.loads(function['arguments'])
+            self.functions[function['label']] = function
+
+        for inst in db.all("select instructions.* from instructions " +
+                           "join functions " +
+                           "on functions.id = instructions.function_id " +
+                           "where functions.program_id = %s;",
+                           (program_id,)):
+            inst['code'] = json.loads(inst['code'])
+
+            if inst['loops'] is not None:
+                inst['loops'] = json.loads(inst['loops'])
+            self.instructions[inst['id']] = inst
+
+            if inst['previous_id'] is not None:
+                self.next[inst['previous_id']] = inst
+            elif inst['parent_id'] is not None:
+                self.first_child[inst['parent_id']] = inst
+            else:
+                self.entries[inst['function_id']] = inst
+
+            if inst['label'] is not None:
+                self.labels.setdefault((inst['function_id'], inst['label']),
+                                       inst)
+
+    def function(self, label):
+        """
+        Look up a function by name.
+
+        """
+
+        ret = self.functions.get(label)
+
+        if ret is None:
+            raise Exception('Function not found: ' + str(label))
+
+        return ret
+
+    def instruction(self, instruction_id):
+        return self.instructions.get(instruction_id)
+
+    def step_over(self, instruction_id):
+        return self.next.get(instruction_id)
+
+    def step_into(self, instruction_id):
+        return self.first_child.get(instruction_id)
+
+    def entry(self, function_id):
+        return self.entries.get(function_id)
+
+    def by_label(self, function_id, label):
+        return self.labels.get((function_id, label))
+
+
+# Program caches by Backend.key() and program ID, shared by every interpreter
+# in the process.
+caches = {}
+caches_lock = threading.Lock()
+
+
+def program_version(db, program_id=default_program_id):
+    """
+    Identify the code currently loaded into a program. This changes whenever
+    load() runs, even in another process.
+
+    """
+
+    return db.scalar("select version from programs where id = %s;",
+                     (program_id,))
+
+
+def program_cache(db, program_id=default_program_id):
+    """
+    Get the cached code of a program, building it if the program has changed
+    since it was last cached.
+
+    """
+
+    key = (db.backend.key(), program_id)
+    version = program_version(db, program_id)
+
+    with caches_lock:
+        cache = caches.get(key)
+
+    if cache is None or cache.version != version:
+        cache = ProgramCache(db, version, program_id)
+
+        with caches_lock:
+            caches[key] = cache
+
+    return cache
+
+
+def invalidate(db, program_id=default_program_id):
+    """
+    Drop the cached code of a program (called by load()).
+
+    """
+
+    with caches_lock:
+        caches.pop((db.backend.key(), program_id), None)
+
+
+def find_program(db, name):
+    """
+    Look up a program by name.
+
+    Returns:
+        The program ID, or None if there is no such program.
+
+    """
+
+    return db.scalar("select id from programs where name = %s;", (name,))
+
+
+def create_program(db, name, status='loaded'):
+    """
+    Create an empty program namespace. Code is loaded into it with load().
+
+    Arguments:
+        db (Database): The database to create the program in.
+        name (str): A name for the program, unique in the database.
+        status (str): 'loaded' for a program run directly, or 'queued' for a
+                      job to be run by a job pool (see glacia.jobs).
+
+    Returns:
+        The new program ID.
+
+    """
+
+    return db.autoid("insert into programs (id, name, status, submitted_at) " +
+                     "values (%s, %s, %s, %s);",
+                     (name, status, int(time.time() * 1000)))
@@ -23,7 +23,7 @@ def reduce(program, state):
     :return: None
     """
     for function in program.functions:
-        reduce_block(function.body, state)
+        reduce_block(function.body, state.function(function.name))
 
 
 def reduce_block(instructions, state):
@@ -85,7 +85,7 @@ def extract_calls(instruction, state):
             if deepest is None or \
                (instruction.kind in ['assignment', 'expression']
                 and total == 1 and len(tokens) == 1):
-                raise StopIteration
+                return
 
             # Replace the call with a temporary variable and yield the call
             # as a separate assignment instruction.
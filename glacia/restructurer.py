@@ -10,7 +10,7 @@ def restructure(program, state):
 
     """
     for function in program.functions:
-        restructure_block(function.body, state)
+        restructure_block(function.body, state.function(function.name))
 
 
 def restructure_block(instructions, state):
@@ -1,26 +1,29 @@
-import json
-
-from glacia.debug import divider, print_tokens, print_nodes, print_program, \
-                         print_db
-from glacia import Database, close_after, CompilerState
-from glacia.preprocessor import preprocess
-from glacia.lexer import lex
-from glacia.parser import parse
-from glacia.semantics import analyze
-from glacia.restructurer import restructure
-from glacia.reducer import reduce
-from glacia.parameterizer import parameterize
-from glacia.generator import generate
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, \
+                               FIRST_COMPLETED
+
+from glacia.debug import divider, print_db
+from glacia import Database, close_after
+from glacia.image import read_image, source_hash, default_cache_dir
 from glacia.loader import load
+from glacia.program import default_program_id, find_program, create_program
 from glacia.interpreter import interpret, Interpreter
+from glacia.memory import MemoryInterpreter
+from glacia.eventlog import LogInterpreter
+from glacia.scheduler import Scheduler
+from glacia.shards import ShardMap, shard_options
 
 
-def run(fn=None, src=None, exec_lines=-1, verbose=False, collect_stdout=False):
+def run(fn=None, src=None, exec_lines=-1, verbose=False, collect_stdout=False,
+        backend=None, db_path=None, engine='db', commit_every=None,
+        commit_interval_ms=None, log_path='glacia.log', compact_lines=None,
+        image=None, cache_dir=default_cache_dir(), sweep_every=None,
+        workers=None, program=None, shards=None):
     """
     Helper function for various uses of the glacia interpreter.
 
-    Either fn or src must be specified to load a new program. If neither is
-    present, the existing program in the database will be resumed.
+    One of fn, src or image must be specified to load a new program. If none
+    is present, the existing program in the database will be resumed.
 
     Arguments:
         fn (str): If present, the filename of the source code to load.
@@ -31,69 +34,128 @@ def run(fn=None, src=None, exec_lines=-1, verbose=False, collect_stdout=False):
         verbose (bool): Whether to print extra information.
         collect_stdout (bool): Whether to collect and return the output of the
                                program.
+        backend (str): The storage backend to use ('mysql' or 'sqlite'). If
+                       None, the backend from the config file is used.
+        db_path (str): The database file to use with the sqlite backend.
+        engine (str): 'db' to keep program state in the database at all
+                      times, 'memory' to keep it in memory and checkpoint it
+                      to the database periodically, or 'log' to keep it in
+                      memory and append every change to a log file.
+        commit_every (int): The number of lines to run between commits
+                            (checkpoints for the memory engine, log fsyncs
+                            for the log engine). If None, the engine's
+                            default is used.
+        commit_interval_ms (int): If present, also commit once this many
+                                  milliseconds have passed since the last
+                                  commit.
+        log_path (str): The log file used by the log engine.
+        compact_lines (int): The number of lines between log compactions for
+                             the log engine. If None, the default is used.
+        image (str): If present, the filename of a compiled image (from
+                     glacia.image.write_image()) to load.
+        cache_dir (str): The compile cache directory, or None to always
+                         compile.
+        sweep_every (int): The number of lines between full sweeps of memory
+                           (reference counting frees memory on its own). If
+                           None, the default is used.
+        workers (int): If present, run the program's threads in parallel
+                       across this many worker processes (see
+                       glacia.scheduler) instead of in this process. Only
+                       the db engine can run threads in parallel, and the
+                       program is run to the end.
+        program (str): If present, the name of the program to load or
+                       resume. A database holds any number of named programs
+                       alongside the default one, each with its own state.
+        shards (list): If present, the program is placed on one of these
+                       databases (sqlite files, or config file sections for
+                       mysql) and the database given by backend and db_path
+                       only records where (see glacia.shards). program must
+                       be present.
 
     """
 
-    if fn is not None and src is not None:
-        raise Exception("fn and src cannot both be present.")
+    if len([a for a in (fn, src, image) if a is not None]) > 1:
+        raise Exception("Only one of fn, src and image can be present.")
 
-    # Read the file if needed.
-    if src is None and fn is not None:
-        with open(fn, 'rb') as f:
-            src = f.read().decode('utf-8')
+    if workers is not None and (engine != 'db' or collect_stdout):
+        raise Exception("Workers only run the db engine and can't collect "
+                        "stdout.")
 
-    # Compile and load the program if needed.
-    if src is not None:
-        state = CompilerState()
+    if shards is not None and program is None:
+        raise Exception("A sharded program must be named.")
 
-        if verbose:
-            divider('Source code')
-            print(src)
+    # The database holding the program: the main database, or the shard the
+    # program is placed on.
+    def shard(create=False):
+        if shards is None:
+            return {'backend': backend, 'path': db_path, 'section': 'db'}
 
-        src = preprocess(src)
-        if verbose:
-            divider('Preprocessed.')
-            print(src)
+        with close_after(Database(backend, db_path)) as directory:
+            return shard_options(ShardMap(directory, shards, backend).locate(
+                program, create=create), backend)
 
-            divider('Partially lexed (still with whitespace)')
-        tokens = lex(src, preserve_whitespace=True)
-        if verbose:
-            print(print_tokens(tokens))
+    def program_id(conn, create=False):
+        if program is None:
+            return default_program_id
 
-            divider('Lexed')
-        tokens = lex(src)
-        if verbose:
-            print(print_tokens(tokens,identifier_color='switch',line_width=60))
+        ret = find_program(conn, program)
 
-        nodes = parse(tokens)
-        if verbose:
-            divider('Parsed')
-            print(print_nodes(nodes).strip())
+        if ret is None:
+            if not create:
+                raise Exception('Program not found: ' + program)
 
-        program = analyze(nodes)
-        if verbose:
-            divider('Analyzed')
-            print(print_program(program))
+            ret = create_program(conn, program)
 
-        def run_stage(label, func):
-            func(program, state)
-            if verbose:
-                divider(label)
-                print(print_program(program))
+        return ret
+
+    def make_interpreter(conn, stdout_func=None):
+        options = {'stdout_func': stdout_func,
+                   'program_id': program_id(conn)}
+        if commit_every is not None:
+            options['commit_every'] = commit_every
+        if commit_interval_ms is not None:
+            options['commit_interval_ms'] = commit_interval_ms
+        if sweep_every is not None:
+            options['sweep_every'] = sweep_every
+
+        if engine == 'log':
+            if compact_lines is not None:
+                options['compact_lines'] = compact_lines
+
+            return LogInterpreter(conn, log_path, **options)
 
-        run_stage('Restructured', restructure)
-        run_stage('Reduced', reduce)
-        run_stage('Parameterized', parameterize)
+        if engine == 'memory':
+            return MemoryInterpreter(conn, **options)
 
-        generated = generate(program)
+        return Interpreter(conn, **options)
 
-        with close_after(Database()) as conn:
-            load(conn, generated)
+    # Read the file if needed.
+    if src is None and fn is not None:
+        with open(fn, 'rb') as f:
+            src = f.read().decode('utf-8')
+
+    # Compile and load the program if needed.
+    if src is not None or image is not None:
+        if image is not None:
+            generated = read_image(image)
+        else:
+            # Loading an image doesn't need the compiler frontend.
+            from glacia.compiler import compile_source
+
+            generated = compile_source(src, verbose=verbose,
+                                       cache_dir=cache_dir)
+
+        with close_after(Database(**shard(create=True))) as conn:
+            loaded = load(conn, generated, program_id(conn, create=True))
             if verbose:
                 divider('Loaded DBIL')
                 print(print_db(conn))
+                print('Loaded %d functions (%d unchanged) and %d '
+                      'instructions in %.3fs.' %
+                      (loaded['functions'], loaded['unchanged'],
+                       loaded['instructions'], loaded['seconds']))
 
-            interpreter = Interpreter(conn)
+            interpreter = make_interpreter(conn)
             interpreter.start()
 
     # Run the program.
@@ -109,19 +171,184 @@ def run(fn=None, src=None, exec_lines=-1, verbose=False, collect_stdout=False):
         if collect_stdout:
             stdout_func = collect_func
 
-        with close_after(Database()) as conn:
-            interpreter = Interpreter(conn, stdout_func=stdout_func)
+        if workers is not None:
+            options = {}
+            if commit_every is not None:
+                options['commit_every'] = commit_every
+            if commit_interval_ms is not None:
+                options['commit_interval_ms'] = commit_interval_ms
+
+            location = shard()
+
+            with close_after(Database(**location)) as conn:
+                scheduled_id = program_id(conn)
+
+            Scheduler(location['backend'], location['path'], workers=workers,
+                      options=options, program_id=scheduled_id,
+                      section=location['section']).run()
+            return
+
+        with close_after(Database(**shard())) as conn:
+            interpreter = make_interpreter(conn, stdout_func=stdout_func)
 
             if exec_lines < 0:
                 interpreter.run()
             else:
-                for i in range(exec_lines):
-                    if not interpreter.run_one_line():
-                        break
+                try:
+                    for i in range(exec_lines):
+                        if not interpreter.run_one_line():
+                            break
+                except:
+                    interpreter.rollback()
+                    raise
+
+                interpreter.flush()
 
         if collect_stdout:
             return collected
 
 
+def run_batch(fns=None, srcs=None, backend=None, db_path=None, concurrency=8,
+              prefix='batch', commit_every=None, commit_interval_ms=None,
+              sweep_every=None, cache_dir=default_cache_dir()):
+    """
+    Run many programs to completion in parallel, yielding the result of each
+    as it finishes.
+
+    Each source is compiled once however many programs share it. Programs
+    are compiled and submitted at most concurrency * 2 ahead of the ones
+    finished, so the first results come out without waiting for the whole
+    batch to compile. Programs are loaded into and run in their own
+    namespaces, named prefix-N after their index, so running a batch again
+    reuses them. Connections are taken from the process-wide pool and
+    returned after each program.
+
+    Arguments:
+        fns (list): Filenames of source code to run.
+        srcs (list): Source code to run, after the files.
+        backend (str): The storage backend to use. If None, the backend from
+                       the config file is used.
+        db_path (str): The database file for file-based backends.
+        concurrency (int): The most programs run at once.
+        prefix (str): The start of the program names. Batches run at the
+                      same time against one database need different
+                      prefixes.
+        commit_every (int): Lines to run between commits (see run()).
+        commit_interval_ms (int): See run().
+        sweep_every (int): See run().
+        cache_dir (str): The compile cache directory, or None to always
+                         compile.
+
+    Returns:
+        A generator of dicts, one per program in the order they finish, with
+        the keys index (in fns followed by srcs), fn (None for srcs), name,
+        program_id, output (a list of printed values), lines, queries (run
+        by the program's connection), seconds (to load and run the program)
+        and error (None unless compiling or running the program failed).
+
+    """
+
+    # Imported here rather than with the rest, as run() only needs the
+    # compiler for sources, not images.
+    from glacia.compiler import compile_source
+
+    fns = fns if fns is not None else []
+    srcs = srcs if srcs is not None else []
+
+    options = {}
+    if commit_every is not None:
+        options['commit_every'] = commit_every
+    if commit_interval_ms is not None:
+        options['commit_interval_ms'] = commit_interval_ms
+    if sweep_every is not None:
+        options['sweep_every'] = sweep_every
+
+    def run_program(result, generated):
+        start = time.time()
+
+        with close_after(Database(backend, db_path)) as conn:
+            # Opening the database may have run queries of its own.
+            queries = conn.backend.queries
+
+            try:
+                program_id = result['program_id']
+
+                load(conn, generated, program_id)
+
+                interpreter = Interpreter(conn, program_id=program_id,
+                                          stdout_func=result['output'].append,
+                                          **options)
+                interpreter.start()
+
+                # Once run_one_line() returns False there was nothing left to
+                # run, so only the lines before that are counted.
+                try:
+                    while interpreter.run_one_line():
+                        result['lines'] += 1
+                except:
+                    interpreter.rollback()
+                    raise
+
+                interpreter.flush()
+            except Exception as e:
+                conn.rollback()
+                result['error'] = str(e)
+
+            result['queries'] = conn.backend.queries - queries
+
+        result['seconds'] = time.time() - start
+
+        return result
+
+    compiled = {}
+
+    # The database is opened here first, so the schema is created and
+    # upgraded before any program runs.
+    with close_after(Database(backend, db_path)) as db, \
+         ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = set()
+
+        for index, source in enumerate([(fn, None) for fn in fns] +
+                                       [(None, src) for src in srcs]):
+            fn, src = source
+
+            result = {'index': index, 'fn': fn,
+                      'name': prefix + '-' + str(index), 'program_id': None,
+                      'output': [], 'lines': 0, 'queries': 0, 'seconds': 0.0,
+                      'error': None}
+
+            try:
+                if fn is not None:
+                    with open(fn, 'rb') as f:
+                        src = f.read().decode('utf-8')
+
+                key = source_hash(src)
+
+                if key not in compiled:
+                    compiled[key] = compile_source(src, cache_dir=cache_dir)
+
+                result['program_id'] = find_program(db, result['name'])
+
+                if result['program_id'] is None:
+                    result['program_id'] = create_program(db, result['name'])
+                    db.commit()
+            except Exception as e:
+                result['error'] = str(e)
+                yield result
+                continue
+
+            pending.add(executor.submit(run_program, result, compiled[key]))
+
+            # Wait for a program to finish before submitting more.
+            if len(pending) >= concurrency * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    yield future.result()
+
+        for future in as_completed(pending):
+            yield future.result()
+
+
 if __name__ == '__main__':
     run(fn='/vagrant/temp/first.glacia', verbose=True)
@@ -0,0 +1,278 @@
+"""
+Runs the threads of a loaded program in parallel across worker processes.
+
+Each worker leases a running thread, runs a time slice of it with its own
+Interpreter, commits and hands the thread back. Leases are held in the
+threads table: lease_owner is the worker running the thread and
+lease_expires when the lease runs out, after which another worker may take
+the thread over (e.g. if the worker died). Once a thread is handed back,
+lease_expires is when that happened, so threads are leased round robin.
+
+"""
+
+import os
+import time
+import socket
+import multiprocessing
+
+from glacia import Database, close_after
+from glacia.interpreter import Interpreter
+from glacia.program import default_program_id
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+# Threads with a frame on their call stack which no worker holds a lease on.
+leasable = ("(lease_owner is null or lease_expires < %s) and exists " +
+            "(select 1 from calls where calls.thread_id = threads.id " +
+            "and calls.depth is not null)")
+
+def program_scope(program_id):
+    """
+    Build a condition on threads for the threads of a program, or of every
+    job admitted to run if program_id is None (see glacia.jobs).
+
+    Returns:
+        A tuple (condition, query arguments).
+
+    """
+
+    if program_id is None:
+        return ("threads.program_id in " +
+                "(select id from programs where status = 'running')", ())
+
+    return ("threads.program_id = %s", (program_id,))
+
+
+def lease_thread(db, worker_id, lease_ms, program_id=default_program_id):
+    """
+    Lease the running thread which has waited longest for a worker, and
+    commit.
+
+    Arguments:
+        db (Database): The database holding the program.
+        worker_id (str): The worker taking the lease.
+        lease_ms (int): How long the lease lasts.
+        program_id (int): The program to lease a thread of, or None for any
+                          running job.
+
+    Returns:
+        A tuple (thread ID, program ID), or None if every running thread is
+        leased.
+
+    """
+
+    now = now_ms()
+    scope, scope_args = program_scope(program_id)
+
+    if db.backend.skip_locked:
+        ret = db.row("select id, program_id from threads where " + leasable +
+                     " and " + scope + " order by lease_expires, id " +
+                     "limit 1 for update skip locked;",
+                     (now,) + scope_args)
+
+        if ret is not None:
+            db.cmd("update threads set lease_owner = %s, lease_expires = %s " +
+                   "where id = %s;",
+                   (worker_id, now + lease_ms, ret[0]))
+
+    # Without row locks (SQLite), claim the thread with a single update,
+    # which is atomic.
+    else:
+        db.cmd("update threads set lease_owner = %s, lease_expires = %s " +
+               "where id = (select id from threads where " + leasable +
+               " and " + scope + " order by lease_expires, id limit 1);",
+               (worker_id, now + lease_ms, now) + scope_args)
+
+        ret = db.row("select id, program_id from threads " +
+                     "where lease_owner = %s;",
+                     (worker_id,))
+
+    db.commit()
+
+    return tuple(ret) if ret is not None else None
+
+
+def release_thread(db, thread_id, worker_id):
+    """
+    Hand a leased thread back, and commit.
+
+    """
+
+    db.cmd("update threads set lease_owner = null, lease_expires = %s " +
+           "where id = %s and lease_owner = %s;",
+           (now_ms(), thread_id, worker_id))
+
+    db.commit()
+
+
+def running_threads(db, program_id=default_program_id):
+    """
+    Count the threads with a frame on their call stack, leased or not, in a
+    program or (if program_id is None) in every running job.
+
+    """
+
+    scope, scope_args = program_scope(program_id)
+
+    return db.scalar("select count(distinct calls.thread_id) from calls " +
+                     "join threads on threads.id = calls.thread_id " +
+                     "where calls.depth is not null and " + scope + ";",
+                     scope_args)
+
+
+def run_slice(interpreter, thread_id, slice_lines, slice_ms):
+    """
+    Run a thread for up to slice_lines lines or slice_ms milliseconds, and
+    commit. If a line fails, it is rolled back and the error raised.
+
+    Arguments:
+        interpreter (Interpreter): The interpreter of the thread's program.
+        thread_id (int): The thread to run, or None to run every running
+                         thread of the program in turn.
+        slice_lines (int): The most lines to run.
+        slice_ms (int): How long to run for.
+
+    Returns:
+        A tuple (lines run, whether there are more lines to be run).
+
+    """
+
+    deadline = time.monotonic() + slice_ms / 1000
+    lines = 0
+    more = True
+
+    try:
+        while lines < slice_lines:
+            more = interpreter.run_one_line(thread_id)
+            lines += 1
+
+            if not more or time.monotonic() >= deadline:
+                break
+    except:
+        # Don't commit a partially-run line.
+        interpreter.rollback()
+        raise
+
+    interpreter.flush()
+
+    return lines, more
+
+
+def work(backend, db_path, section, program_id, options, slice_lines,
+         lease_ms, poll_ms):
+    """
+    The main loop of a worker process: lease threads and run them until no
+    thread is left running.
+
+    Arguments:
+        backend (str): The storage backend to use.
+        db_path (str): The database file for file-based backends.
+        section (str): The config file section with connection settings.
+        program_id (int): The program to run.
+        options (dict): Interpreter options (commit_every etc).
+        slice_lines (int): The most lines to run before handing a thread
+                           back.
+        lease_ms (int): How long a lease lasts. A slice also ends once half
+                        of the lease has passed.
+        poll_ms (int): How long to wait when every running thread is leased.
+
+    """
+
+    worker_id = socket.gethostname() + ':' + str(os.getpid())
+
+    with close_after(Database(backend, db_path, pooled=False,
+                              section=section)) as db:
+        # Other workers hold free addresses a sweep would hand out again, so
+        # only reference counting frees memory here.
+        interpreter = Interpreter(db, sweep_every=None,
+                                  program_id=program_id, **options)
+
+        while True:
+            leased = lease_thread(db, worker_id, lease_ms, program_id)
+
+            if leased is None:
+                if running_threads(db, program_id) == 0:
+                    break
+
+                time.sleep(poll_ms / 1000)
+                continue
+
+            thread_id = leased[0]
+
+            try:
+                run_slice(interpreter, thread_id, slice_lines, lease_ms / 2)
+            finally:
+                release_thread(db, thread_id, worker_id)
+
+
+class Scheduler(object):
+    """
+    Runs the threads of a loaded program across worker processes until no
+    thread is left running. Threads take turns on the workers a time slice
+    at a time, so a program can use as many cores as it has threads.
+
+    Workers run the db engine: the memory and log engines keep program
+    state inside a single process.
+
+    Arguments:
+        backend (str): The storage backend to use. If None, the backend from
+                       the config file is used.
+        db_path (str): The database file for file-based backends.
+        workers (int): The number of worker processes. If None, one per CPU.
+        slice_lines (int): The most lines a worker runs in a thread before
+                           handing it back.
+        lease_ms (int): How long a worker's lease on a thread lasts before
+                        another worker may take the thread over.
+        poll_ms (int): How long an idle worker waits before looking for a
+                       thread again.
+        options (dict): Options for each worker's Interpreter (commit_every,
+                        commit_interval_ms).
+        program_id (int): The program to run.
+        section (str): The config file section to read connection settings
+                       from (see Database).
+
+    """
+
+    def __init__(self, backend=None, db_path=None, workers=None,
+                 slice_lines=100, lease_ms=60000, poll_ms=10, options=None,
+                 program_id=default_program_id, section='db'):
+        self.backend = backend
+        self.db_path = db_path
+        self.section = section
+        self.program_id = program_id
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.slice_lines = slice_lines
+        self.lease_ms = lease_ms
+        self.poll_ms = poll_ms
+        self.options = options if options is not None else {}
+
+
+    def run(self):
+        """
+        Start the workers and wait for them to finish.
+
+        """
+
+        # Spawn rather than fork, so workers don't share the parent's pooled
+        # connections.
+        context = multiprocessing.get_context('spawn')
+
+        processes = [context.Process(target=work, args=(
+            self.backend, self.db_path, self.section, self.program_id,
+            self.options, self.slice_lines, self.lease_ms, self.poll_ms))
+            for i in range(self.workers)]
+
+        for process in processes:
+            process.start()
+
+        for process in processes:
+            process.join()
+
+        failed = [p for p in processes if p.exitcode != 0]
+
+        if len(failed) > 0:
+            raise Exception(str(len(failed)) + ' of ' + str(len(processes)) +
+                            ' workers failed.')
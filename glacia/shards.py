@@ -0,0 +1,160 @@
+"""
+Spreads programs across several databases (shards).
+
+Each program lives entirely on one shard: its code and all of its threads,
+frames and memory. Threads of a program share memory (lists passed to
+spawn()), so a program is the smallest unit that can be placed without
+queries joining across databases. The interpreter, loader and job pool work
+on the shard's Database as they would on any other, unaware of placement.
+
+Which shard holds a program is recorded in the placements table of a
+directory database (usually the main database). A new program goes to the
+shard holding the fewest programs. Shards can be added at any time;
+programs already placed stay where they are.
+
+"""
+
+from glacia import Database, config_get
+
+
+class ShardMap(object):
+    """
+    Places programs on shards and opens the database holding a program.
+
+    Arguments:
+        directory (Database): The database holding the placements table.
+        shards (list): The shards. For the sqlite backend each shard is a
+                       database file; for mysql, a section of the config
+                       file with the same settings as [db].
+        backend (str): The storage backend of the shards. If None, the
+                       backend from the config file is used.
+
+    """
+
+    def __init__(self, directory, shards, backend=None):
+        if len(shards) == 0:
+            raise Exception('At least one shard is needed.')
+
+        self.directory = directory
+        self.shards = list(shards)
+        self.backend = backend
+
+
+    def shard(self, name):
+        """
+        Look up the shard holding a program.
+
+        Returns:
+            The shard, or None if the program hasn't been placed.
+
+        """
+
+        return self.directory.scalar("select shard from placements " +
+                                     "where name = %s;",
+                                     (name,))
+
+
+    def place(self, name):
+        """
+        Get the shard holding a program, placing the program on the least
+        used shard if it has none yet, and commit.
+
+        Returns:
+            The shard.
+
+        """
+
+        ret = self.shard(name)
+
+        if ret is not None:
+            return ret
+
+        counts = self.placements()
+
+        ret = min(self.shards, key=lambda s: counts[s])
+
+        try:
+            self.directory.cmd("insert into placements (name, shard) " +
+                               "values (%s, %s);",
+                               (name, ret))
+            self.directory.commit()
+        except self.directory.backend.IntegrityError:
+            # Placed by another process in the meantime.
+            self.directory.rollback()
+            ret = self.shard(name)
+
+        return ret
+
+
+    def locate(self, name, create=False):
+        """
+        Get the shard holding a program.
+
+        Arguments:
+            name (str): The program name.
+            create (bool): Whether to place the program if it hasn't been
+                           placed yet.
+
+        Returns:
+            The shard.
+
+        """
+
+        ret = self.place(name) if create else self.shard(name)
+
+        if ret is None:
+            raise Exception('Program not found: ' + name)
+
+        return ret
+
+
+    def open(self, name, create=False, pooled=True):
+        """
+        Open the database holding a program (see locate()).
+
+        Returns:
+            A Database.
+
+        """
+
+        return open_shard(self.locate(name, create), self.backend,
+                          pooled=pooled)
+
+
+    def placements(self):
+        """
+        Get the number of programs placed on each shard.
+
+        Returns:
+            A dict mapping each shard to a count.
+
+        """
+
+        counts = dict(self.directory.rows("select shard, count(1) " +
+                                          "from placements group by shard;"))
+
+        return dict((s, counts.get(s, 0)) for s in self.shards)
+
+
+def shard_options(shard, backend=None):
+    """
+    Get the Database arguments (backend, path and section) for a shard.
+
+    """
+
+    if backend is None:
+        backend = config_get('backend', 'mysql')
+
+    if backend == 'sqlite':
+        return {'backend': backend, 'path': shard, 'section': 'db'}
+
+    return {'backend': backend, 'path': None, 'section': shard}
+
+
+def open_shard(shard, backend=None, pooled=True):
+    """
+    Open a shard's database.
+
+    """
+
+    return Database(pooled=pooled, **shard_options(shard, backend))
@@ -16,17 +16,46 @@ output matches the actual output, the test is considered to have passed.
 
 """
 
+import sys
 import glob
+import argparse
 
 from glacia import color
-from glacia.run import run
+from glacia.run import run, run_batch
+
+p = argparse.ArgumentParser()
+p.add_argument("-b", "--backend", choices=['mysql', 'sqlite'])
+p.add_argument("-d", "--db-path")
+p.add_argument("-e", "--engine", choices=['db', 'memory', 'log'],
+               default='db')
+p.add_argument("--log-path", default='glacia.log')
+p.add_argument("--batch", action='store_true',
+               help="run the tests in parallel (db engine only)")
+args = p.parse_args(sys.argv[1:])
 
 print('')
 
 successful = 0
 total = 0
 
-for fn in glob.glob('test/code_tests/*.glaciatest'):
+fns = glob.glob('test/code_tests/*.glaciatest')
+
+# With --batch, every test program is run up front and the outputs are
+# checked below.
+batched = {}
+
+if args.batch:
+    srcs = []
+
+    for fn in fns:
+        with open(fn, 'rb') as f:
+            srcs.append(f.read().decode('utf-8').split('---')[1].strip())
+
+    for result in run_batch(srcs=srcs, backend=args.backend,
+                            db_path=args.db_path):
+        batched[fns[result['index']]] = result
+
+for fn in fns:
     total += 1
 
     with open(fn, 'rb') as f:
@@ -35,8 +64,16 @@ for fn in glob.glob('test/code_tests/*.glaciatest'):
         expected = parts[0].strip()
 
         try:
-            # Run the test program and collect the standard output.
-            actual = run(src=parts[1].strip(), collect_stdout=True)
+            if args.batch:
+                if batched[fn]['error'] is not None:
+                    raise Exception(batched[fn]['error'])
+
+                actual = batched[fn]['output']
+            else:
+                # Run the test program and collect the standard output.
+                actual = run(src=parts[1].strip(), collect_stdout=True,
+                             backend=args.backend, db_path=args.db_path,
+                             engine=args.engine, log_path=args.log_path)
         except:
             print(color.print('Error running '+fn+':', 'red'))
             raise
@@ -0,0 +1,127 @@
+/* The version 1 SQLite schema, from before schema versions, used to check
+   that old databases are upgraded (see glacia.migrations). */
+
+/* Block allocator for row IDs (see Database.next_id()) and the number of
+   programs loaded so far (see glacia.program.program_version()). */
+create table sequences
+(
+    name varchar(64)
+,   next_id integer
+
+,   primary key (name)
+);
+
+insert into sequences (name, next_id) values ('ids', 1);
+insert into sequences (name, next_id) values ('loads', 1);
+
+create table functions
+(
+    id integer
+,   label varchar(255)
+,   return_type varchar(255)
+,   arguments text
+
+    /* sha256 of the function's DBIL, to skip unchanged functions on reload */
+,   code_hash char(64) null
+
+,   primary key (id)
+,   unique (label)
+);
+
+create table instructions
+(
+    id integer
+,   function_id integer null
+,   parent_id integer null
+,   previous_id integer null
+,   code text
+,   label varchar(64) null
+
+    /* Control flow worked out by the loader. The instruction to go to once
+       this one is done (null at the end of the function), the number of
+       conditionals popped on the way there and, for break and continue, the
+       enclosing loops as a JSON list of [loop id, conditionals popped]. */
+,   successor_id integer null
+,   exits integer not null default 0
+,   loops text null
+
+,   primary key (id)
+,   unique (function_id, parent_id, previous_id)
+,   unique (function_id, label)
+,   foreign key (function_id) references functions (id)
+,   foreign key (parent_id) references instructions (id)
+,   foreign key (previous_id) references instructions (id)
+);
+
+create index instructions_previous_id on instructions (previous_id);
+create index instructions_parent_id on instructions (parent_id);
+
+create table threads
+(
+    id integer
+
+,   primary key (id)
+);
+
+/* The call stack. Each row is a frame in a thread. */
+create table calls
+(
+    id integer
+,   thread_id integer
+,   depth integer null
+,   instruction_id integer
+,   calling_instruction_id integer null
+
+,   primary key (id)
+,   unique (thread_id, depth)
+,   foreign key (thread_id) references threads (id)
+,   foreign key (instruction_id) references instructions (id)
+,   foreign key (calling_instruction_id) references instructions (id)
+);
+
+/* The conditional stack. Each row is a conditional (if[/else if][/else]). */
+create table conditionals
+(
+    call_id integer
+,   depth int
+,   satisfied bool
+
+,   primary key (call_id, depth)
+,   foreign key (call_id) references calls (id) on delete cascade
+);
+
+/* Addresses in virtual database "memory". */
+create table addresses
+(
+    id integer
+,   type varchar(16)
+,   val varchar(255)
+
+,   primary key (id)
+);
+
+/* Local variables visible to a given call stack frame */
+create table locals
+(
+    id integer
+,   call_id integer
+,   label varchar(255)
+,   address_id integer
+
+,   primary key (id)
+,   unique (call_id, label)
+,   foreign key (call_id) references calls (id) on delete cascade
+,   foreign key (address_id) references addresses (id) on delete cascade
+);
+
+/* List items */
+create table items
+(
+    list_id integer
+,   ordinal int
+,   address_id integer
+
+,   primary key (list_id, ordinal)
+,   foreign key (list_id) references addresses (id) on delete cascade
+,   foreign key (address_id) references addresses (id) on delete cascade
+);
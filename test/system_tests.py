@@ -0,0 +1,1075 @@
+"""
+Checks of the parts of glacia which code tests can't reach: resuming after
+a crash, reloads, schema upgrades, several interpreters sharing a program,
+jobs, the asyncio runner, shards, forks and the daemon. Each check runs
+against fresh SQLite databases in a temporary directory and raises an
+exception if something is wrong:
+
+    python3 test/system_tests.py [-k substring of a check name]
+
+"""
+
+import gc
+import os
+import sys
+import stat
+import asyncio
+import sqlite3
+import argparse
+import tempfile
+import threading
+import traceback
+import subprocess
+
+from glacia import color, Database, close_after
+from glacia.run import run, run_batch
+from glacia.compiler import compile_source
+from glacia.loader import load
+from glacia.migrations import latest_version
+from glacia.backends.sqlite import schema_path, qmark
+from glacia.interpreter import Interpreter, free_type
+from glacia.memory import MemoryInterpreter
+from glacia.eventlog import LogInterpreter
+from glacia.program import find_program
+from glacia.fork import fork, program_ids
+from glacia.aio import AsyncRunner
+from glacia.shards import ShardMap, open_shard
+from glacia import jobs
+from glacia.daemon import Daemon
+from glacia.client import request, DaemonError
+
+# The SQLite schema from before schema versions.
+schema_v1_path = os.path.join(os.path.dirname(__file__), 'sqlite_v1.sql')
+
+checks = []
+
+
+def check(func):
+    checks.append(func)
+    return func
+
+
+def expect(actual, expected):
+    if actual != expected:
+        raise Exception('Expected ' + repr(expected) + ', got ' +
+                        repr(actual) + '.')
+
+
+# Allocates a list on every iteration and frees the last one.
+lists_src = '''
+def main()
+{
+    i = 0;
+    while (i < 300)
+    {
+        x = list(i, i + 1);
+        print(x[0] + x[1]);
+        i = i + 1;
+    }
+}
+'''
+
+lists_output = [str(2 * i + 1) for i in range(300)]
+
+# Calls a function allocating a list on every iteration.
+pairs_src = '''
+def pair(i)
+{
+    x = list(i, i + 1);
+    return x[0] + x[1];
+}
+
+def main()
+{
+    i = 0;
+    while (i < 100)
+    {
+        print(pair(i));
+        i = i + 1;
+    }
+}
+'''
+
+# Two threads printing their names.
+threads_src = '''
+def count(name, n)
+{
+    i = 0;
+    while (i < n)
+    {
+        print(name);
+        i = i + 1;
+    }
+}
+
+def main()
+{
+    spawn("count", "a", 20);
+    spawn("count", "b", 20);
+}
+'''
+
+
+# A generator feeding a list passed by reference.
+generator_src = '''
+generator numbers(total)
+{
+    i = 1;
+
+    while (i <= total)
+    {
+        yield i;
+        i = i + 1;
+    }
+}
+
+def add(lst, n)
+{
+    push(lst, n);
+}
+
+def main()
+{
+    ar = list();
+    gen = numbers(20);
+
+    for (n in gen)
+    {
+        add(ar, n * n);
+        print(ar[len(ar) - 1]);
+    }
+
+    print(len(ar));
+}
+'''
+
+generator_output = [str(i * i) for i in range(1, 21)] + ['20']
+
+
+def glacia(*args):
+    """
+    Run the glacia command line and return the lines it printed.
+
+    """
+
+    ret = subprocess.run([sys.executable, '-m', 'glacia.cli'] + list(args),
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    if ret.returncode != 0:
+        raise Exception('glacia ' + ' '.join(args) + ' failed: ' +
+                        ret.stderr.decode('utf-8'))
+
+    return ret.stdout.decode('utf-8').splitlines()
+
+
+def write_source(tmp, name, src):
+    fn = os.path.join(tmp, name + '.glacia')
+
+    with open(fn, 'w') as f:
+        f.write(src)
+
+    return fn
+
+
+def load_program(db_path, name, src, **options):
+    run(src=src, exec_lines=0, backend='sqlite', db_path=db_path,
+        program=name, **options)
+
+    with close_after(Database('sqlite', db_path)) as db:
+        return find_program(db, name)
+
+
+@check
+def compile_cache_unwritable(tmp):
+    # A cache directory which can't be created doesn't stop compiling.
+    blocker = os.path.join(tmp, 'file')
+
+    with open(blocker, 'w') as f:
+        f.write('')
+
+    compile_source(lists_src, cache_dir=os.path.join(blocker, 'cache'))
+
+
+@check
+def sqlite_durable_commits(tmp):
+    # Every commit is synced, so one which has returned survives a power
+    # failure (2 is FULL).
+    with close_after(Database('sqlite', os.path.join(tmp, 'sync.db'))) as db:
+        expect(db.scalar("pragma synchronous;"), 2)
+
+
+@check
+def query_shapes(tmp):
+    # Queries take a fixed number of forms however many rows a program
+    # inserts or frees, so statement caches can reuse them.
+    db_path = os.path.join(tmp, 'shapes.db')
+    load_program(db_path, 'shapes', lists_src)
+
+    qmark.cache_clear()
+
+    expect(run(collect_stdout=True, backend='sqlite', db_path=db_path,
+               program='shapes'),
+           lists_output)
+    expect(qmark.cache_info().currsize < 100, True)
+
+
+@check
+def crash_resume(tmp):
+    # A process which dies between commits loses the lines run since the
+    # last one along with their output, and the program carries on after
+    # the last commit when resumed, so no output is repeated or lost.
+    engines = {'db': Interpreter, 'memory': MemoryInterpreter,
+               'log': LogInterpreter}
+
+    for engine, cls in engines.items():
+        db_path = os.path.join(tmp, engine + '.db')
+        log_path = os.path.join(tmp, engine + '.log')
+        program_id = load_program(db_path, 'crash', generator_src,
+                                  engine=engine, log_path=log_path)
+
+        before = []
+        db = Database('sqlite', db_path, pooled=False)
+        args = [db, log_path] if engine == 'log' else [db]
+        interpreter = cls(*args, stdout_func=before.append, commit_every=7,
+                          program_id=program_id)
+
+        # Until there is output committed and output which isn't.
+        while len(before) == 0 or len(interpreter.output) == 0:
+            expect(interpreter.run_one_line(), True)
+
+        # Whatever the interpreter wrote reaches its files before the crash,
+        # as if the OS had flushed its buffers between commits.
+        del interpreter
+        gc.collect()
+
+        db.close()
+
+        after = run(collect_stdout=True, backend='sqlite', db_path=db_path,
+                    engine=engine, log_path=log_path, program='crash')
+
+        expect(before + after, generator_output)
+
+
+@check
+def rollback_resume(tmp):
+    # Rolling back between commits goes back to the last commit, so running
+    # on from there neither repeats nor loses output.
+    engines = {'db': Interpreter, 'memory': MemoryInterpreter,
+               'log': LogInterpreter}
+
+    for engine, cls in engines.items():
+        db_path = os.path.join(tmp, engine + '.db')
+        log_path = os.path.join(tmp, engine + '.log')
+        program_id = load_program(db_path, 'rollback', generator_src,
+                                  engine=engine, log_path=log_path)
+
+        out = []
+
+        with close_after(Database('sqlite', db_path, pooled=False)) as db:
+            args = [db, log_path] if engine == 'log' else [db]
+            interpreter = cls(*args, stdout_func=out.append, commit_every=7,
+                              program_id=program_id)
+
+            while len(out) == 0 or len(interpreter.output) == 0:
+                expect(interpreter.run_one_line(), True)
+
+            interpreter.rollback()
+            interpreter.run()
+
+        expect(out, generator_output)
+
+
+@check
+def reload_new_temps(tmp):
+    # An edit adding temp variables to the first function doesn't rename
+    # the temps of the functions after it, so they aren't rewritten.
+    db_path = os.path.join(tmp, 'temps.db')
+    program_id = load_program(db_path, 'temps', generator_src)
+
+    changed = generator_src.replace('yield i;', 'yield i + len(list());')
+
+    with close_after(Database('sqlite', db_path)) as db:
+        loaded = load(db, compile_source(changed, cache_dir=None),
+                      program_id)
+        Interpreter(db, program_id=program_id).start()
+
+    expect((loaded['functions'], loaded['unchanged']), (1, 2))
+
+    expect(run(collect_stdout=True, backend='sqlite', db_path=db_path,
+               program='temps'),
+           generator_output)
+
+
+@check
+def reload_changed_function(tmp):
+    # Reloading a program rewrites only the functions which changed and
+    # starts it again. Other programs in the database carry on regardless.
+    db_path = os.path.join(tmp, 'reload.db')
+
+    load_program(db_path, 'other', generator_src)
+    before = run(exec_lines=60, collect_stdout=True, backend='sqlite',
+                 db_path=db_path, program='other')
+
+    program_id = load_program(db_path, 'reload', generator_src)
+    run(exec_lines=60, collect_stdout=True, backend='sqlite',
+        db_path=db_path, program='reload')
+
+    changed = generator_src.replace('push(lst, n);', 'push(lst, n + 1);')
+
+    def function_ids(db):
+        return dict(db.rows("select label, id from functions " +
+                            "where program_id = %s;", (program_id,)))
+
+    with close_after(Database('sqlite', db_path)) as db:
+        old_ids = function_ids(db)
+        loaded = load(db, compile_source(changed, cache_dir=None),
+                      program_id)
+        Interpreter(db, program_id=program_id).start()
+        new_ids = function_ids(db)
+
+    expect((loaded['functions'], loaded['unchanged']), (1, 2))
+    expect([new_ids[f] == old_ids[f] for f in ['numbers', 'add', 'main']],
+           [True, False, True])
+
+    expect(run(collect_stdout=True, backend='sqlite', db_path=db_path,
+               program='reload'),
+           [str(i * i + 1) for i in range(1, 21)] + ['20'])
+
+    after = run(collect_stdout=True, backend='sqlite', db_path=db_path,
+                program='other')
+
+    expect(before + after, generator_output)
+
+
+@check
+def migrate_version_1(tmp):
+    # A database from before schema versions, holding a list in a local,
+    # is brought up to date when opened and can run programs afterwards.
+    db_path = os.path.join(tmp, 'old.db')
+
+    conn = sqlite3.connect(db_path)
+
+    with open(schema_v1_path, 'rb') as f:
+        conn.executescript(f.read().decode('utf-8'))
+
+    conn.executescript(
+        "update sequences set next_id = 9 where name = 'ids';" +
+        "update sequences set next_id = 3 where name = 'loads';" +
+        "insert into functions (id, label, return_type, arguments) " +
+         "values (1, 'main', 'def', '[]');" +
+        "insert into instructions (id, function_id, code) " +
+         "values (2, 1, '{}');" +
+        "insert into threads (id) values (3);" +
+        "insert into calls (id, thread_id, depth, instruction_id) " +
+         "values (4, 3, 0, 2);" +
+        "insert into addresses (id, type, val) " +
+         "values (5, 'list', '2'), (6, 'int', '7'), (7, 'int', '8');" +
+        "insert into locals (id, call_id, label, address_id) " +
+         "values (8, 4, 'x', 5);" +
+        "insert into items (list_id, ordinal, address_id) " +
+         "values (5, 0, 6), (5, 1, 7);")
+    conn.commit()
+    conn.close()
+
+    with close_after(Database('sqlite', db_path)) as db:
+        expect(db.scalar("select version from schema_version;"),
+               latest_version)
+
+        # The state is the default program's, with references counted.
+        expect(db.row("select id, name, version from programs;"),
+               (0, 'default', 3))
+        expect(db.rows("select id, refs, program_id from addresses " +
+                       "order by id;"),
+               [(5, 1, 0), (6, 1, 0), (7, 1, 0)])
+        expect(db.rows("select id, program_id, label from functions;"),
+               [(1, 0, 'main')])
+
+    expect(run(src=generator_src, collect_stdout=True, backend='sqlite',
+               db_path=db_path, program='new', cache_dir=None),
+           generator_output)
+
+
+@check
+def migrate_unversioned(tmp):
+    # A database from before version 1, with 3-character IDs and no
+    # sequences, is refused with an explanation and left as it was.
+    db_path = os.path.join(tmp, 'ancient.db')
+
+    conn = sqlite3.connect(db_path)
+    conn.executescript(
+        "create table functions (id char(3), label varchar(255), " +
+         "return_type varchar(255), arguments text, primary key (id));" +
+        "insert into functions values ('a1b', 'main', 'def', '[]');")
+    conn.commit()
+    conn.close()
+
+    try:
+        Database('sqlite', db_path, pooled=False)
+    except Exception as e:
+        expect('predates schema versions' in str(e), True)
+    else:
+        raise Exception('Expected the database to be refused.')
+
+    conn = sqlite3.connect(db_path)
+
+    try:
+        expect(conn.execute("select name from sqlite_master " +
+                            "where type = 'table';").fetchall(),
+               [('functions',)])
+    finally:
+        conn.close()
+
+
+def sqlite_schema(db_path):
+    # The columns and indexes of each table, regardless of their order.
+    conn = sqlite3.connect(db_path)
+
+    try:
+        tables = [r[0] for r in conn.execute(
+            "select name from sqlite_master where type = 'table';")]
+
+        return {table: (
+            sorted(c[1:] for c in conn.execute(
+                "pragma table_info(" + table + ");")),
+            sorted(r[1] for r in conn.execute(
+                "pragma index_list(" + table + ");")))
+            for table in tables}
+    finally:
+        conn.close()
+
+
+@check
+def baseline_schema(tmp):
+    # A new database starts at the latest version, with the same tables as
+    # an upgraded one.
+    new_path = os.path.join(tmp, 'new.db')
+    old_path = os.path.join(tmp, 'old.db')
+
+    conn = sqlite3.connect(old_path)
+
+    with open(schema_v1_path, 'rb') as f:
+        conn.executescript(f.read().decode('utf-8'))
+
+    conn.close()
+
+    for db_path in [new_path, old_path]:
+        with close_after(Database('sqlite', db_path)) as db:
+            expect(db.scalar("select version from schema_version;"),
+                   latest_version)
+            expect(db.rows("select id, name, version, free_head " +
+                           "from programs;"),
+                   [(0, 'default', 1, 0)])
+            expect(db.rows("select name from sequences;"), [('ids',)])
+
+    # Autoindexes are named after the order of constraints, so only compare
+    # the columns and named indexes.
+    new, old = sqlite_schema(new_path), sqlite_schema(old_path)
+
+    expect(sorted(new), sorted(old))
+
+    for table in new:
+        expect(new[table][0], old[table][0])
+        expect([i for i in new[table][1] if 'autoindex' not in i],
+               [i for i in old[table][1] if 'autoindex' not in i])
+
+
+@check
+def current_schema_unlocked(tmp):
+    # Opening a database which is already current takes no schema lock, so
+    # it isn't held up by another connection writing.
+    db_path = os.path.join(tmp, 'current.db')
+
+    conn = sqlite3.connect(db_path)
+    conn.execute('pragma journal_mode = wal;')
+
+    with open(schema_path, 'rb') as f:
+        conn.executescript(f.read().decode('utf-8'))
+
+    conn.execute('begin immediate;')
+
+    try:
+        with close_after(Database('sqlite', db_path, pooled=False)) as db:
+            expect(db.scalar("select version from schema_version;"),
+                   latest_version)
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+@check
+def frame_memory_reclaimed(tmp):
+    # The memory of a frame is freed when the call returns and reused by the
+    # next call, so a loop of calls uses the same few addresses throughout.
+    db_path = os.path.join(tmp, 'frames.db')
+    program_id = load_program(db_path, 'frames', pairs_src)
+
+    output = run(exec_lines=400, collect_stdout=True, backend='sqlite',
+                 db_path=db_path, program='frames')
+
+    expect(len(output) > 40, True)
+    expect(output, [str(2 * i + 1) for i in range(len(output))])
+
+    with close_after(Database('sqlite', db_path)) as db:
+        addresses = db.scalar("select count(1) from addresses " +
+                              "where program_id = %s;", (program_id,))
+
+    expect(addresses < 20, True)
+
+
+@check
+def temp_lists_released(tmp):
+    # The temporary local holding each list built by list() goes once the
+    # list has been assigned, so a loop building lists keeps the same few
+    # locals and addresses.
+    db_path = os.path.join(tmp, 'temps.db')
+    program_id = load_program(db_path, 'temps', lists_src)
+
+    output = run(exec_lines=1000, collect_stdout=True, backend='sqlite',
+                 db_path=db_path, program='temps')
+
+    expect(len(output) > 100, True)
+    expect(output, lists_output[:len(output)])
+
+    with close_after(Database('sqlite', db_path)) as db:
+        locals_ = db.scalar("select count(1) from locals;")
+        addresses = db.scalar("select count(1) from addresses " +
+                              "where program_id = %s and type <> %s;",
+                              (program_id, free_type))
+
+    expect(locals_ <= 3, True)
+    expect(addresses < 10, True)
+
+
+@check
+def shared_program_sweeps(tmp):
+    # Two interpreters take turns running one program while one of them
+    # sweeps memory.
+    db_path = os.path.join(tmp, 'shared.db')
+    program_id = load_program(db_path, 'shared', lists_src)
+
+    output = []
+    interpreters = [
+        Interpreter(Database('sqlite', db_path), stdout_func=output.append,
+                    program_id=program_id, sweep_every=sweep_every)
+        for sweep_every in [7, None]]
+
+    more = True
+    turn = 0
+
+    while more:
+        more = interpreters[turn % 2].run_one_line()
+        turn += 1
+
+    for interpreter in interpreters:
+        interpreter.flush()
+        interpreter.db.close()
+
+    expect(output, lists_output)
+
+
+@check
+def sweep_unreachable(tmp):
+    # A sweep frees a cycle of lists which only refer to each other, and
+    # leaves the lists reachable from locals alone.
+    db_path = os.path.join(tmp, 'sweep.db')
+    program_id = load_program(db_path, 'sweep', lists_src)
+
+    output = []
+
+    with close_after(Database('sqlite', db_path)) as db:
+        interpreter = Interpreter(db, stdout_func=output.append,
+                                  program_id=program_id, sweep_every=None)
+
+        for i in range(40):
+            interpreter.run_one_line()
+
+        first, second = interpreter.mem_alloc(), interpreter.mem_alloc()
+
+        for addr, other in [(first, second), (second, first)]:
+            interpreter.store_address(addr, 'list', '1')
+            interpreter.store_item(addr, 0, other)
+
+        interpreter.flush()
+
+        def items(db):
+            return db.rows("select list_id, ordinal, address_id from items " +
+                           "order by list_id, ordinal;")
+
+        reachable = [item for item in items(db)
+                     if item[0] not in (first, second)]
+        expect(len(reachable) > 0, True)
+
+        interpreter.sweep()
+        interpreter.flush()
+
+        expect(db.rows("select type from addresses where id in (%s, %s);",
+                       (first, second)),
+               [('free',), ('free',)])
+        expect(items(db), reachable)
+
+        interpreter.run()
+
+    expect(output, lists_output)
+
+
+@check
+def shared_free_addresses(tmp):
+    # A sweep puts the addresses another interpreter has freed and holds on
+    # to back on the free list. Only one of the two may get each of them.
+    db_path = os.path.join(tmp, 'free.db')
+    program_id = load_program(db_path, 'free', lists_src)
+
+    first, second = [Interpreter(Database('sqlite', db_path),
+                                 program_id=program_id)
+                     for i in range(2)]
+
+    # As freed by a line of the second interpreter.
+    addr = second.mem_alloc()
+    second.release_addresses([addr])
+    second.free_addresses.extend(second.released)
+    second.released = []
+    second.flush()
+
+    first.sweep()
+    first.flush()
+
+    taken = set()
+
+    while addr not in taken:
+        taken.add(first.mem_alloc())
+
+    first.flush()
+
+    expect(second.mem_alloc() in taken, False)
+    second.flush()
+
+    for interpreter in [first, second]:
+        interpreter.db.close()
+
+
+@check
+def gc_referenced_again(tmp):
+    # An address referred to again after gc() found it unreferenced (as by
+    # another interpreter) is left alone, along with its items.
+    db_path = os.path.join(tmp, 'gc.db')
+    program_id = load_program(db_path, 'gc', lists_src)
+
+    with close_after(Database('sqlite', db_path)) as db:
+        interpreter = Interpreter(db, program_id=program_id)
+
+        lst, item, other = [interpreter.mem_alloc() for i in range(3)]
+        interpreter.store_address(lst, 'list', 1)
+        interpreter.store_item(lst, 0, item)
+        interpreter.add_refs(lst, 1)
+
+        interpreter.mem_free([lst, other])
+
+        expect(interpreter.released, [other])
+        expect(db.row("select type, refs from addresses where id = %s;",
+                      (lst,)), ('list', 1))
+        expect(db.scalar("select refs from addresses where id = %s;",
+                         (item,)), 1)
+
+
+@check
+def free_list_order(tmp):
+    # Addresses are reserved in the order they are chained, whatever their
+    # IDs, and no further than the end of the chain.
+    db_path = os.path.join(tmp, 'order.db')
+    program_id = load_program(db_path, 'order', lists_src)
+
+    with close_after(Database('sqlite', db_path)) as db:
+        interpreter = Interpreter(db, program_id=program_id)
+        interpreter.free_block_size = 3
+
+        addrs = [interpreter.mem_alloc() for i in range(5)]
+        interpreter.release_addresses(addrs)
+        interpreter.flush()
+
+        chain = [addrs[i] for i in [3, 0, 4, 1, 2]]
+        db.many("update addresses set next_free_id = %s where id = %s;",
+                list(zip(chain[1:] + [None], chain)))
+        db.cmd("update programs set free_head = %s where id = %s;",
+               (chain[0], program_id))
+        db.commit()
+
+        interpreter = Interpreter(db, program_id=program_id)
+        interpreter.free_block_size = 3
+
+        expect([interpreter.mem_alloc() for i in range(5)], chain)
+        expect(db.scalar("select free_head from programs where id = %s;",
+                         (program_id,)), 0)
+
+
+@check
+def shared_program_conflicts(tmp):
+    # A line which conflicts rolls back the uncommitted lines before it,
+    # whose output must not be written twice.
+    db_path = os.path.join(tmp, 'conflicts.db')
+    program_id = load_program(db_path, 'conflicts', threads_src)
+
+    output = []
+    first, second = [
+        Interpreter(Database('sqlite', db_path), stdout_func=output.append,
+                    program_id=program_id, commit_every=commit_every)
+        for commit_every in [1000, 1]]
+
+    # Start both threads.
+    while len(first.db.rows("select id from threads " +
+                            "where program_id = %s;", (program_id,))) < 3:
+        first.run_one_line()
+
+    first.flush()
+
+    a, b = [thread_id for thread_id, in first.db.rows(
+        "select threads.id from threads " +
+        "join calls on calls.thread_id = threads.id " +
+        "where threads.program_id = %s and calls.depth = 0 " +
+        "order by threads.id;", (program_id,))][-2:]
+
+    first.run_one_line(a)
+    first.flush()
+
+    # The second interpreter runs thread a behind the first one's back, so
+    # the first conflicts on its next line of a, after lines of b.
+    second.run_one_line(a)
+    second.flush()
+
+    # Enough lines of b to go round its loop, printing.
+    for i in range(6):
+        first.run_one_line(b)
+
+    first.run_one_line(a)
+
+    expect(first.conflicts, 1)
+
+    while first.run_one_line():
+        pass
+
+    first.flush()
+
+    for interpreter in [first, second]:
+        interpreter.db.close()
+
+    expect(sorted(output), ['a'] * 20 + ['b'] * 20)
+
+
+@check
+def job_pool(tmp):
+    # Jobs submitted from the command line run to the end across a pool of
+    # workers, and a failing job doesn't stop the others.
+    db_args = ['-b', 'sqlite', '-d', os.path.join(tmp, 'jobs.db')]
+    good = write_source(tmp, 'good', generator_src)
+    bad = write_source(tmp, 'bad', 'def main() { nosuch(); }')
+
+    for name, fn in [('first', good), ('broken', bad), ('second', good)]:
+        glacia('submit', '-n', name, '-f', fn, '--cache-dir',
+               os.path.join(tmp, 'cache'), *db_args)
+
+    output = glacia('pool', '--workers', '2', '--max-running', '2',
+                    *db_args)
+
+    expect(sorted(output), sorted(generator_output * 2))
+
+    listed = [line.split()[:2] for line in glacia('jobs', *db_args)]
+    expect(listed, [['first', 'finished'], ['broken', 'failed'],
+                    ['second', 'finished']])
+
+    with close_after(Database('sqlite', db_args[-1])) as db:
+        progress = jobs.progress(db)
+
+    expect([job['error'] for job in progress],
+           [None, 'Function not found: nosuch', None])
+
+    # A failed job keeps its state, finished ones have nothing left to run.
+    expect([progress[i]['threads'] for i in [0, 2]], [0, 0])
+    expect(progress[0]['lines_run'], progress[2]['lines_run'])
+    expect(progress[0]['lines_run'] > 0, True)
+
+
+@check
+def async_runner(tmp):
+    # Programs run a slice at a time on one event loop, each with its own
+    # output, and a program which fails doesn't stop the others.
+    db_path = os.path.join(tmp, 'aio.db')
+    srcs = {'gen': generator_src, 'threads': threads_src,
+            'bad': 'def main() { nosuch(); }'}
+
+    program_ids = dict((name, load_program(db_path, name, src))
+                       for name, src in srcs.items())
+    output = dict((name, []) for name in srcs)
+
+    async def main():
+        runner = AsyncRunner('sqlite', db_path, concurrency=2,
+                             slice_lines=5)
+        runner.start()
+
+        done = {}
+
+        for name in srcs:
+            done[name] = await runner.submit(
+                program_ids[name], stdout_func=output[name].append)
+
+        await runner.close()
+
+        return done
+
+    done = asyncio.run(main())
+
+    expect(output['gen'], generator_output)
+    expect(sorted(output['threads']), ['a'] * 20 + ['b'] * 20)
+    expect(output['bad'], [])
+    expect(str(done['bad'].exception()), 'Function not found: nosuch')
+
+    # Nothing is left to run.
+    for name in ['gen', 'threads']:
+        expect(run(collect_stdout=True, backend='sqlite', db_path=db_path,
+                   program=name), [])
+
+
+@check
+def shard_placement(tmp):
+    # Programs are spread evenly across shards, stay on the shard they were
+    # placed on when resumed, and can be run as jobs on their shard.
+    directory = os.path.join(tmp, 'directory.db')
+    shards = [os.path.join(tmp, s + '.db') for s in ['a', 'b', 'c']]
+    names = ['p' + str(i) for i in range(4)]
+
+    before = dict((name, run(src=generator_src, exec_lines=40,
+                             collect_stdout=True, backend='sqlite',
+                             db_path=directory, program=name,
+                             shards=shards[:2], cache_dir=None))
+                  for name in names)
+
+    with close_after(Database('sqlite', directory)) as db:
+        shard_map = ShardMap(db, shards[:2], 'sqlite')
+        placed = dict((name, shard_map.locate(name)) for name in names)
+
+        expect(shard_map.placements(), {shards[0]: 2, shards[1]: 2})
+
+        # A new shard takes new programs. The others stay where they are.
+        shard_map = ShardMap(db, shards, 'sqlite')
+        expect(shard_map.place('p4'), shards[2])
+        expect(dict((name, shard_map.locate(name)) for name in names),
+               placed)
+
+    for name in names:
+        for shard in shards[:2]:
+            with close_after(open_shard(shard, 'sqlite')) as db:
+                expect(find_program(db, name) is not None,
+                       shard == placed[name])
+
+        after = run(collect_stdout=True, backend='sqlite', db_path=directory,
+                    program=name, shards=shards[:2])
+
+        expect(before[name] + after, generator_output)
+
+    # From the command line, a job goes to the least used shard.
+    db_args = ['-b', 'sqlite', '-d', directory]
+    shard_args = ['--shard', shards[0], '--shard', shards[2]]
+    fn = write_source(tmp, 'job', generator_src)
+
+    glacia('submit', '-n', 'job', '-f', fn, '--cache-dir',
+           os.path.join(tmp, 'cache'), *(db_args + shard_args))
+
+    expect(glacia('pool', '--workers', '1', '-b', 'sqlite', '-d', shards[2]),
+           generator_output)
+
+    listed = [line.split()[:2]
+              for line in glacia('jobs', *(db_args + shard_args))]
+    expect(listed, [['job', 'finished']])
+
+
+@check
+def fork_program(tmp):
+    # A fork taken halfway, with a generator's frame and a list in memory,
+    # carries on from the same point as the original, unaffected by it.
+    db_path = os.path.join(tmp, 'fork.db')
+    load_program(db_path, 'original', generator_src)
+
+    # With another program's rows among the original's IDs.
+    before = run(exec_lines=50, collect_stdout=True, backend='sqlite',
+                 db_path=db_path, program='original')
+    load_program(db_path, 'other', generator_src)
+    before += run(exec_lines=100, collect_stdout=True, backend='sqlite',
+                  db_path=db_path, program='original')
+
+    with close_after(Database('sqlite', db_path)) as db:
+        copy = fork(db, find_program(db, 'original'), 'copy')
+
+        # The copy's rows take up a block of IDs with no gaps.
+        count, low, high = db.row("select count(1), min(id), max(id) from (" +
+                                  program_ids + ") as ids;", (copy,) * 6)
+        expect(high - low + 1, count)
+        expect(db.scalar("select count(1) from fork_ids;"), 0)
+
+    for name in ['original', 'copy']:
+        after = run(collect_stdout=True, backend='sqlite', db_path=db_path,
+                    program=name)
+
+        expect(before + after, generator_output)
+
+
+@check
+def fork_jobs(tmp):
+    # Copies forked from the command line as jobs run on from the point the
+    # original had reached, as does the original.
+    db_args = ['-b', 'sqlite', '-d', os.path.join(tmp, 'fork.db')]
+    fn = write_source(tmp, 'original', generator_src)
+
+    before = glacia('-f', fn, '-p', 'original', '-r', '60', '--no-cache',
+                    *db_args)
+    glacia('fork', '-p', 'original', '-n', 'first', '-n', 'second',
+           '--queue', *db_args)
+
+    expect(0 < len(before) < len(generator_output), True)
+    rest = generator_output[len(before):]
+
+    expect(sorted(glacia('pool', '--workers', '2', *db_args)),
+           sorted(rest * 2))
+    expect(glacia('-p', 'original', *db_args), rest)
+
+
+@check
+def batch_results(tmp):
+    srcs = [generator_src, 'def main() { print(1); }',
+            'def main() { nosuch(); }',
+            generator_src]
+
+    results = sorted(run_batch(srcs=srcs, backend='sqlite',
+                               db_path=os.path.join(tmp, 'batch.db'),
+                               concurrency=2, cache_dir=None),
+                     key=lambda r: r['index'])
+
+    expect([r['index'] for r in results], [0, 1, 2, 3])
+    expect([r['output'] for r in results],
+           [generator_output, ['1'], [], generator_output])
+    expect([r['error'] for r in results],
+           [None, None, 'Function not found: nosuch', None])
+
+    # One line to print, and the same lines for the same source.
+    expect(results[1]['lines'], 1)
+    expect(results[0]['lines'], results[3]['lines'])
+
+
+@check
+def batch_window(tmp):
+    # Only a few programs more than are running have been prepared by the
+    # time the first result comes out.
+    db_path = os.path.join(tmp, 'window.db')
+    srcs = ['def main() { print(' + str(i) + '); }' for i in range(20)]
+
+    results = run_batch(srcs=srcs, backend='sqlite', db_path=db_path,
+                        concurrency=1, cache_dir=None)
+
+    first = next(results)
+
+    with close_after(Database('sqlite', db_path)) as db:
+        prepared = db.scalar("select count(1) from programs " +
+                             "where name like 'batch-%';")
+
+    expect(prepared <= 3, True)
+
+    rest = list(results)
+
+    expect(sorted(r['output'][0] for r in [first] + rest),
+           sorted(str(i) for i in range(20)))
+
+
+@check
+def daemon_requests(tmp):
+    socket_path = os.path.join(tmp, 'daemon.sock')
+    daemon = Daemon(socket_path, 'sqlite', os.path.join(tmp, 'daemon.db'),
+                    cache_dir=None)
+
+    serving = threading.Thread(target=daemon.serve)
+    serving.start()
+
+    try:
+        while not os.path.exists(socket_path):
+            serving.join(0.01)
+
+        expect(stat.S_IMODE(os.stat(socket_path).st_mode), 0o600)
+
+        request('load', socket_path=socket_path, program='gen',
+                src=generator_src)
+
+        step = request('step', socket_path=socket_path, program='gen',
+                       lines=30)
+        rest = request('run', socket_path=socket_path, program='gen')
+
+        expect(step['lines'], 30)
+        expect(rest['more'], False)
+        expect(step['output'] + rest['output'], generator_output)
+
+        status = request('status', socket_path=socket_path)['programs']
+        expect([(p['program'], p['lines']) for p in status],
+               [('gen', step['lines'] + rest['lines'])])
+
+        # Requests for programs the daemon can't find fail on their own.
+        try:
+            request('run', socket_path=socket_path, program='nosuch')
+            raise Exception('No error running a missing program.')
+        except DaemonError as e:
+            expect(str(e), 'Program not found: nosuch')
+
+        # A second daemon can't take over the socket.
+        try:
+            Daemon(socket_path, 'sqlite', os.path.join(tmp, 'other.db'),
+                   cache_dir=None).serve()
+            raise Exception('A second daemon started.')
+        except DaemonError:
+            pass
+    finally:
+        request('shutdown', socket_path=socket_path)
+        serving.join()
+
+    expect(os.path.exists(socket_path), False)
+
+    # Without a daemon, the client fails with a message rather than a
+    # traceback.
+    client = subprocess.run([sys.executable, '-m', 'glacia.cli', 'client',
+                             'status', '-s', socket_path],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    expect(client.returncode, 1)
+    expect(len(client.stderr.decode('utf-8').splitlines()), 1)
+
+
+def main(argv):
+    p = argparse.ArgumentParser()
+    p.add_argument("-k", "--keyword")
+    args = p.parse_args(argv)
+
+    print('')
+
+    successful = 0
+    total = 0
+
+    for func in checks:
+        if args.keyword is not None and args.keyword not in func.__name__:
+            continue
+
+        total += 1
+
+        with tempfile.TemporaryDirectory() as tmp:
+            try:
+                func(tmp)
+            except Exception:
+                print(color.print('Check failed', 'red') + ': ' +
+                      func.__name__)
+                print('\t' + traceback.format_exc().replace('\n', '\n\t'))
+                continue
+
+        print(color.print('Check passed', 'green') + ': ' + func.__name__)
+        successful += 1
+
+    final = '\n' + str(successful) + '/' + str(total) + ' checks successful.'
+    print(color.print(final, 'green' if successful == total else 'red'))
+
+    if successful != total:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
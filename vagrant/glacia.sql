@@ -1,23 +1,98 @@
+/* The schema version these tables are at (see glacia.migrations). */
+create table schema_version
+(
+    version int not null
+);
+
+insert into schema_version (version) values (10);
+
+/* Block allocator for row IDs (see Database.next_id()). */
+create table sequences
+(
+    name varchar(64)
+,   next_id bigint unsigned
+
+,   primary key (name)
+);
+
+insert into sequences (name, next_id) values ('ids', 1);
+
+/* Namespaces holding a program and its state (see glacia.program). version
+   counts the loads of the program's code and free_head is the first address
+   of its free list. The rest tracks the program as a job (see glacia.jobs). */
+create table programs
+(
+    id bigint unsigned
+,   name varchar(255)
+,   version bigint unsigned not null default 0
+,   free_head bigint unsigned not null default 0
+,   status varchar(16) not null default 'loaded'
+,   lines_run bigint unsigned not null default 0
+,   submitted_at bigint null
+,   started_at bigint null
+,   finished_at bigint null
+,   error text null
+
+,   primary key (id)
+,   unique (name)
+);
+
+insert into programs (id, name, version, free_head) values (0, 'default', 1, 0);
+
+/* The shard each program is placed on (see glacia.shards). */
+create table placements
+(
+    name varchar(255)
+,   shard varchar(255)
+
+,   primary key (name)
+);
+
+create index placements_shard on placements (shard);
+
+/* The new ID of each row copied by a fork in progress, by the new program
+   (see glacia.fork). */
+create table fork_ids
+(
+    program_id bigint unsigned
+,   old_id bigint unsigned
+,   new_id bigint unsigned
+
+,   primary key (program_id, old_id)
+);
+
 create table functions
 (
-    id char(3)
+    id bigint unsigned
+,   program_id bigint unsigned not null default 0
 ,   label varchar(255)
 ,   return_type varchar(255)
 ,   arguments text
 
+    /* sha256 of the function's DBIL, to skip unchanged functions on reload */
+,   code_hash char(64) null
+
 ,   primary key (id)
-,   unique (label)
+,   unique (program_id, label)
 );
 
 create table instructions
 (
-    id char(3)
-,   function_id char(3) null
-,   parent_id char(3) null
-,   previous_id char(3) null
+    id bigint unsigned
+,   function_id bigint unsigned null
+,   parent_id bigint unsigned null
+,   previous_id bigint unsigned null
 ,   code text
 ,   label varchar(64) null
 
+    /* Control flow worked out by the loader. The instruction to go to once
+       this one is done (null at the end of the function), the number of
+       conditionals popped on the way there and, for break and continue, the
+       enclosing loops as a JSON list of [loop id, conditionals popped]. */
+,   successor_id bigint unsigned null
+,   exits int not null default 0
+,   loops text null
+
 ,   primary key (id)
 ,   unique (function_id, parent_id, previous_id)
 ,   unique (function_id, label)
@@ -26,21 +101,31 @@ create table instructions
 ,   foreign key (previous_id) references instructions (id)
 );
 
+/* The scheduler worker running each thread and when its lease runs out (see
+   glacia.scheduler). version is bumped on every change (see
+   glacia.interpreter). */
 create table threads
 (
-    id char(3)
+    id bigint unsigned
+,   program_id bigint unsigned not null default 0
+,   lease_owner varchar(64) null
+,   lease_expires bigint null
+,   version bigint unsigned not null default 0
 
 ,   primary key (id)
 );
 
+create index threads_program_id on threads (program_id);
+
 /* The call stack. Each row is a frame in a thread. */
 create table calls
 (
-    id char(3)
-,   thread_id char(3)
+    id bigint unsigned
+,   thread_id bigint unsigned
 ,   depth bigint unsigned null
-,   instruction_id char(3)
-,   calling_instruction_id char(3) null
+,   instruction_id bigint unsigned
+,   calling_instruction_id bigint unsigned null
+,   version bigint unsigned not null default 0
 
 ,   primary key (id)
 ,   unique (thread_id, depth)
@@ -52,7 +137,7 @@ create table calls
 /* The conditional stack. Each row is a conditional (if[/else if][/else]). */
 create table conditionals
 (
-    call_id char(3)
+    call_id bigint unsigned
 ,   depth int
 ,   satisfied bool
 
@@ -60,23 +145,33 @@ create table conditionals
 ,   foreign key (call_id) references calls (id) on delete cascade
 );
 
-/* Addresses in virtual database "memory". */
+/* Addresses in virtual database "memory". refs counts the locals and items
+   referring to an address, owner_call_id is the frame it is freed with and
+   next_free_id chains freed addresses into the program's free list. */
 create table addresses
 (
-    id char(3)
+    id bigint unsigned
+,   program_id bigint unsigned not null default 0
 ,   type varchar(16)
 ,   val varchar(255)
+,   refs int not null default 0
+,   owner_call_id bigint unsigned null
+,   next_free_id bigint unsigned null
+,   version bigint unsigned not null default 0
 
 ,   primary key (id)
 );
 
+create index addresses_owner_call_id on addresses (owner_call_id);
+create index addresses_program_id on addresses (program_id);
+
 /* Local variables visible to a given call stack frame */
 create table locals
 (
-    id char(3)
-,   call_id char(3)
+    id bigint unsigned
+,   call_id bigint unsigned
 ,   label varchar(255)
-,   address_id char(3)
+,   address_id bigint unsigned
 
 ,   primary key (id)
 ,   unique (call_id, label)
@@ -84,14 +179,18 @@ create table locals
 ,   foreign key (address_id) references addresses (id) on delete cascade
 );
 
+create index locals_address_id on locals (address_id);
+
 /* List items */
 create table items
 (
-    list_id char(3)
+    list_id bigint unsigned
 ,   ordinal int
-,   address_id char(3)
+,   address_id bigint unsigned
 
 ,   primary key (list_id, ordinal)
 ,   foreign key (list_id) references addresses (id) on delete cascade
 ,   foreign key (address_id) references addresses (id) on delete cascade
 );
+
+create index items_address_id on items (address_id);